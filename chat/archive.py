@@ -0,0 +1,215 @@
+import gzip
+import io
+import json
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+
+from chat.models import Room, Message, MessageEmbedding
+from chat.retrieval import schedule_embedding
+from chat.transfer import MESSAGE_FIELDS, encoder
+from chat_ai_service.routers import pin_primary
+
+DEFAULT_ARCHIVE = {
+    'INACTIVE_DAYS': 90,  # 最后一条消息(或上次恢复)早于这么多天的房间会被归档
+    'STORAGE': None,  # 存储类的路径, 默认本地目录; 可换成对象存储
+    'OPTIONS': {},  # 传给存储类的参数
+    'PATH': None,  # 默认存储的目录, 默认 BASE_DIR/var/archive
+    'BATCH_SIZE': 1000,  # 读写消息时每批的行数
+    'COMPRESS_LEVEL': 6,
+}
+
+SPOOL_SIZE = 8 * 1024 * 1024  # 压缩结果超过这个大小时临时文件落盘
+
+
+def get_config():
+    return {**DEFAULT_ARCHIVE, **getattr(settings, 'CHAT_ARCHIVE', {})}
+
+
+_storage = None
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        config = get_config()
+        if config['STORAGE']:
+            _storage = import_string(config['STORAGE'])(**config['OPTIONS'])
+        else:
+            _storage = FileSystemStorage(location=config['PATH'] or settings.BASE_DIR / 'var' / 'archive')
+    return _storage
+
+
+def blob_name(room):
+    return f'{room.user_id}/{room.id}.ndjson.gz'
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def inactive_rooms(days=None, chunk=100, after=0):
+    """
+    逐个产出没有归档、最近一条消息和上次恢复都早于 days 天前的房间, 按 id 排序
+    按 id 键集翻页, 每页只对这一页的房间查一次 days 天内有没有消息(走 (room, id) 索引),
+    不对整张房间表做聚合
+    """
+    cutoff = timezone.now() - timedelta(days=days or get_config()['INACTIVE_DAYS'])
+    candidates = (Room.objects.filter(archived_at__isnull=True, create_time__lt=cutoff)
+                  .filter(Q(restored_at__isnull=True) | Q(restored_at__lt=cutoff))
+                  .only('id', 'user_id').order_by('id'))
+    while True:
+        rooms = list(candidates.filter(id__gt=after)[:chunk])
+        active = set(Message.objects.filter(room_id__in=[room.id for room in rooms], create_time__gte=cutoff)
+                     .values_list('room_id', flat=True).distinct()) if rooms else set()
+        for room in rooms:
+            if room.id not in active:
+                yield room
+        if len(rooms) < chunk:
+            return
+        after = rooms[-1].id
+
+
+def archive_room(room):
+    """
+    把房间的消息写成一个 gzip 压缩的 NDJSON 文件, 写完后在事务里删掉这些消息并标记房间
+    先写文件再删行, 中途失败时数据库不变, 最多留下一个下次会被覆盖的文件
+    返回归档的消息数, 没有消息时为 0(不归档), 写文件期间有新消息时为 None
+    """
+    config = get_config()
+    storage = get_storage()
+    name = blob_name(room)
+    if not Message.objects.filter(room_id=room.id).exists():
+        return 0
+    count = first_id = last_id = 0
+    # 按主键分批读, 边读边压缩到临时文件(小的在内存里, 大的落盘), 内存与房间大小无关
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as buffer:
+        with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=config['COMPRESS_LEVEL']) as archive:
+            while True:
+                rows = list(Message.objects.filter(room_id=room.id, id__gt=last_id).order_by('id')
+                            .values(*MESSAGE_FIELDS, 'user_id')[:config['BATCH_SIZE']])
+                for row in rows:
+                    # DjangoJSONEncoder 只保留到毫秒, 归档要原样恢复
+                    if row['create_time'] is not None:
+                        row['create_time'] = row['create_time'].isoformat()
+                if rows:
+                    first_id = first_id or rows[0]['id']
+                    archive.write(('\n'.join(encoder.encode(row) for row in rows) + '\n').encode())
+                    count += len(rows)
+                    last_id = rows[-1]['id']
+                if len(rows) < config['BATCH_SIZE']:
+                    break
+        buffer.seek(0)
+        if storage.exists(name):
+            storage.delete(name)
+        storage.save(name, File(buffer))
+
+    with transaction.atomic():
+        locked = Room.objects.select_for_update().filter(id=room.id, archived_at__isnull=True).first()
+        # 写文件期间有新消息或者已被别人归档, 放弃这次, 文件留着下次覆盖
+        if locked is None or Message.objects.filter(room_id=room.id, id__gt=last_id).exists():
+            return None
+        # 先按房间删掉向量, 消息就没有要级联的行了, 再按主键范围分批直接 DELETE;
+        # 消息的 delete() 会为了级联把整个房间的消息读进内存
+        MessageEmbedding.objects.filter(room_id=room.id).delete()
+        start = 0
+        while start < last_id:
+            bound = list(Message.objects.filter(room_id=room.id, id__gt=start).order_by('id')
+                         .values_list('id', flat=True)[config['BATCH_SIZE'] - 1:config['BATCH_SIZE']])
+            end = min(bound[0], last_id) if bound else last_id
+            Message.objects.filter(room_id=room.id, id__gt=start, id__lte=end)._raw_delete(Message.objects.db)
+            start = end
+        locked.archived_at = timezone.now()
+        locked.archived_messages = count
+        locked.archived_first_id = first_id
+        locked.archived_last_id = last_id
+        locked.save(update_fields=['archived_at', 'archived_messages', 'archived_first_id', 'archived_last_id'])
+    return count
+
+
+def iter_archived(room):
+    """逐条读出房间归档文件里的消息(create_time 已解析), 文件不存在时抛 ArchiveError"""
+    storage = get_storage()
+    name = blob_name(room)
+    if not storage.exists(name):
+        raise ArchiveError(f'房间 {room.id} 的归档文件 {name} 不存在')
+    with storage.open(name, 'rb') as f, gzip.GzipFile(fileobj=f, mode='rb') as archive:
+        for line in io.TextIOWrapper(archive, encoding='utf-8'):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            row['create_time'] = parse_datetime(row['create_time']) if row['create_time'] else None
+            yield row
+
+
+def restore_room(room_id):
+    """
+    把归档的消息按原来的 id 写回消息表, 房间恢复为热数据; 并发的请求在房间行锁上排队, 只恢复一次
+    返回恢复的消息数, 房间没有归档时返回 0
+    """
+    config = get_config()
+    storage = get_storage()
+    with transaction.atomic():
+        room = Room.objects.select_for_update().filter(id=room_id).first()
+        if room is None or room.archived_at is None:
+            return 0
+        name = blob_name(room)
+        batch, restored = [], 0
+        for row in iter_archived(room):
+            batch.append(Message(**row))
+            if len(batch) >= config['BATCH_SIZE']:
+                Message.objects.bulk_create(batch)
+                restored += len(batch)
+                batch = []
+        if batch:
+            Message.objects.bulk_create(batch)
+            restored += len(batch)
+        if restored != room.archived_messages:
+            raise ArchiveError(f'房间 {room_id} 的归档文件有 {restored} 条消息, 应为 {room.archived_messages} 条')
+        room.archived_at = None
+        room.archived_messages = 0
+        room.archived_first_id = room.archived_last_id = 0
+        room.restored_at = timezone.now()
+        room.save(update_fields=['archived_at', 'archived_messages', 'archived_first_id', 'archived_last_id',
+                                 'restored_at'])
+        # 恢复成功后才删文件; 向量随消息级联删除了, 重新计算
+        transaction.on_commit(lambda: storage.delete(name))
+        transaction.on_commit(lambda: schedule_embedding(room_id))
+        # 从库还没同步到恢复的消息, 这个用户先读主库
+        transaction.on_commit(lambda: pin_primary(room.user_id))
+    return restored
+
+
+def ensure_hot(room_id, user=None):
+    """
+    视图访问房间的消息之前调用: 房间已归档就先恢复, 没归档时只多一次按主键的查询
+    user 不为空时只处理该用户的房间
+    """
+    rooms = Room.objects.filter(id=room_id, archived_at__isnull=False)
+    if user is not None:
+        rooms = rooms.filter(user=user)
+    if rooms.exists():
+        restore_room(room_id)
+
+
+def ensure_message_hot(message_id, user):
+    """
+    按消息 id 访问时调用: 消息所在的房间已归档时消息不在表里, 按归档时记下的 id 范围找到该用户的房间并恢复
+    返回是否恢复了房间
+    """
+    room_ids = list(Room.objects.filter(user=user, archived_at__isnull=False, archived_first_id__lte=message_id,
+                                        archived_last_id__gte=message_id).values_list('id', flat=True))
+    return any([restore_room(room_id) for room_id in room_ids])
+
+
+def delete_archive(room):
+    if room.archived_at is not None:
+        get_storage().delete(blob_name(room))
@@ -0,0 +1,23 @@
+from django.core.cache import cache
+
+CATEGORIZED_TTL = 300
+
+
+def _version_key(user_id):
+    return f'rooms:version:{user_id}'
+
+
+def rooms_version(user_id):
+    # 每个用户一个版本号, 房间变化时加一, 旧版本的缓存自然失效
+    return cache.get_or_set(_version_key(user_id), 1, timeout=None)
+
+
+def invalidate_rooms(user_id):
+    try:
+        cache.incr(_version_key(user_id))
+    except ValueError:
+        cache.set(_version_key(user_id), 1, timeout=None)
+
+
+def rooms_cache_key(user_id, *parts):
+    return ':'.join(['rooms', str(user_id), str(rooms_version(user_id)), *map(str, parts)])
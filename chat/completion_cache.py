@@ -0,0 +1,122 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+DEFAULT_RESPONSE_CACHE = {
+    'ENABLED': False,  # 全局开关, 关闭时请求仍可用 ?cache=1 单独开启
+    'TTL': 3600,
+    'MAX_ENTRIES': 1000,
+    'REPLAY_CHUNK': 16,  # 回放时每次输出的字符数
+}
+
+SPACE_RE = re.compile(r'\s+')
+TRAILING_PUNCT_RE = re.compile(r'[\s.。!！?？~～]+$')
+
+
+def get_config():
+    return {**DEFAULT_RESPONSE_CACHE, **getattr(settings, 'CHAT_RESPONSE_CACHE', {})}
+
+
+def normalize(text):
+    # 忽略大小写、多余空白和结尾标点, "Translate this!" 和 "translate  this" 视为同一个问题
+    return TRAILING_PUNCT_RE.sub('', SPACE_RE.sub(' ', text.strip().lower()))
+
+
+def _digest(payload):
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode()).hexdigest()
+
+
+class CompletionCache:
+    """
+    模型回复的进程内缓存, 键为 模型 + 完整上下文; 先查精确键, 再查归一化键
+    TTL 过期 + LRU 淘汰, 线程安全
+    """
+
+    def __init__(self, max_entries=1000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.exact = OrderedDict()
+        self.normalized = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits_exact': 0, 'hits_normalized': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    def keys(self, model, messages):
+        exact = _digest([model, [(m['role'], m['content']) for m in messages]])
+        normalized = _digest([model, [(m['role'], normalize(m['content'])) for m in messages]])
+        return exact, normalized
+
+    def _lookup(self, store, key, now):
+        entry = store.get(key)
+        if entry is None:
+            return None
+        expires, text = entry
+        if expires < now:
+            del store[key]
+            return None
+        store.move_to_end(key)
+        return text
+
+    def get(self, model, messages):
+        exact, normalized = self.keys(model, messages)
+        now = time.monotonic()
+        with self.lock:
+            text = self._lookup(self.exact, exact, now)
+            if text is not None:
+                self.counters['hits_exact'] += 1
+                return text
+            text = self._lookup(self.normalized, normalized, now)
+            if text is not None:
+                self.counters['hits_normalized'] += 1
+                return text
+            self.counters['misses'] += 1
+            return None
+
+    def set(self, model, messages, text):
+        exact, normalized = self.keys(model, messages)
+        entry = (time.monotonic() + self.ttl, text)
+        with self.lock:
+            for store, key in ((self.exact, exact), (self.normalized, normalized)):
+                store[key] = entry
+                store.move_to_end(key)
+                while len(store) > self.max_entries:
+                    store.popitem(last=False)
+                    self.counters['evictions'] += 1
+            self.counters['stores'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.exact.clear()
+            self.normalized.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters['hits_exact'] + self.counters['hits_normalized'] + self.counters['misses']
+            hits = lookups - self.counters['misses']
+            return {
+                **self.counters,
+                'entries': len(self.exact),
+                'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def replay(text, chunk_size=None):
+    # 把缓存的回复切成小段, 按和上游一样的节奏输出给 event_stream
+    chunk_size = chunk_size or get_config()['REPLAY_CHUNK']
+    for start in range(0, len(text), chunk_size):
+        yield text[start:start + chunk_size]
+
+
+def is_enabled(request):
+    flag = request.query_params.get('cache')
+    if flag is not None:
+        return flag in ('1', 'true')
+    return get_config()['ENABLED']
+
+
+_config = get_config()
+completion_cache = CompletionCache(max_entries=_config['MAX_ENTRIES'], ttl=_config['TTL'])
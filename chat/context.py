@@ -0,0 +1,104 @@
+from django.conf import settings
+
+from chat import retrieval
+from chat.models import Room, Message
+from chat.tokens import MESSAGE_OVERHEAD, count_tokens
+
+DEFAULT_BUDGET = 3000
+# 单次最多取多少条历史, 防止极短消息的房间一次拉出太多行
+MAX_HISTORY = 200
+RECALL_HEADER = '以下是之前对话中可能与当前问题相关的内容:\n'
+
+
+def get_budget(model):
+    budgets = getattr(settings, 'CHAT_CONTEXT_BUDGETS', {})
+    return budgets.get(model, budgets.get('default', DEFAULT_BUDGET))
+
+
+def fit(rows, budget):
+    # 从最新的往前放, 放不下就停, 返回 (放进去的行, 剩余预算)
+    taken = []
+    for row in rows:
+        # tokens 为 0 的是加字段之前的老数据, 现场算一次
+        cost = (row[3] or count_tokens(row[2])) + MESSAGE_OVERHEAD
+        if cost > budget:
+            break
+        budget -= cost
+        taken.append(row)
+    return taken, budget
+
+
+def build_context(room, model, reserved=0, query=None):
+    """
+    从最新的消息往前取, 直到用完该模型的 token 预算, 返回按时间正序的 [{'role', 'content'}]
+    房间有摘要时, 摘要作为一条 system 消息放在最前面, 只取摘要之后的原始消息
+    开启检索(CHAT_RETRIEVAL)且传了 query 时, 窗口之外与 query 相关的旧消息作为一条 system 消息放在摘要之后
+    reserved: 已被系统提示和本轮用户输入占用的 token 数
+    """
+    budget = get_budget(model) - reserved
+    user_id, summary, summary_until, summary_tokens = (
+        Room.objects.filter(id=room).values_list('user_id', 'summary', 'summary_until', 'summary_tokens').first()
+        or (None, '', 0, 0))
+    summary_message = None
+    if summary and summary_tokens + MESSAGE_OVERHEAD <= budget:
+        budget -= summary_tokens + MESSAGE_OVERHEAD
+        summary_message = {'role': 'system', 'content': f'以下是之前对话的摘要:\n{summary}'}
+    else:
+        summary_until = 0
+
+    rows = list(Message.objects.filter(room=room, id__gt=summary_until)
+                .order_by('-id')
+                .values_list('id', 'role', 'content', 'tokens')[:MAX_HISTORY])
+
+    window, _ = fit(rows, budget)
+    recalled_message = None
+    # 只有窗口装不下全部历史(或者更早的已被摘要)时才需要检索
+    if query and (len(window) < len(rows) or summary_until or len(rows) == MAX_HISTORY):
+        recalled = recall(room, user_id, query, rows, budget)
+        if recalled:
+            # 剩下的预算还给窗口, 但窗口不能延伸到已经检索出来的消息
+            recalled_message, cost, recalled_ids = recalled
+            cut = next((i for i, row in enumerate(rows) if row[0] in recalled_ids), len(rows))
+            window, _ = fit(rows[:cut], budget - cost)
+
+    context = [{'role': role, 'content': content} for _, role, content, _ in reversed(window)]
+    if recalled_message:
+        context.insert(0, recalled_message)
+    if summary_message:
+        context.insert(0, summary_message)
+    return context
+
+
+def recall(room, user_id, query, rows, budget):
+    """
+    检索窗口之外的相关旧消息, 最多用 BUDGET_RATIO 的预算, 窗口相应缩短
+    返回 (system 消息, 占用的 token 数, 检索到的消息 id), 没有可用结果时返回 None
+    """
+    config = retrieval.get_config()
+    if not config['ENABLED']:
+        return None
+    limit = int(budget * config['BUDGET_RATIO'])
+    window, _ = fit(rows, budget - limit)
+    hits = retrieval.retrieve(room, user_id, query, exclude=[row[0] for row in window])
+    if not hits:
+        return None
+    found = {row[0]: row for row in Message.objects.filter(id__in=[message_id for message_id, _ in hits])
+             .values_list('id', 'role', 'content', 'tokens')}
+    # 按相关度依次放入, 超出预算的跳过
+    lines = []
+    cost = MESSAGE_OVERHEAD + count_tokens(RECALL_HEADER)
+    for message_id, _ in hits:
+        row = found.get(message_id)
+        if row is None:
+            continue
+        line = f'[{row[1]}] {row[2]}'
+        tokens = count_tokens(line) + 1
+        if cost + tokens > limit:
+            continue
+        cost += tokens
+        lines.append((message_id, line))
+    if not lines:
+        return None
+    # 按时间顺序排列, 便于模型理解
+    content = RECALL_HEADER + '\n'.join(line for _, line in sorted(lines))
+    return {'role': 'system', 'content': content}, cost, {message_id for message_id, _ in lines}
@@ -0,0 +1,240 @@
+import asyncio
+import bisect
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from chat.sse import SSEEncoder, format_event
+
+DEFAULT_GENERATIONS = {
+    'RING_CHARS': 64 * 1024,  # 生成结束后保留最后这么多字符供断线重连回放
+    'TTL': 600,  # 生成结束多久后从内存移除
+    'START_TIMEOUT': 30,  # 没能在事件循环上启动时, 创建后这么久还没人接收就放弃(归还并发名额)
+}
+
+
+def get_config():
+    return {**DEFAULT_GENERATIONS, **getattr(settings, 'CHAT_GENERATIONS', {})}
+
+
+class GenerationExpired(Exception):
+    """请求的偏移量已经不在缓冲区里"""
+
+
+class GenerationFailed(Exception):
+    pass
+
+
+class Generation:
+    """
+    一次模型生成, 作为后台 task 运行, 与客户端连接解耦:
+    客户端断开不会中断上游, 生成完成后由 on_finish 负责保存
+    输出按片段缓冲, 任意数量的订阅者可以从某个字符偏移量开始接收(断线重连、多个标签页)
+    """
+
+    def __init__(self, source, owner, key=None, on_finish=None, ring_chars=None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.key = key
+        self.source = source
+        self.on_finish = on_finish
+        self.ring_chars = ring_chars or get_config()['RING_CHARS']
+        self.parts = []
+        self.starts = []  # 每个片段的起始偏移量, 用于二分查找
+        self.base = 0  # 缓冲区第一个字符的偏移量
+        self.length = 0
+        self.done = False
+        self.error = None
+        self.usage = None
+        self.created_at = time.monotonic()
+        self.finished_at = None
+        self.task = None
+        self._changed = None
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    def ensure_started(self):
+        # 必须在事件循环里调用, 第一个订阅者接入时启动
+        if self.task is None and not self.done:
+            self._changed = asyncio.Event()
+            self.task = asyncio.ensure_future(self.run())
+
+    def start(self, loop=None):
+        """
+        创建后立即启动, 不等客户端开始读响应: 客户端在读之前断开时生成照常完成, on_finish 照常归还并发名额
+        loop 为生成所在的事件循环(同步视图里是 request.event_loop, 见 EventLoopMiddleware),
+        在它的线程里直接启动, 否则交给它; 没有可用的循环时由第一个订阅者启动, 没人接收的由 GenerationRegistry 清理
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not None and loop in (None, running):
+            self.ensure_started()
+        elif loop is not None and loop.is_running():
+            loop.call_soon_threadsafe(self.ensure_started)
+
+    def abandon(self):
+        # 一直没有启动的生成: 不再请求上游, 走一遍 on_finish 归还并发名额
+        if self.task is not None or self.done:
+            return
+        self.done = True
+        self.error = 'abandoned'
+        self.finished_at = time.monotonic()
+        if self.on_finish:
+            try:
+                self.on_finish(self)
+            except Exception as e:
+                print(f'finish generation {self.id} failed: {e}')
+
+    async def run(self):
+        try:
+            async for text in self.source:
+                self.starts.append(self.length)
+                self.parts.append(text)
+                self.length += len(text)
+                self._notify()
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.done = True
+            self.finished_at = time.monotonic()
+            if self.on_finish:
+                try:
+                    self.on_finish(self)
+                except Exception as e:
+                    print(f'finish generation {self.id} failed: {e}')
+            self._trim()
+            self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _trim(self):
+        # 完成后只保留环形缓冲区大小的尾部
+        if self.length - self.base <= self.ring_chars:
+            return
+        tail = self.text[-self.ring_chars:]
+        self.base = self.length - len(tail)
+        self.parts = [tail]
+        self.starts = [self.base]
+
+    def read(self, offset):
+        index = bisect.bisect_right(self.starts, offset) - 1
+        first = self.parts[index][offset - self.starts[index]:]
+        return first + ''.join(self.parts[index + 1:])
+
+    async def subscribe(self, offset=0):
+        self.ensure_started()
+        while True:
+            if offset < self.base:
+                raise GenerationExpired(f'offset {offset} is no longer buffered')
+            if offset < self.length:
+                text = self.read(offset)
+                offset += len(text)
+                yield text
+                continue
+            if self.done:
+                if self.error:
+                    raise GenerationFailed(self.error)
+                return
+            await self._changed.wait()
+
+
+class GenerationRegistry:
+    """进程内的生成表, 多进程部署时重连请求需要落到同一个进程(按用户做粘性路由)"""
+
+    def __init__(self, ttl=None, start_timeout=None):
+        self.ttl = ttl or get_config()['TTL']
+        self.start_timeout = start_timeout or get_config()['START_TIMEOUT']
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def add(self, generation):
+        with self.lock:
+            self._cleanup()
+            self.items[generation.id] = generation
+        return generation
+
+    def get(self, generation_id, owner):
+        generation = self.items.get(generation_id)
+        if generation is None or generation.owner != owner:
+            return None
+        return generation
+
+    def find(self, owner, key, include_done=False):
+        with self.lock:
+            for generation in self.items.values():
+                if generation.owner == owner and generation.key == key and (include_done or not generation.done):
+                    return generation
+        return None
+
+    def _cleanup(self):
+        now = time.monotonic()
+        for generation in self.items.values():
+            if generation.task is None and not generation.done and now - generation.created_at > self.start_timeout:
+                generation.abandon()
+        expired = [
+            generation_id for generation_id, generation in self.items.items()
+            if generation.done and now - generation.finished_at > self.ttl
+        ]
+        for generation_id in expired:
+            del self.items[generation_id]
+
+    def cleanup(self):
+        with self.lock:
+            self._cleanup()
+
+
+_background_loop = None
+_background_lock = threading.Lock()
+
+
+def get_background_loop():
+    """WSGI 下请求没有事件循环: 生成都在这个后台线程的事件循环上运行"""
+    global _background_loop
+    with _background_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name='generations', daemon=True).start()
+        return _background_loop
+
+
+def get_event_loop(request):
+    # ASGI 下为请求所在的事件循环(见 EventLoopMiddleware), WSGI 下为后台事件循环
+    return getattr(request, 'event_loop', None) or get_background_loop()
+
+
+def iterate_sync(frames, loop):
+    """
+    WSGI 的响应体要同步迭代器: 在 loop 上逐个取异步迭代器的元素, 取到一个交出一个
+    StreamingHttpResponse 直接拿异步迭代器时会在 WSGI 下整个读完再发送
+    """
+    async def step():
+        return await frames.__anext__()
+
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(step(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        # 客户端断开时 WSGI 服务器关闭迭代器, 一并停止订阅
+        asyncio.run_coroutine_threadsafe(frames.aclose(), loop).result()
+
+
+async def stream_generation(generation, offset=0):
+    # 先告诉客户端生成 id, 断线后可以用它重新接入
+    yield format_event({'id': generation.id}, event='generation')
+    encoder = SSEEncoder(start_offset=offset)
+    async for frame in encoder.encode(generation.subscribe(offset), lambda: generation.usage):
+        yield frame
+
+
+generations = GenerationRegistry()
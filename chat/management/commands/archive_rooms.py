@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chat.archive import archive_room, get_config, inactive_rooms, restore_room
+from chat.caches import invalidate_rooms
+
+
+class Command(BaseCommand):
+    help = '把长时间不活跃的房间的消息归档到冷存储(gzip 压缩的 NDJSON), 访问时自动恢复; --loop 定时运行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='不活跃多少天后归档, 默认 CHAT_ARCHIVE.INACTIVE_DAYS')
+        parser.add_argument('--limit', type=int, default=None, help='本轮最多归档的房间数')
+        parser.add_argument('--chunk', type=int, default=100, help='每次查询候选房间的数量')
+        parser.add_argument('--sleep', type=float, default=0.05, help='每个房间之间的间隔(秒), 给线上写入让路')
+        parser.add_argument('--dry-run', action='store_true', help='只列出会被归档的房间')
+        parser.add_argument('--loop', type=float, default=None, help='每隔这么多秒运行一轮, 不退出')
+        parser.add_argument('--restore', type=int, nargs='+', default=None, help='恢复指定 id 的房间')
+
+    def handle(self, *args, **options):
+        if options['restore']:
+            for room_id in options['restore']:
+                self.stdout.write(f'room {room_id}: restored {restore_room(room_id)} messages')
+            return
+        while True:
+            self.run_once(options)
+            if options['loop'] is None:
+                return
+            close_old_connections()
+            time.sleep(options['loop'])
+
+    def run_once(self, options):
+        days = options['days'] or get_config()['INACTIVE_DAYS']
+        limit = options['limit']
+        rooms = messages = 0
+        started = time.perf_counter()
+        # inactive_rooms 按 id 键集翻页, 没有消息或归档失败的房间不会被反复选中
+        for room in inactive_rooms(days, chunk=options['chunk']):
+            if limit is not None and rooms >= limit:
+                break
+            if options['dry_run']:
+                self.stdout.write(f'room {room.id} (user {room.user_id})')
+                rooms += 1
+                continue
+            count = archive_room(room)
+            if count:
+                invalidate_rooms(room.user_id)
+                rooms += 1
+                messages += count
+                self.stdout.write(f'room {room.id}: archived {count} messages')
+            time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{"would archive" if options["dry_run"] else "archived"} {rooms} rooms, {messages} messages '
+            f'inactive for {days} days in {time.perf_counter() - started:.1f}s'
+        ))
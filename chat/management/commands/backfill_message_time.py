@@ -0,0 +1,47 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = '把老消息 date_time 字符串回填到 create_time, 按主键区间分批, 每批一个短事务, 不锁全表'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', type=int, default=5000, help='每批处理的主键区间大小')
+        parser.add_argument('--sleep', type=float, default=0.05, help='每批之间的间隔(秒), 给线上写入让路')
+        parser.add_argument('--start', type=int, default=None, help='从这个 id 开始(用于中断后继续)')
+
+    def handle(self, *args, **options):
+        chunk = options['chunk']
+        bounds = Message.objects.filter(create_time__isnull=True).aggregate(lo=Min('id'), hi=Max('id'))
+        if bounds['lo'] is None:
+            self.stdout.write('nothing to backfill')
+            return
+
+        tz = timezone.get_current_timezone()
+        start = options['start'] or bounds['lo']
+        converted = skipped = 0
+        while start <= bounds['hi']:
+            end = start + chunk
+            rows = list(Message.objects.filter(id__gte=start, id__lt=end, create_time__isnull=True)
+                        .only('id', 'date_time'))
+            for row in rows:
+                try:
+                    # date_time 存的是服务器本地时间, 格式 %Y-%m-%d %H:%M:%S
+                    row.create_time = timezone.make_aware(datetime.strptime(row.date_time, '%Y-%m-%d %H:%M:%S'), tz)
+                except (TypeError, ValueError):
+                    skipped += 1
+            rows = [row for row in rows if row.create_time is not None]
+            if rows:
+                Message.objects.bulk_update(rows, ['create_time'])
+            converted += len(rows)
+            self.stdout.write(f'id [{start}, {end}): {len(rows)} rows, total {converted}')
+            start = end
+            time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(f'done: {converted} converted, {skipped} unparseable'))
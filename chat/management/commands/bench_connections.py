@@ -0,0 +1,150 @@
+import asyncio
+import json
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.db import connections
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat import views
+from chat.models import Room
+from chat.providers import FakeProvider
+from chat_ai_service.db import get_pool
+
+BENCH_USER = 'bench-connections'
+
+
+class ConnectionCounter:
+    """统计被请求占用着的数据库连接: 新建(或从池里借出)时加一, 关闭(或还回池里)时减一"""
+
+    def __init__(self, wrapper_class):
+        self.wrapper_class = wrapper_class
+        self.lock = threading.Lock()
+        self.open = 0
+        self.peak = 0
+        self.opened = 0
+
+    def __enter__(self):
+        get_new_connection = self.wrapper_class.get_new_connection
+        close = self.wrapper_class._close
+        counter = self
+
+        def counted_get_new_connection(wrapper, conn_params):
+            conn = get_new_connection(wrapper, conn_params)
+            with counter.lock:
+                counter.open += 1
+                counter.opened += 1
+                counter.peak = max(counter.peak, counter.open)
+            return conn
+
+        def counted_close(wrapper):
+            if wrapper.connection is not None:
+                with counter.lock:
+                    counter.open -= 1
+            return close(wrapper)
+
+        self.patches = [
+            mock.patch.object(self.wrapper_class, 'get_new_connection', counted_get_new_connection),
+            mock.patch.object(self.wrapper_class, '_close', counted_close),
+        ]
+        for patch in self.patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *exc):
+        for patch in reversed(self.patches):
+            patch.stop()
+
+
+class Command(BaseCommand):
+    help = '压测: 并发流式会话占用的数据库连接数, 经过完整的 ASGI 请求处理(使用 FakeProvider, 不落库)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--streams', type=int, default=50, help='并发流数量')
+        parser.add_argument('--tokens', type=int, default=40, help='每个流的 token 数')
+        parser.add_argument('--delay', type=float, default=0.05, help='每个 token 的间隔(秒)')
+        parser.add_argument('--no-release', action='store_true', help='不在流开始前释放连接, 作为对比')
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(username=BENCH_USER)
+        room = Room.objects.create(user=user, name='bench')
+        token = str(AccessToken.for_user(user))
+        provider = FakeProvider('bench', delay=options['delay'], prefix='', max_concurrency=options['streams'],
+                                max_queue=options['streams'])
+        connections.close_all()
+        try:
+            with ConnectionCounter(type(connections['default'])) as counter, \
+                    mock.patch.object(views, 'get_provider_for_model', lambda model: provider), \
+                    mock.patch.object(views.ChatView, 'throttle_classes', []), \
+                    mock.patch.object(views.ChatView, 'save_message', lambda *args: None), \
+                    mock.patch.object(views, 'release_connections',
+                                      (lambda: None) if options['no_release'] else views.release_connections):
+                elapsed, completed, during = asyncio.run(self.run(room.id, token, counter, options))
+        finally:
+            room.delete()
+            user.delete()
+
+        self.stdout.write(f'streams:             {options["streams"]}')
+        self.stdout.write(f'completed:           {completed}')
+        self.stdout.write(f'wall time:           {elapsed:.2f}s')
+        self.stdout.write(f'connections opened:  {counter.opened}')
+        self.stdout.write(f'held mid-stream:     {during} (peak {counter.peak})')
+        self.stdout.write(f'per stream:          {during / options["streams"]:.2f}')
+        pool = get_pool('default')
+        if pool is not None:
+            self.stdout.write(f'pool:                {pool.stats()}')
+
+    async def run(self, room_id, token, counter, options):
+        application = get_asgi_application()
+        prompt = ' '.join(f'tok{i}' for i in range(options['tokens']))
+        body = json.dumps({'content': prompt, 'room': room_id}).encode()
+        started = asyncio.Event()
+        first_chunks = 0
+        during = None
+
+        async def request():
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+                'scheme': 'http', 'path': '/chat/index', 'raw_path': b'/chat/index', 'root_path': '',
+                'query_string': b'model=bench', 'server': ('bench', 80), 'client': ('127.0.0.1', 0),
+                'headers': [(b'content-type', b'application/json'), (b'authorization', f'Bearer {token}'.encode())],
+            }
+            received = False
+            chunks = []
+
+            async def receive():
+                nonlocal received
+                if not received:
+                    received = True
+                    return {'type': 'http.request', 'body': body, 'more_body': False}
+                # 客户端不断开, 直到响应结束被取消
+                await asyncio.Event().wait()
+
+            async def send(message):
+                nonlocal first_chunks
+                if message['type'] == 'http.response.body' and message.get('body'):
+                    if not chunks:
+                        first_chunks += 1
+                        if first_chunks == options['streams']:
+                            started.set()
+                    chunks.append(message['body'])
+
+            await application(scope, receive, send)
+            return b''.join(chunks)
+
+        async def sample():
+            # 所有流都开始输出后, 统计此时仍被占用的连接
+            nonlocal during
+            await started.wait()
+            await asyncio.sleep(options['delay'] * options['tokens'] / 4)
+            during = counter.open
+
+        start = time.perf_counter()
+        results, _ = await asyncio.gather(asyncio.gather(*(request() for _ in range(options['streams']))), sample())
+        elapsed = time.perf_counter() - start
+        completed = sum(1 for result in results if b'event: done' in result)
+        return elapsed, completed, during
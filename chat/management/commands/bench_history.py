@@ -0,0 +1,64 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chat.context import build_context
+from chat.models import Room, Message
+
+
+class Command(BaseCommand):
+    help = '历史消息查询的延迟基准, --rows 10000000 即可在千万级表上测试'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help='消息表的目标行数, 不足时自动补数据')
+        parser.add_argument('--rooms', type=int, default=1000, help='补数据时使用的房间数')
+        parser.add_argument('--queries', type=int, default=500, help='每种查询执行的次数')
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(username='bench-history')
+        rooms = self.ensure_rooms(user, options['rooms'])
+        self.ensure_rows(user, rooms, options['rows'])
+        self.stdout.write(f'{connection.vendor}: {Message.objects.count()} messages')
+
+        queries = {
+            # ChatView 组装上下文
+            'context': lambda room: build_context(room, 'gpt-4o'),
+            # MessageView ?room=X 的最新一页
+            'history page': lambda room: list(Message.objects.filter(user=user, room=room).order_by('-id')[:50]),
+            # 按时间范围取历史
+            'time range': lambda room: list(Message.objects.filter(room=room).order_by('-create_time')[:50]),
+        }
+        for name, query in queries.items():
+            samples = []
+            for _ in range(options['queries']):
+                room = random.choice(rooms)
+                start = time.perf_counter()
+                query(room)
+                samples.append((time.perf_counter() - start) * 1000)
+            samples.sort()
+            self.stdout.write(f'{name:<14} p50 {statistics.median(samples):.2f}ms  '
+                              f'p95 {samples[int(len(samples) * 0.95)]:.2f}ms  max {samples[-1]:.2f}ms')
+
+    def ensure_rooms(self, user, count):
+        existing = list(Room.objects.filter(user=user).values_list('id', flat=True))
+        if len(existing) < count:
+            Room.objects.bulk_create(Room(user=user, name=f'bench-{i}') for i in range(count - len(existing)))
+            existing = list(Room.objects.filter(user=user).values_list('id', flat=True))
+        return existing
+
+    def ensure_rows(self, user, rooms, rows):
+        missing = rows - Message.objects.count()
+        batch = 10000
+        while missing > 0:
+            size = min(batch, missing)
+            Message.objects.bulk_create(
+                Message(room_id=random.choice(rooms), user=user, role=random.choice(['user', 'assistant']),
+                        content='benchmark message ' * 8, model='gpt-4o', date_time='', tokens=40)
+                for _ in range(size)
+            )
+            missing -= size
+            self.stdout.write(f'inserted, {missing} to go')
@@ -0,0 +1,53 @@
+import statistics
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.response import Response
+
+from chat.models import Room, Message
+from chat.serializers import RoomSerializer, MessageSerializer
+from chat_ai_service.renderer import FastPublicRenderer, PublicRenderer, orjson
+
+
+class Command(BaseCommand):
+    help = '对比 PublicRenderer 和 FastPublicRenderer 渲染大列表的耗时(不访问数据库)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='列表长度')
+        parser.add_argument('--repeat', type=int, default=20, help='每个渲染器重复次数')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        now = timezone.now()
+        user = User(id=1, username='bench')
+        rooms = [Room(id=i, user=user, name=f'会话 {i}', create_time=now - timedelta(minutes=i)) for i in range(rows)]
+        messages = [
+            Message(id=i, room=rooms[0], user=user, role='assistant', model='gpt-4o', tokens=120,
+                    content='这是一条用于压测渲染的消息, with some ascii text as well. ' * 4,
+                    date_time='2024-08-29 12:00:00', create_time=now)
+            for i in range(rows)
+        ]
+        payloads = {
+            'rooms': RoomSerializer(rooms, many=True).data,
+            'messages': MessageSerializer(messages, many=True).data,
+        }
+
+        self.stdout.write(f'orjson: {"available" if orjson else "missing (fallback to stdlib)"}')
+        for name, data in payloads.items():
+            results = {}
+            for renderer_class in (PublicRenderer, FastPublicRenderer):
+                renderer = renderer_class()
+                context = {'response': Response(status=200), 'request': None}
+                samples = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    body = renderer.render(data, 'application/json', context)
+                    samples.append((time.perf_counter() - start) * 1000)
+                results[renderer_class.__name__] = (statistics.median(samples), len(body))
+            base = results['PublicRenderer'][0]
+            for renderer_name, (median, size) in results.items():
+                self.stdout.write(f'{name:<9}{renderer_name:<20} {median:8.2f}ms  {size / 1024:8.0f}KB  '
+                                  f'x{base / median:.1f}')
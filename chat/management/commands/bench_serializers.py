@@ -0,0 +1,55 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from chat.models import Room, Message
+from chat.serializers import MessageSerializer, MessageReadSerializer
+
+
+class Command(BaseCommand):
+    help = '对比 MessageSerializer 与 MessageReadSerializer 在大房间上的列表序列化耗时(含查询)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10000, help='房间里的消息数')
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(username='bench-serializers')
+        room, _ = Room.objects.get_or_create(user=user, name='bench-serializers')
+        missing = options['messages'] - Message.objects.filter(room=room).count()
+        if missing > 0:
+            Message.objects.bulk_create(
+                (Message(room=room, user=user, role='assistant', model='gpt-4o', tokens=60,
+                         content='benchmark message content ' * 10, date_time='2024-08-29 12:00:00')
+                 for _ in range(missing)),
+                batch_size=2000,
+            )
+        queryset = Message.objects.filter(room=room).order_by('-id')[:options['messages']]
+
+        def model_serializer():
+            return MessageSerializer(queryset, many=True).data
+
+        def read_serializer():
+            serializer = MessageReadSerializer()
+            return serializer.to_representation(serializer.values(queryset))
+
+        def read_serializer_subset():
+            serializer = MessageReadSerializer('id,role,content')
+            return serializer.to_representation(serializer.values(queryset))
+
+        results = {}
+        for name, func in [('ModelSerializer', model_serializer), ('ReadSerializer', read_serializer),
+                           ('ReadSerializer 3 fields', read_serializer_subset)]:
+            samples = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                func()
+                samples.append((time.perf_counter() - start) * 1000)
+            results[name] = statistics.median(samples)
+
+        base = results['ModelSerializer']
+        self.stdout.write(f'{options["messages"]} messages')
+        for name, median in results.items():
+            self.stdout.write(f'{name:<24} {median:8.2f}ms  x{base / median:.1f}')
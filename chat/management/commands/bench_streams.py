@@ -0,0 +1,99 @@
+import asyncio
+import json
+import threading
+import time
+
+import httpx
+from django.core.management.base import BaseCommand
+
+from chat import views
+from chat.generations import stream_generation
+from chat.metrics import metrics
+from chat.providers import FakeProvider, OpenAIProvider
+
+
+def fake_upstream(tokens, delay):
+    # 本地假上游: 按 OpenAI 的 SSE 格式逐个吐出 token, 每个 token 之间 sleep 模拟生成耗时
+    async def body():
+        for i in range(tokens):
+            await asyncio.sleep(delay)
+            chunk = {
+                'id': 'chatcmpl-bench',
+                'object': 'chat.completion.chunk',
+                'created': 0,
+                'model': 'bench',
+                'choices': [{'index': 0, 'delta': {'content': f'tok{i} '}, 'finish_reason': None}],
+            }
+            yield f'data: {json.dumps(chunk)}\n\n'.encode()
+        yield b'data: [DONE]\n\n'
+
+    async def handler(request):
+        return httpx.Response(200, headers={'content-type': 'text/event-stream'}, content=body())
+
+    return httpx.MockTransport(handler)
+
+
+class Command(BaseCommand):
+    help = '压测: 单进程内并发流式会话数 (使用本地假上游, 不访问数据库)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--streams', type=int, default=500, help='并发流数量')
+        parser.add_argument('--tokens', type=int, default=50, help='每个流的 token 数')
+        parser.add_argument('--delay', type=float, default=0.05, help='上游每个 token 的间隔(秒)')
+        parser.add_argument('--fake', action='store_true', help='使用 FakeProvider, 不经过 OpenAI SDK')
+        parser.add_argument('--concurrency', type=int, default=10000, help='provider 的并发上限')
+
+    def handle(self, *args, **options):
+        if options['fake']:
+            provider = FakeProvider('bench', delay=options['delay'], prefix='',
+                                    max_concurrency=options['concurrency'], max_queue=options['streams'])
+        else:
+            # 走完整的 OpenAI SDK + httpx 连接池, 只是上游换成本地假服务
+            provider = OpenAIProvider('bench', api_key='bench', base_url='http://upstream.local/v1',
+                                      transport=fake_upstream(options['tokens'], options['delay']),
+                                      max_concurrency=options['concurrency'], max_queue=options['streams'])
+        asyncio.run(self.run(provider, options['streams'], options['tokens'], options['delay']))
+
+    async def run(self, provider, streams, tokens, delay):
+
+        view = views.ChatView()
+        # 压测只关心流本身, 不落库
+        view.save_message = lambda *args: None
+
+        active = 0
+        peak = 0
+
+        async def consume():
+            nonlocal active, peak
+            frames = []
+            prompt = ' '.join(f'tok{i}' for i in range(tokens))
+            messages = [{'role': 'user', 'content': prompt}]
+            generation = view.start_generation(provider, messages, prompt, None, None, None, 'bench')
+            async for frame in stream_generation(generation):
+                if not frames:
+                    active += 1
+                    peak = max(peak, active)
+                frames.append(frame)
+            active -= 1
+            return frames
+
+        threads_before = threading.active_count()
+        start = time.perf_counter()
+        results = await asyncio.gather(*(consume() for _ in range(streams)))
+        elapsed = time.perf_counter() - start
+
+        ideal = tokens * delay
+        self.stdout.write(f'streams:           {streams}')
+        completed = sum(1 for frames in results if frames and b'event: done' in frames[-1])
+        self.stdout.write(f'completed:         {completed}')
+        self.stdout.write(f'peak concurrent:   {peak}')
+        self.stdout.write(f'wall time:         {elapsed:.2f}s (single stream ideal {ideal:.2f}s)')
+        self.stdout.write(f'tokens/sec:        {streams * tokens / elapsed:.0f}')
+        self.stdout.write(f'frames/stream:     {sum(map(len, results)) / streams:.1f} (upstream tokens {tokens})')
+        self.stdout.write(f'threads:           {threads_before} -> {threading.active_count()}')
+        stats = metrics.totals.get('bench')
+        if stats:
+            self.stdout.write(f'avg ttft:          {stats["ttft_ms"] / stats["requests"]:.0f}ms '
+                              f'(max {stats["ttft_ms_max"]}ms)')
+        # 压测的统计不落库
+        metrics.pending.clear()
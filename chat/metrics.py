@@ -0,0 +1,237 @@
+import atexit
+import bisect
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from rest_framework.permissions import BasePermission
+
+DEFAULT_METRICS = {
+    'FLUSH_INTERVAL': 30,  # 内存里的聚合多久写一次 CompletionStat(秒)
+    'TOKEN': None,  # 抓取 /chat/metrics 时放在 X-Metrics-Token 请求头里, 不配置则只有管理员能访问
+    'BUCKETS': (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120),  # 首字延迟和生成耗时直方图的边界(秒)
+}
+
+COUNTERS = ('requests', 'errors', 'cached', 'chunks', 'prompt_tokens', 'completion_tokens', 'ttft_ms', 'duration_ms')
+
+
+def _new_row():
+    return {**dict.fromkeys(COUNTERS, 0), 'ttft_ms_max': 0}
+
+
+def get_config():
+    return {**DEFAULT_METRICS, **getattr(settings, 'CHAT_METRICS', {})}
+
+
+class CompletionTrace:
+    """包在生成的数据源外面, 记录开始时间、首字时间和片段数; usage 交给 provider 填写上游报告的用量"""
+
+    def __init__(self, model, user_id, cached=False):
+        self.model = model
+        self.user_id = user_id
+        self.cached = cached
+        self.usage = {}
+        self.started = None
+        self.first = None
+        self.finished = None
+        self.chunks = 0
+
+    async def wrap(self, source):
+        self.started = time.monotonic()
+        try:
+            async for text in source:
+                if self.first is None:
+                    self.first = time.monotonic()
+                self.chunks += 1
+                yield text
+        finally:
+            self.finished = time.monotonic()
+
+    @property
+    def ttft(self):
+        return self.first - self.started if self.first is not None else None
+
+    @property
+    def duration(self):
+        return self.finished - self.started if self.finished is not None else 0
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class MetricsRecorder:
+    """
+    生成的用量和延迟统计:
+    - 按 (用户, 模型, 小时) 在内存里累加, 后台线程每 FLUSH_INTERVAL 秒用 UPDATE ... SET x = x + n 写入 CompletionStat
+    - 进程启动以来按模型的计数和直方图, 以 Prometheus 文本格式输出(每个进程单独抓取)
+    """
+
+    def __init__(self, config=None):
+        self.config = config or get_config()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.totals = {}
+        self.ttft = {}
+        self.duration = {}
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, name='completion-metrics', daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def record(self, trace, usage, error=False):
+        ttft = trace.ttft
+        values = {
+            'requests': 1,
+            'errors': int(bool(error)),
+            'cached': int(trace.cached),
+            'chunks': trace.chunks,
+            'prompt_tokens': usage.get('prompt_tokens') or 0,
+            'completion_tokens': usage.get('completion_tokens') or 0,
+            'ttft_ms': round(ttft * 1000) if ttft is not None else 0,
+            'duration_ms': round(trace.duration * 1000),
+        }
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        buckets = self.config['BUCKETS']
+        self.start()
+        with self.lock:
+            for target, key in ((self.pending, (trace.user_id, trace.model, hour)), (self.totals, trace.model)):
+                row = target.setdefault(key, _new_row())
+                for name, value in values.items():
+                    row[name] += value
+                row['ttft_ms_max'] = max(row['ttft_ms_max'], values['ttft_ms'])
+            if ttft is not None:
+                self.ttft.setdefault(trace.model, Histogram(buckets)).observe(ttft)
+            self.duration.setdefault(trace.model, Histogram(buckets)).observe(trace.duration)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        close_old_connections()
+        failed = {}
+        for key, row in pending.items():
+            try:
+                self._save(key, row)
+            except Exception as e:
+                print(f'save completion stats failed: {e}')
+                failed[key] = row
+        if failed:
+            # 数据库不可用时放回去, 下次一起写
+            with self.lock:
+                for key, row in failed.items():
+                    current = self.pending.setdefault(key, _new_row())
+                    for name in COUNTERS:
+                        current[name] += row[name]
+                    current['ttft_ms_max'] = max(current['ttft_ms_max'], row['ttft_ms_max'])
+
+    def _save(self, key, row):
+        from chat.models import CompletionStat
+        user_id, model, hour = key
+        stats = CompletionStat.objects.filter(user_id=user_id, model=model, hour=hour)
+        increments = {name: F(name) + row[name] for name in COUNTERS}
+        increments['ttft_ms_max'] = Greatest(F('ttft_ms_max'), row['ttft_ms_max'])
+        if stats.update(**increments):
+            return
+        try:
+            with transaction.atomic():
+                CompletionStat.objects.create(user_id=user_id, model=model, hour=hour, **row)
+        except IntegrityError:
+            # 别的进程刚插入了这一行
+            stats.update(**increments)
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.config['FLUSH_INTERVAL']):
+            self.flush()
+
+    def render(self):
+        from chat.persistence import turn_writer
+        from chat.providers import _providers
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{name}{labels} {value}' for labels, value in samples)
+
+        def histogram(name, help_text, histograms):
+            samples = []
+            for model, hist in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip([*hist.buckets, '+Inf'], hist.counts):
+                    cumulative += count
+                    samples.append((f'_bucket{_labels(model=model, le=bound)}', cumulative))
+                samples.append((f'_sum{_labels(model=model)}', round(hist.sum, 6)))
+                samples.append((f'_count{_labels(model=model)}', hist.count))
+            metric(name, 'histogram', help_text, samples)
+
+        with self.lock:
+            totals = sorted(self.totals.items())
+            metric('chat_completions_total', 'counter', '生成次数', [
+                (_labels(model=model, status=status), count)
+                for model, row in totals
+                for status, count in (('ok', row['requests'] - row['errors']), ('error', row['errors']))
+            ])
+            metric('chat_completions_cached_total', 'counter', '命中回复缓存的生成次数',
+                   [(_labels(model=model), row['cached']) for model, row in totals])
+            metric('chat_completion_chunks_total', 'counter', '上游片段数',
+                   [(_labels(model=model), row['chunks']) for model, row in totals])
+            metric('chat_completion_tokens_total', 'counter', 'token 用量', [
+                (_labels(model=model, type=kind), row[f'{kind}_tokens'])
+                for model, row in totals for kind in ('prompt', 'completion')
+            ])
+            histogram('chat_completion_ttft_seconds', '首字延迟', self.ttft)
+            histogram('chat_completion_duration_seconds', '生成耗时', self.duration)
+
+        metric('chat_provider_active', 'gauge', '正在进行的上游请求',
+               [(_labels(provider=name), provider.active) for name, provider in sorted(_providers.items())])
+        metric('chat_provider_waiting', 'gauge', '排队等待的上游请求',
+               [(_labels(provider=name), provider.waiting) for name, provider in sorted(_providers.items())])
+        metric('chat_write_queue_depth', 'gauge', '等待写库的对话轮数', [('', turn_writer.queue.qsize())])
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsPermission(BasePermission):
+    """管理员, 或者带着配置的 X-Metrics-Token(给 Prometheus 抓取用)"""
+
+    def has_permission(self, request, view):
+        token = get_config()['TOKEN']
+        if token and request.headers.get('X-Metrics-Token') == token:
+            return True
+        return bool(request.user and request.user.is_staff)
+
+
+metrics = MetricsRecorder()
@@ -0,0 +1,20 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0005_remove_room_active"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="tokens",
+            field=models.PositiveIntegerField(
+                default=0, help_text="内容的 token 数, 保存时计算"
+            ),
+        ),
+    ]
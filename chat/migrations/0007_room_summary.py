@@ -0,0 +1,32 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0006_message_tokens"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="room",
+            name="summary",
+            field=models.TextField(
+                blank=True, default="", help_text="早期消息的滚动摘要"
+            ),
+        ),
+        migrations.AddField(
+            model_name="room",
+            name="summary_tokens",
+            field=models.PositiveIntegerField(default=0, help_text="摘要的 token 数"),
+        ),
+        migrations.AddField(
+            model_name="room",
+            name="summary_until",
+            field=models.BigIntegerField(
+                default=0, help_text="已摘要到的最后一条消息id"
+            ),
+        ),
+    ]
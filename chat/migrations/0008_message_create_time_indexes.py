@@ -0,0 +1,45 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:14
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0007_room_summary"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # 先不带默认值加列, 老数据保持 NULL, 由 backfill_message_time 命令分批回填
+        migrations.AddField(
+            model_name="message",
+            name="create_time",
+            field=models.DateTimeField(db_index=True, help_text="创建时间", null=True),
+        ),
+        # 默认值只在 Python 侧生效, 不需要改表
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name="message",
+                    name="create_time",
+                    field=models.DateTimeField(
+                        db_index=True,
+                        default=django.utils.timezone.now,
+                        help_text="创建时间",
+                        null=True,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(fields=["room", "id"], name="chat_msg_room_id_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(fields=["user", "room"], name="chat_msg_user_room_idx"),
+        ),
+    ]
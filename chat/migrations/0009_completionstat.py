@@ -0,0 +1,92 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0008_message_create_time_indexes"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CompletionStat",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("model", models.CharField(help_text="模型", max_length=100)),
+                ("hour", models.DateTimeField(help_text="统计的小时(整点)")),
+                (
+                    "requests",
+                    models.PositiveIntegerField(default=0, help_text="生成次数"),
+                ),
+                (
+                    "errors",
+                    models.PositiveIntegerField(default=0, help_text="失败次数"),
+                ),
+                (
+                    "cached",
+                    models.PositiveIntegerField(
+                        default=0, help_text="命中回复缓存的次数"
+                    ),
+                ),
+                (
+                    "chunks",
+                    models.PositiveBigIntegerField(default=0, help_text="上游片段数"),
+                ),
+                ("prompt_tokens", models.PositiveBigIntegerField(default=0)),
+                ("completion_tokens", models.PositiveBigIntegerField(default=0)),
+                (
+                    "ttft_ms",
+                    models.PositiveBigIntegerField(
+                        default=0, help_text="首字延迟之和(毫秒)"
+                    ),
+                ),
+                (
+                    "ttft_ms_max",
+                    models.PositiveIntegerField(
+                        default=0, help_text="最大首字延迟(毫秒)"
+                    ),
+                ),
+                (
+                    "duration_ms",
+                    models.PositiveBigIntegerField(
+                        default=0, help_text="生成耗时之和(毫秒)"
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        help_text="用户id",
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["hour", "model"], name="chat_stat_hour_model_idx"
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="completionstat",
+            constraint=models.UniqueConstraint(
+                fields=("user", "model", "hour"), name="chat_stat_user_model_hour"
+            ),
+        ),
+    ]
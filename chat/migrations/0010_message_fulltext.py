@@ -0,0 +1,77 @@
+from django.db import migrations
+
+FTS_TABLE = "chat_message_fts"
+MYSQL_INDEX = "chat_msg_content_ft"
+
+SQLITE_FORWARD = [
+    # 外部内容表: 只存索引, 内容仍在 chat_message 里
+    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+    f"content, content='chat_message', content_rowid='id', tokenize='trigram')",
+    f"CREATE TRIGGER {FTS_TABLE}_ai AFTER INSERT ON chat_message BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content); END",
+    f"CREATE TRIGGER {FTS_TABLE}_ad AFTER DELETE ON chat_message BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content); END",
+    f"CREATE TRIGGER {FTS_TABLE}_au AFTER UPDATE OF content ON chat_message BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content); "
+    f"INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content); END",
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ai",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_au",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+
+def create_fulltext(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "mysql":
+        # 注意这不是在线操作: 表上第一个 FULLTEXT 索引需要加隐藏的 FTS_DOC_ID 列并重建整张表,
+        # 期间为 LOCK=SHARED, chat_message 只能读不能写, 耗时与表大小成正比
+        # 大表上线的做法: 停写的维护窗口里执行本迁移; 或者先用 pt-online-schema-change 等
+        # 在线改表工具建好同名索引, 再执行迁移(索引已存在时跳过)
+        # 之后的写入由 MySQL 增量维护; ngram 分词支持中文
+        with schema_editor.connection.cursor() as cursor:
+            constraints = schema_editor.connection.introspection.get_constraints(
+                cursor, "chat_message"
+            )
+        if MYSQL_INDEX in constraints:
+            return
+        schema_editor.execute(
+            f"ALTER TABLE chat_message ADD FULLTEXT INDEX {MYSQL_INDEX} (content) "
+            "WITH PARSER ngram, ALGORITHM=INPLACE, LOCK=SHARED"
+        )
+    elif vendor == "sqlite":
+        # 需要 SQLite 3.34+ 的 trigram 分词; 不支持时跳过, 搜索退回 LIKE
+        try:
+            with schema_editor.connection.cursor() as cursor:
+                cursor.execute(
+                    "CREATE VIRTUAL TABLE temp.fts_probe USING fts5(x, tokenize='trigram')"
+                )
+                cursor.execute("DROP TABLE temp.fts_probe")
+        except Exception:
+            return
+        for sql in SQLITE_FORWARD:
+            schema_editor.execute(sql)
+
+
+def drop_fulltext(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "mysql":
+        schema_editor.execute(f"ALTER TABLE chat_message DROP INDEX {MYSQL_INDEX}")
+    elif vendor == "sqlite":
+        for sql in SQLITE_BACKWARD:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0009_completionstat"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext, drop_fulltext),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:34
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0010_message_fulltext"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MessageEmbedding",
+            fields=[
+                (
+                    "message",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="embedding",
+                        serialize=False,
+                        to="chat.message",
+                    ),
+                ),
+                (
+                    "embedder",
+                    models.CharField(
+                        help_text="生成向量的模型, 换模型后重新计算", max_length=100
+                    ),
+                ),
+                ("vector", models.BinaryField(help_text="float16 向量")),
+                (
+                    "room",
+                    models.ForeignKey(
+                        db_index=False,
+                        help_text="冗余, 按房间加载向量",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="chat.room",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        db_index=False,
+                        help_text="冗余, 按用户加载向量",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["room", "message"], name="chat_emb_room_msg_idx"
+                    ),
+                    models.Index(
+                        fields=["user", "message"], name="chat_emb_user_msg_idx"
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0011_messageembedding"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="room",
+            name="archived_at",
+            field=models.DateTimeField(
+                blank=True, help_text="归档时间, 非空时消息在冷存储里", null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="room",
+            name="archived_messages",
+            field=models.PositiveIntegerField(
+                default=0, help_text="归档的消息数, 恢复时校验"
+            ),
+        ),
+        migrations.AddField(
+            model_name="room",
+            name="restored_at",
+            field=models.DateTimeField(
+                blank=True, help_text="上次从归档恢复的时间", null=True
+            ),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.0.3 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0012_room_archive"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="room",
+            name="archived_first_id",
+            field=models.BigIntegerField(
+                default=0, help_text="归档的第一条消息 id, 按消息 id 访问时找房间"
+            ),
+        ),
+        migrations.AddField(
+            model_name="room",
+            name="archived_last_id",
+            field=models.BigIntegerField(default=0, help_text="归档的最后一条消息 id"),
+        ),
+    ]
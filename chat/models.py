@@ -1,5 +1,8 @@
-from django.db import models
+from django.db import connection, models
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+from chat.tokens import count_tokens
 
 
 # Create your models here.
@@ -8,10 +11,28 @@ class Room(models.Model):
     name = models.CharField(max_length=100, help_text='会话名字')
     checked = models.BooleanField(default=False, help_text='是否选中')
     create_time = models.DateTimeField(auto_now_add=True)
+    summary = models.TextField(blank=True, default='', help_text='早期消息的滚动摘要')
+    summary_until = models.BigIntegerField(default=0, help_text='已摘要到的最后一条消息id')
+    summary_tokens = models.PositiveIntegerField(default=0, help_text='摘要的 token 数')
+    archived_at = models.DateTimeField(null=True, blank=True, help_text='归档时间, 非空时消息在冷存储里')
+    archived_messages = models.PositiveIntegerField(default=0, help_text='归档的消息数, 恢复时校验')
+    archived_first_id = models.BigIntegerField(default=0, help_text='归档的第一条消息 id, 按消息 id 访问时找房间')
+    archived_last_id = models.BigIntegerField(default=0, help_text='归档的最后一条消息 id')
+    restored_at = models.DateTimeField(null=True, blank=True, help_text='上次从归档恢复的时间')
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def bulk_create_for_user(cls, user, rooms):
+        # 调用方要用返回的 id; MySQL 的 bulk_create 拿不到自增 id, 按 id 倒序去查会和并发的创建串行,
+        # 所以逐行插入(调用方在事务里, 只多几次往返), 每行的 id 由数据库直接返回
+        if connection.features.can_return_rows_from_bulk_insert:
+            return cls.objects.bulk_create(rooms)
+        for room in rooms:
+            room.save(force_insert=True)
+        return rooms
+
 
 class Message(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, help_text='会话id')
@@ -20,6 +41,87 @@ class Message(models.Model):
     role = models.CharField(max_length=100, help_text='角色')
     model = models.CharField(max_length=100, help_text='模型')
     date_time = models.CharField(max_length=100, help_text='时间')
+    create_time = models.DateTimeField(null=True, default=timezone.now, db_index=True, help_text='创建时间')
+    tokens = models.PositiveIntegerField(default=0, help_text='内容的 token 数, 保存时计算')
+
+    class Meta:
+        indexes = [
+            # 按房间取历史: WHERE room_id = ? ORDER BY id
+            models.Index(fields=['room', 'id'], name='chat_msg_room_id_idx'),
+            # MessageView 的过滤: WHERE user_id = ? AND room_id = ?
+            models.Index(fields=['user', 'room'], name='chat_msg_user_room_idx'),
+        ]
 
     def __str__(self):
         return self.content
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 记下读出来时的内容, 保存时据此判断 token 数是否需要重算
+        if 'content' in instance.__dict__ and 'model' in instance.__dict__:
+            instance._loaded_tokens_key = (instance.content, instance.model)
+        return instance
+
+    def _tokens_stale(self, update_fields=None):
+        if not self.tokens:
+            return True
+        if update_fields is not None:
+            return bool({'content', 'model'} & set(update_fields))
+        # 新建时可以带上算好的 token 数; 没读出来(deferred)的内容不会被这次保存改动
+        if self._state.adding or {'content', 'model'} & self.get_deferred_fields():
+            return False
+        return getattr(self, '_loaded_tokens_key', None) != (self.content, self.model)
+
+    def save(self, *args, **kwargs):
+        # token 数在写入时算好, 组装上下文时直接读; 内容或模型改了要重算
+        update_fields = kwargs.get('update_fields')
+        if self._tokens_stale(update_fields):
+            self.tokens = count_tokens(self.content, self.model)
+            if update_fields is not None and 'tokens' not in update_fields:
+                kwargs['update_fields'] = [*update_fields, 'tokens']
+        super().save(*args, **kwargs)
+        if not {'content', 'model'} & self.get_deferred_fields():
+            self._loaded_tokens_key = (self.content, self.model)
+
+
+class CompletionStat(models.Model):
+    """每个用户每个模型每小时的生成统计, 由 chat.metrics 在内存里聚合后定期累加写入"""
+    user = models.ForeignKey(User, null=True, on_delete=models.CASCADE, help_text='用户id')
+    model = models.CharField(max_length=100, help_text='模型')
+    hour = models.DateTimeField(help_text='统计的小时(整点)')
+    requests = models.PositiveIntegerField(default=0, help_text='生成次数')
+    errors = models.PositiveIntegerField(default=0, help_text='失败次数')
+    cached = models.PositiveIntegerField(default=0, help_text='命中回复缓存的次数')
+    chunks = models.PositiveBigIntegerField(default=0, help_text='上游片段数')
+    prompt_tokens = models.PositiveBigIntegerField(default=0)
+    completion_tokens = models.PositiveBigIntegerField(default=0)
+    ttft_ms = models.PositiveBigIntegerField(default=0, help_text='首字延迟之和(毫秒)')
+    ttft_ms_max = models.PositiveIntegerField(default=0, help_text='最大首字延迟(毫秒)')
+    duration_ms = models.PositiveBigIntegerField(default=0, help_text='生成耗时之和(毫秒)')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'model', 'hour'], name='chat_stat_user_model_hour'),
+        ]
+        indexes = [
+            models.Index(fields=['hour', 'model'], name='chat_stat_hour_model_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} {self.model} {self.hour}'
+
+
+class MessageEmbedding(models.Model):
+    """消息的向量, float16 紧凑存储, 由 chat.retrieval 在消息写入后异步计算"""
+    message = models.OneToOneField(Message, primary_key=True, on_delete=models.CASCADE, related_name='embedding')
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, db_index=False, help_text='冗余, 按房间加载向量')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False, help_text='冗余, 按用户加载向量')
+    embedder = models.CharField(max_length=100, help_text='生成向量的模型, 换模型后重新计算')
+    vector = models.BinaryField(help_text='float16 向量')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'message'], name='chat_emb_room_msg_idx'),
+            models.Index(fields=['user', 'message'], name='chat_emb_user_msg_idx'),
+        ]
@@ -0,0 +1,213 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections
+
+from chat.models import Message
+from chat.retrieval import schedule_embedding
+from chat.summary import schedule_summary
+from chat.tokens import count_tokens
+from chat_ai_service.routers import pin_primary
+
+DEFAULT_WRITE_BEHIND = {
+    'BATCH_SIZE': 200,  # 单次 bulk_create 的最大行数
+    'FLUSH_INTERVAL': 0.5,  # 攒批最长等待时间(秒)
+    'MAX_QUEUE': 10000,  # 队列满了直接落到 SPILL_PATH, 由写入线程稍后重放
+    'RETRIES': 3,
+    'SPILL_PATH': None,  # 数据库不可用时未写入的消息落到这个 jsonl 文件, 下次启动时重放
+    'OVERFLOW_WORKERS': 2,  # 没有 SPILL_PATH 时, 队列满了由这么多个线程直接写库
+}
+
+_STOP = object()
+
+
+def get_config():
+    return {**DEFAULT_WRITE_BEHIND, **getattr(settings, 'CHAT_WRITE_BEHIND', {})}
+
+
+class TurnWriter:
+    """
+    消息的异步批量写入: 流结束时只把一轮对话放进内存队列, 由后台线程攒批后 bulk_create
+    进程正常退出时(atexit)会把队列写完, 写不进数据库的落盘到 SPILL_PATH, 写入线程启动时和每次写成功后重放
+    """
+
+    def __init__(self, config=None):
+        self.config = config or get_config()
+        self.queue = queue.Queue(maxsize=self.config['MAX_QUEUE'])
+        self.thread = None
+        self.lock = threading.Lock()
+        self.spill_lock = threading.Lock()
+        self.overflow = ThreadPoolExecutor(max_workers=self.config['OVERFLOW_WORKERS'],
+                                           thread_name_prefix='turn-writer-overflow')
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, name='turn-writer', daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def put(self, content, ai_content, room, user_id, model, fetch_time):
+        res_time = time.strftime('%Y-%m-%d %H:%M:%S')
+        common_fields = {'room_id': room, 'user_id': user_id, 'model': model}
+        rows = [
+            {**common_fields, 'role': 'user', 'content': content, 'date_time': fetch_time},
+            {**common_fields, 'role': 'assistant', 'content': ai_content, 'date_time': res_time},
+        ]
+        self.start()
+        try:
+            self.queue.put_nowait(rows)
+        except queue.Full:
+            # 队列满说明数据库跟不上; put 在事件循环上调用, 不能同步写库, 先落盘
+            if self.config['SPILL_PATH']:
+                self._spill(rows)
+            else:
+                self.overflow.submit(self._write, rows)
+
+    def flush(self, timeout=None):
+        # 等待队列里已有的消息全部写完
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self, timeout=10):
+        self.overflow.shutdown()
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+
+    def _run(self):
+        # 上次退出时没写进去的先写
+        self._replay_spill()
+        batch_size = self.config['BATCH_SIZE']
+        interval = self.config['FLUSH_INTERVAL']
+        while True:
+            rows = []
+            taken = 0
+            stop = False
+            deadline = None
+            while len(rows) < batch_size:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                taken += 1
+                if item is _STOP:
+                    stop = True
+                    break
+                rows.extend(item)
+                if deadline is None:
+                    deadline = time.monotonic() + interval
+            try:
+                if rows:
+                    self._write(rows)
+            except Exception as e:
+                # 写入线程不能退出, 否则之后的消息都只进队列不落库
+                print(f'write {len(rows)} messages failed: {e}')
+            finally:
+                for _ in range(taken):
+                    self.queue.task_done()
+            if stop:
+                self._drain()
+                return
+
+    def _drain(self):
+        rows = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                rows.extend(item)
+            self.queue.task_done()
+        if rows:
+            self._write(rows)
+
+    def _write(self, rows, replay=True):
+        for attempt in range(self.config['RETRIES']):
+            close_old_connections()
+            try:
+                self._bulk_create(rows)
+                break
+            except Exception as e:
+                print(f'write messages failed (attempt {attempt + 1}): {e}')
+                time.sleep(0.2 * 2 ** attempt)
+        else:
+            self._spill(rows)
+            return
+        if replay:
+            # 数据库恢复了, 顺带写掉之前落盘的(队列满或写库失败时)
+            self._replay_spill()
+        # 用户接下来翻历史要能看到刚写的消息, 这段时间读主库
+        pin_primary(*{row['user_id'] for row in rows})
+        for room_id in {row['room_id'] for row in rows}:
+            schedule_summary(room_id)
+            schedule_embedding(room_id)
+
+    def _bulk_create(self, rows):
+        messages = []
+        for row in rows:
+            message = Message(**row)
+            message.tokens = count_tokens(message.content, message.model)
+            messages.append(message)
+        try:
+            Message.objects.bulk_create(messages, batch_size=self.config['BATCH_SIZE'])
+        except IntegrityError:
+            # 一行坏数据(比如房间已删除)不能拖垮整批, 逐行重试并丢弃坏行
+            for message in messages:
+                try:
+                    message.save()
+                except IntegrityError as e:
+                    print(f'drop message for room {message.room_id}: {e}')
+
+    def _spill(self, rows):
+        path = self.config['SPILL_PATH']
+        if not path:
+            print(f'lost {len(rows)} messages: database unavailable and SPILL_PATH not set')
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self.spill_lock, open(path, 'a', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f'lost {len(rows)} messages: spill to {path} failed: {e}')
+
+    def _replay_spill(self):
+        # 在写入线程里直接分批写库(不经过队列, 避免写入线程自己在满队列上阻塞)
+        path = self.config['SPILL_PATH']
+        if not path:
+            return
+        # 先改名再读, 重放失败的会重新落到新的 SPILL_PATH
+        replay_path = f'{path}.replay'
+        # 上次重放到一半进程就退出了, 留下的文件先重放(已写入的那几批会重复)
+        if os.path.exists(replay_path):
+            self._replay_file(replay_path)
+        with self.spill_lock:
+            if not os.path.exists(path):
+                return
+            os.replace(path, replay_path)
+        self._replay_file(replay_path)
+
+    def _replay_file(self, replay_path):
+        with open(replay_path, encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        for start in range(0, len(rows), self.config['BATCH_SIZE']):
+            self._write(rows[start:start + self.config['BATCH_SIZE']], replay=False)
+        os.remove(replay_path)
+
+
+turn_writer = TurnWriter()
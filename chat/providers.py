@@ -0,0 +1,253 @@
+import asyncio
+import fnmatch
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import httpx
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+DEFAULT_PROVIDERS = {
+    'openai': {
+        'BACKEND': 'chat.providers.OpenAIProvider',
+        'OPTIONS': {},
+    },
+}
+
+
+class ProviderBusy(Exception):
+    """并发已满且排队超时(或排队人数超限)"""
+
+
+class BaseProvider:
+    """
+    上游模型服务: stream 用于对话的流式输出(异步), complete 用于摘要等后台任务(同步)
+    每个 provider 自带并发上限, 超出的请求排队等待, 排队过长直接拒绝, 避免把上游打到限流
+    """
+
+    def __init__(self, name, max_concurrency=32, max_queue=256, queue_timeout=30):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.active = 0
+        # asyncio 的信号量绑定事件循环, 换了循环(比如测试里多次 asyncio.run)就重建
+        self._loop = None
+        self._semaphore = None
+        self._sync_semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def _get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            previous, self._loop = self._loop, loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.on_new_loop(previous)
+        return self._semaphore
+
+    def on_new_loop(self, previous):
+        # 绑定在旧循环上的资源在这里换掉, previous 为旧循环(第一次为 None)
+        pass
+
+    @asynccontextmanager
+    async def slot(self):
+        semaphore = self._get_semaphore()
+        if semaphore.locked() and self.waiting >= self.max_queue:
+            raise ProviderBusy(f'{self.name}: too many queued requests')
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise ProviderBusy(f'{self.name}: timed out waiting for a free slot')
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            semaphore.release()
+
+    @contextmanager
+    def sync_slot(self):
+        if not self._sync_semaphore.acquire(timeout=self.queue_timeout):
+            raise ProviderBusy(f'{self.name}: timed out waiting for a free slot')
+        try:
+            yield
+        finally:
+            self._sync_semaphore.release()
+
+    async def stream(self, model, messages, usage=None):
+        # usage: 传入字典时, 上游报告的 token 用量会写进去
+        async with self.slot():
+            async for text in self._stream(model, messages, usage):
+                yield text
+
+    def complete(self, model, messages):
+        with self.sync_slot():
+            return self._complete(model, messages)
+
+    async def _stream(self, model, messages, usage=None):
+        raise NotImplementedError
+        yield
+
+    def _complete(self, model, messages):
+        raise NotImplementedError
+
+
+class OpenAIProvider(BaseProvider):
+    """OpenAI 兼容接口, 连接池参数可配, 长连接复用"""
+
+    def __init__(self, name, api_key=None, base_url=None, organization=None, project=None,
+                 max_connections=100, max_keepalive_connections=20, keepalive_expiry=30, timeout=60,
+                 transport=None, stream_usage=True, **kwargs):
+        super().__init__(name, **kwargs)
+        self.client_options = {
+            'api_key': api_key or os.getenv("API_KEY"),
+            'organization': organization or os.getenv("ORGANIZATION"),
+            'project': project or os.getenv("PROJECT"),
+            'base_url': base_url or os.getenv("BASE_URL") or None,
+        }
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout, connect=10)
+        self.transport = transport
+        # 流式响应末尾附带 usage, 部分兼容接口不支持 stream_options 时关掉
+        self.stream_usage = stream_usage
+        self._async_client = None
+        self._sync_client = None
+
+    def on_new_loop(self, previous):
+        from openai import AsyncOpenAI
+        http_client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, transport=self.transport)
+        old, self._async_client = self._async_client, AsyncOpenAI(http_client=http_client, **self.client_options)
+        if old is not None:
+            # 旧连接池里的连接属于旧循环, 能的话在旧循环上关闭, 否则在当前循环上尽量关闭
+            if previous is not None and previous.is_running():
+                asyncio.run_coroutine_threadsafe(self._close_client(old), previous)
+            else:
+                asyncio.ensure_future(self._close_client(old))
+
+    async def _close_client(self, client):
+        try:
+            await client.close()
+        except Exception as e:
+            print(f'close {self.name} client failed: {e}')
+
+    @property
+    def sync_client(self):
+        if self._sync_client is None:
+            from openai import OpenAI
+            http_client = httpx.Client(limits=self.limits, timeout=self.timeout)
+            self._sync_client = OpenAI(http_client=http_client, **self.client_options)
+        return self._sync_client
+
+    async def _stream(self, model, messages, usage=None):
+        options = {'stream_options': {'include_usage': True}} if usage is not None and self.stream_usage else {}
+        completion = await self._async_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            **options,
+        )
+        async for chunk in completion:
+            if chunk.usage and usage is not None:
+                usage.update(
+                    prompt_tokens=chunk.usage.prompt_tokens,
+                    completion_tokens=chunk.usage.completion_tokens,
+                    total_tokens=chunk.usage.total_tokens,
+                )
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                yield content
+
+    def _complete(self, model, messages):
+        completion = self.sync_client.chat.completions.create(model=model, messages=messages)
+        return completion.choices[0].message.content
+
+
+class FakeProvider(BaseProvider):
+    """本地假模型: 把最后一条用户消息按词回显, 用于测试和压测, 不访问网络"""
+
+    def __init__(self, name, delay=0.0, prefix='echo: ', **kwargs):
+        super().__init__(name, **kwargs)
+        self.delay = delay
+        self.prefix = prefix
+
+    def reply(self, messages):
+        last = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+        return self.prefix + last
+
+    async def _stream(self, model, messages, usage=None):
+        for word in self.reply(messages).split(' '):
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            yield word + ' '
+
+    def _complete(self, model, messages):
+        if self.delay:
+            time.sleep(self.delay)
+        return self.reply(messages)
+
+
+_providers = {}
+_lock = threading.Lock()
+
+
+def get_provider_config():
+    return getattr(settings, 'CHAT_PROVIDERS', DEFAULT_PROVIDERS)
+
+
+def get_provider(name):
+    with _lock:
+        if name not in _providers:
+            config = get_provider_config()[name]
+            options = {key.lower(): value for key, value in config.get('OPTIONS', {}).items()}
+            _providers[name] = import_string(config['BACKEND'])(name, **options)
+        return _providers[name]
+
+
+def set_provider(name, provider):
+    # 测试/压测时直接注入 provider 实例
+    with _lock:
+        _providers[name] = provider
+
+
+def get_default_model(cached_only=False):
+    # cached_only: 缓存里没有时直接用配置里的默认模型, 不查库
+    from user.models import AiModel
+    model = cache.get('chat:default_model')
+    if model is None and cached_only:
+        return getattr(settings, 'CHAT_DEFAULT_MODEL', 'gpt-4o-mini')
+    if model is None:
+        model = (AiModel.objects.filter(is_default=True).values_list('name', flat=True).first()
+                 or getattr(settings, 'CHAT_DEFAULT_MODEL', 'gpt-4o-mini'))
+        cache.set('chat:default_model', model, 60)
+    return model
+
+
+def resolve_provider_name(model):
+    # 优先使用 AiModel 上配置的 provider, 其次按 CHAT_MODEL_PROVIDERS 的通配规则, 最后是默认 provider
+    from user.models import AiModel
+    cache_key = f'chat:model_provider:{model}'
+    name = cache.get(cache_key)
+    if name is None:
+        name = AiModel.objects.filter(name=model).exclude(provider='').values_list('provider', flat=True).first()
+        if not name:
+            routes = getattr(settings, 'CHAT_MODEL_PROVIDERS', {})
+            name = next((provider for pattern, provider in routes.items() if fnmatch.fnmatch(model, pattern)),
+                        getattr(settings, 'CHAT_DEFAULT_PROVIDER', 'openai'))
+        cache.set(cache_key, name, 60)
+    return name
+
+
+def get_provider_for_model(model):
+    return get_provider(resolve_provider_name(model))
@@ -0,0 +1,342 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils.module_loading import import_string
+
+from chat.models import Message, MessageEmbedding
+
+DEFAULT_RETRIEVAL = {
+    'ENABLED': False,
+    'EMBEDDER': 'chat.retrieval.HashingEmbedder',  # 线上可换成 chat.retrieval.OpenAIEmbedder
+    'OPTIONS': {},
+    'SCOPE': 'room',  # room: 只在当前房间里找; user: 在该用户所有房间里找
+    'MODE': 'exact',  # exact: 全量点积; lsh: 先用随机超平面签名粗筛再精排, 大索引时更快
+    'LSH_BITS': 64,
+    'TOP_K': 4,
+    'MIN_SCORE': 0.25,  # 余弦相似度低于这个值的不要
+    'BUDGET_RATIO': 0.25,  # 检索到的消息最多占上下文预算的比例
+    'MAX_INDEXES': 256,  # 内存里最多缓存多少个房间/用户的索引
+    'BATCH_SIZE': 64,  # 每次计算向量的消息数
+}
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def get_config():
+    return {**DEFAULT_RETRIEVAL, **getattr(settings, 'CHAT_RETRIEVAL', {})}
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class BaseEmbedder:
+    """把文本列表转成 (n, dim) 的单位向量; name 需要唯一标识模型和维度, 换了就会重新计算"""
+    name = None
+    dim = None
+
+    def embed(self, texts):
+        raise NotImplementedError
+
+
+class HashingEmbedder(BaseEmbedder):
+    """本地确定性的哈希向量: 英文按词、中文按单字和相邻两字, 不依赖网络, 用于测试和开发"""
+    TOKEN_RE = re.compile(r'[a-z0-9]+|[\u4e00-\u9fff]+')
+
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.name = f'hashing-{dim}'
+
+    def features(self, text):
+        for token in self.TOKEN_RE.findall(text.lower()):
+            if token.isascii():
+                yield token
+                continue
+            yield from token
+            for i in range(len(token) - 1):
+                yield token[i:i + 2]
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self.features(text):
+                value = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+                vectors[row, value % self.dim] += 1 if value >> 63 else -1
+        return normalize(vectors)
+
+
+class OpenAIEmbedder(BaseEmbedder):
+    """OpenAI 兼容的 embeddings 接口, 复用 provider 的连接池和并发限制"""
+
+    def __init__(self, model='text-embedding-3-small', provider='openai', dim=256):
+        self.model = model
+        self.provider = provider
+        self.dim = dim
+        self.name = f'{provider}:{model}:{dim}'
+
+    def embed(self, texts):
+        from chat.providers import get_provider
+        provider = get_provider(self.provider)
+        with provider.sync_slot():
+            response = provider.sync_client.embeddings.create(model=self.model, input=texts, dimensions=self.dim)
+        return normalize(np.array([item.embedding for item in response.data], dtype=np.float32))
+
+
+_planes = {}
+
+
+def get_planes(dim, bits):
+    # 所有索引共用同一组随机超平面, 固定种子保证进程重启后签名一致
+    if (dim, bits) not in _planes:
+        _planes[dim, bits] = np.random.default_rng(dim * 1000 + bits).standard_normal((bits, dim)).astype(np.float32)
+    return _planes[dim, bits]
+
+
+class VectorIndex:
+    """
+    一个房间(或用户)的向量索引: ids 与 vectors 一一对应, 追加时按倍数扩容
+    exact 为全量点积; lsh 先按签名的汉明距离选出候选, 再对候选精确打分
+    add 与 search 可能在不同线程里并发, 共用一把锁: search 在锁里取出前 size 行的视图,
+    add 只往 size 之后写或者扩容成新数组, 已取出的视图不会再变
+    """
+
+    def __init__(self, dim, bits=64):
+        self.dim = dim
+        self.bits = bits
+        self.size = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.codes = np.empty((0, bits // 8), dtype=np.uint8)
+        self.lock = threading.Lock()
+
+    def encode(self, vectors):
+        return np.packbits(vectors @ get_planes(self.dim, self.bits).T > 0, axis=1)
+
+    def add(self, ids, vectors):
+        with self.lock:
+            self._add(np.asarray(ids, dtype=np.int64), vectors)
+
+    def _add(self, ids, vectors):
+        if self.size:
+            # 重复计算(比如换了模型后重算)时跳过已有的
+            keep = ~np.isin(ids, self.ids[:self.size])
+            ids, vectors = ids[keep], vectors[keep]
+        if not len(ids):
+            return
+        needed = self.size + len(ids)
+        if needed > len(self.ids):
+            capacity = max(needed, 2 * len(self.ids), 64)
+            self.ids = np.resize(self.ids, capacity)
+            self.vectors = np.resize(self.vectors, (capacity, self.dim))
+            self.codes = np.resize(self.codes, (capacity, self.bits // 8))
+        self.ids[self.size:needed] = ids
+        self.vectors[self.size:needed] = vectors
+        self.codes[self.size:needed] = self.encode(vectors)
+        self.size = needed
+
+    def search(self, query, k, exclude=(), mode='exact'):
+        with self.lock:
+            size = self.size
+            ids, vectors, codes = self.ids[:size], self.vectors[:size], self.codes[:size]
+        if not size:
+            return []
+        if mode == 'lsh' and size > k * 16:
+            distances = POPCOUNT[np.bitwise_xor(codes, self.encode(query[None, :]))].sum(axis=1)
+            candidates = np.argpartition(distances, k * 16)[:k * 16]
+            scores = vectors[candidates] @ query
+        else:
+            candidates = None
+            scores = vectors @ query
+        if len(exclude):
+            scores[np.isin(ids if candidates is None else ids[candidates], exclude)] = -np.inf
+        top = np.argpartition(-scores, k)[:k] if len(scores) > k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        positions = top if candidates is None else candidates[top]
+        return [(int(ids[i]), float(scores[j])) for i, j in zip(positions, top) if scores[j] > -np.inf]
+
+
+class IndexRegistry:
+    """按 (scope, id) 缓存已加载的索引, LRU 淘汰; 第一次用到时从 MessageEmbedding 加载(见 schedule_load)"""
+
+    def __init__(self, max_indexes=256):
+        self.max_indexes = max_indexes
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def peek(self, scope, key):
+        # 只取已经加载的索引, 不访问数据库
+        with self.lock:
+            index = self.items.get((scope, key))
+            if index is not None:
+                self.items.move_to_end((scope, key))
+            return index
+
+    def get(self, scope, key, embedder, bits):
+        with self.lock:
+            index = self.items.get((scope, key))
+            if index is not None:
+                self.items.move_to_end((scope, key))
+                return index
+        index = self.load(scope, key, embedder, bits)
+        with self.lock:
+            index = self.items.setdefault((scope, key), index)
+            while len(self.items) > self.max_indexes:
+                self.items.popitem(last=False)
+        return index
+
+    def load(self, scope, key, embedder, bits):
+        rows = (MessageEmbedding.objects.filter(**{f'{scope}_id': key}, embedder=embedder.name)
+                .order_by('message_id').values_list('message_id', 'vector'))
+        ids, vectors = [], []
+        for message_id, vector in rows.iterator(chunk_size=2000):
+            ids.append(message_id)
+            vectors.append(bytes(vector))
+        index = VectorIndex(embedder.dim, bits)
+        if ids:
+            index.add(ids, np.frombuffer(b''.join(vectors), dtype=np.float16).reshape(-1, embedder.dim)
+                      .astype(np.float32))
+        return index
+
+    def add(self, scope, key, ids, vectors):
+        # 只更新已经加载的索引, 没加载的下次用到时从数据库加载
+        with self.lock:
+            index = self.items.get((scope, key))
+            if index is not None:
+                index.add(ids, vectors)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+_embedder = None
+_registry = None
+
+
+def get_embedder():
+    global _embedder
+    if _embedder is None:
+        config = get_config()
+        options = {key.lower(): value for key, value in config['OPTIONS'].items()}
+        _embedder = import_string(config['EMBEDDER'])(**options)
+    return _embedder
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = IndexRegistry(get_config()['MAX_INDEXES'])
+    return _registry
+
+
+def embed_room(room_id):
+    """给房间里还没有(当前模型)向量的消息计算向量, 分批写入并更新已加载的索引"""
+    config = get_config()
+    embedder = get_embedder()
+    conflict_target = ['message'] if connection.features.supports_update_conflicts_with_target else None
+    while True:
+        rows = list(Message.objects.filter(room_id=room_id).exclude(embedding__embedder=embedder.name)
+                    .order_by('id').values_list('id', 'user_id', 'content')[:config['BATCH_SIZE']])
+        if not rows:
+            return
+        vectors = embedder.embed([content for _, _, content in rows])
+        MessageEmbedding.objects.bulk_create(
+            [
+                MessageEmbedding(message_id=message_id, room_id=room_id, user_id=user_id, embedder=embedder.name,
+                                 vector=vector.astype(np.float16).tobytes())
+                for (message_id, user_id, _), vector in zip(rows, vectors)
+            ],
+            update_conflicts=True, unique_fields=conflict_target, update_fields=['embedder', 'vector'],
+        )
+        ids = np.array([message_id for message_id, _, _ in rows])
+        # 与落库的精度一致
+        vectors = vectors.astype(np.float16).astype(np.float32)
+        registry = get_registry()
+        registry.add('room', room_id, ids, vectors)
+        for user_id in {user_id for _, user_id, _ in rows}:
+            mask = np.array([row_user == user_id for _, row_user, _ in rows])
+            registry.add('user', user_id, ids[mask], vectors[mask])
+        if len(rows) < config['BATCH_SIZE']:
+            return
+
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='message-embedding')
+_pending = set()
+_lock = threading.Lock()
+
+
+def _run(task, *args):
+    close_old_connections()
+    try:
+        task(*args)
+    except Exception as e:
+        print(f'{task.__name__} {args} failed: {e}')
+    finally:
+        close_old_connections()
+
+
+def _embed(room_id):
+    # 开始计算前就清掉排队标记: 计算过程中写入的消息会再排一次, 不会被漏掉
+    with _lock:
+        _pending.discard(room_id)
+    embed_room(room_id)
+
+
+def _load(scope, key):
+    config = get_config()
+    try:
+        get_registry().get(scope, key, get_embedder(), config['LSH_BITS'])
+    finally:
+        with _lock:
+            _pending.discard((scope, key))
+
+
+def _submit(mark, *args):
+    # 同一个房间(或索引)同时只排队一次
+    with _lock:
+        if mark in _pending:
+            return
+        _pending.add(mark)
+    try:
+        _executor.submit(_run, *args)
+    except RuntimeError:
+        with _lock:
+            _pending.discard(mark)
+
+
+def schedule_embedding(room_id):
+    # 消息写库后在后台线程里计算向量
+    if not get_config()['ENABLED']:
+        return
+    _submit(room_id, _embed, room_id)
+
+
+def schedule_load(scope, key):
+    # 加载索引要读出全部向量, 放到后台线程里; 与计算向量共用一个线程,
+    # 加载期间不会有新向量写入, 加载完之后写入的会通过 IndexRegistry.add 更新到索引里
+    _submit((scope, key), _load, scope, key)
+
+
+def retrieve(room_id, user_id, query, exclude=(), k=None):
+    """
+    返回与 query 最相关的 [(message_id, score)], exclude 为已经在上下文里的消息 id
+    索引还没加载时在后台加载, 本次返回空列表, 不在请求里读全部向量
+    """
+    config = get_config()
+    embedder = get_embedder()
+    scope, key = ('user', user_id) if config['SCOPE'] == 'user' else ('room', room_id)
+    index = get_registry().peek(scope, key)
+    if index is None:
+        schedule_load(scope, key)
+        return []
+    query = embedder.embed([query])[0]
+    hits = index.search(query, k or config['TOP_K'], np.asarray(exclude, dtype=np.int64), config['MODE'])
+    return [(message_id, score) for message_id, score in hits if score >= config['MIN_SCORE']]
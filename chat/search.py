@@ -0,0 +1,141 @@
+from django.db import connection, connections, router
+from rest_framework import serializers
+
+from chat.models import Message
+
+SNIPPET_CHARS = 40  # 片段里命中词前后各保留的字符数
+MAX_LIMIT = 50
+
+FTS_TABLE = 'chat_message_fts'
+MYSQL_INDEX = 'chat_msg_content_ft'
+
+
+def split_terms(query):
+    # 按空白切词, 每个词按短语匹配(引号内的运算符不生效), 多个词之间是 AND
+    terms = [term.replace('"', '') for term in query.split()]
+    return list(dict.fromkeys(term for term in terms if term))
+
+
+def make_snippet(content, terms, width=SNIPPET_CHARS):
+    lowered = content.lower()
+    positions = [(lowered.find(term.lower()), term) for term in terms]
+    positions = [(index, term) for index, term in positions if index >= 0]
+    if not positions:
+        return content[:width * 2] + ('…' if len(content) > width * 2 else '')
+    index, term = min(positions)
+    start = max(index - width, 0)
+    end = min(index + len(term) + width, len(content))
+    return ('…' if start else '') + content[start:end] + ('…' if end < len(content) else '')
+
+
+def _hit(row, terms, score):
+    return {
+        'id': row['id'],
+        'room': row['room_id'],
+        'role': row['role'],
+        # 与其它接口一样输出本地时区的时间
+        'create_time': serializers.DateTimeField().to_representation(row['create_time']) if row['create_time'] else None,
+        'score': round(score, 4),
+        'snippet': make_snippet(row['content'], terms),
+    }
+
+
+class LikeSearch:
+    """没有全文索引时的兜底: LIKE 扫描, 按命中次数排序, 只适合小数据量(开发、测试)"""
+    min_term_chars = 1
+
+    def search(self, user_id, terms, room_id=None, limit=20):
+        queryset = Message.objects.filter(user_id=user_id)
+        if room_id is not None:
+            queryset = queryset.filter(room_id=room_id)
+        for term in terms:
+            queryset = queryset.filter(content__icontains=term)
+        rows = queryset.order_by('-id').values('id', 'room_id', 'role', 'content', 'create_time')[:limit * 5]
+        hits = [
+            _hit(row, terms, sum(row['content'].lower().count(term.lower()) for term in terms))
+            for row in rows
+        ]
+        return sorted(hits, key=lambda hit: (-hit['score'], -hit['id']))[:limit]
+
+
+class FullTextSearch:
+    """数据库全文索引: 先按相关度取出 id, 再查出内容做片段"""
+    min_term_chars = 1
+    sql = None
+    match_params = 1  # sql 里出现几次匹配表达式
+
+    def match_expression(self, terms):
+        raise NotImplementedError
+
+    def search(self, user_id, terms, room_id=None, limit=20):
+        if any(len(term) < self.min_term_chars for term in terms):
+            # 太短的词不在索引里
+            return LikeSearch().search(user_id, terms, room_id, limit)
+        room_filter = 'AND m.room_id = %s' if room_id is not None else ''
+        params = ([self.match_expression(terms)] * self.match_params + [user_id]
+                  + ([room_id] if room_id is not None else []) + [limit])
+        # 与 ORM 的读查询一样按路由选库(只读接口里是从库)
+        with connections[router.db_for_read(Message)].cursor() as cursor:
+            cursor.execute(self.sql.format(room_filter=room_filter), params)
+            scores = dict(cursor.fetchall())
+        rows = Message.objects.filter(id__in=scores).values('id', 'room_id', 'role', 'content', 'create_time')
+        hits = [_hit(row, terms, scores[row['id']]) for row in rows]
+        return sorted(hits, key=lambda hit: (-hit['score'], -hit['id']))
+
+
+class MySQLSearch(FullTextSearch):
+    """InnoDB FULLTEXT 索引(ngram 分词, 支持中文), 写入时由 MySQL 增量维护"""
+    min_term_chars = 2  # ngram_token_size 默认为 2
+    match_params = 2
+    sql = '''
+        SELECT m.id, MATCH(m.content) AGAINST (%s IN BOOLEAN MODE) AS score
+        FROM chat_message m
+        WHERE MATCH(m.content) AGAINST (%s IN BOOLEAN MODE) AND m.user_id = %s {room_filter}
+        ORDER BY score DESC
+        LIMIT %s
+    '''
+
+    def match_expression(self, terms):
+        # 每个词都必须出现, 按短语匹配
+        return ' '.join(f'+"{term}"' for term in terms)
+
+
+class SQLiteSearch(FullTextSearch):
+    """FTS5 外部内容表(trigram 分词), 由触发器随 chat_message 增量维护; 主要用于开发和测试"""
+    min_term_chars = 3  # trigram 至少三个字符
+    sql = f'''
+        SELECT m.id, -bm25({FTS_TABLE}) AS score
+        FROM {FTS_TABLE} JOIN chat_message m ON m.id = {FTS_TABLE}.rowid
+        WHERE {FTS_TABLE} MATCH %s AND m.user_id = %s {{room_filter}}
+        ORDER BY bm25({FTS_TABLE})
+        LIMIT %s
+    '''
+
+    def match_expression(self, terms):
+        return ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        # 迁移在不支持的数据库上不建索引, 这里按实际建好的索引选择实现
+        with connection.cursor() as cursor:
+            tables = connection.introspection.table_names(cursor)
+            if connection.vendor == 'sqlite' and FTS_TABLE in tables:
+                _backend = SQLiteSearch()
+            elif connection.vendor == 'mysql' and MYSQL_INDEX in connection.introspection.get_constraints(
+                    cursor, Message._meta.db_table):
+                _backend = MySQLSearch()
+            else:
+                _backend = LikeSearch()
+    return _backend
+
+
+def search_messages(user_id, query, room_id=None, limit=20):
+    terms = split_terms(query)
+    if not terms:
+        return []
+    return get_backend().search(user_id, terms, room_id, min(limit, MAX_LIMIT))
@@ -1,13 +1,20 @@
-from rest_framework import serializers
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
 
 from chat.models import Room, Message
+from chat_ai_service.profiling import section
 
 
 class RoomSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Room
-        fields = '__all__'
+        # 摘要由后台生成, 会进入模型的上下文: 不对外输出正文, 也不允许客户端写; 归档状态只由归档和恢复修改,
+        # 归档的消息 id 范围只在内部按消息找房间用
+        exclude = ['summary', 'archived_first_id', 'archived_last_id']
+        read_only_fields = ['summary_until', 'summary_tokens', 'archived_at', 'archived_messages', 'restored_at']
         # depth = 1
 
 
@@ -15,4 +22,107 @@ class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = '__all__'
+        read_only_fields = ['tokens']
         # depth = 1
+
+
+class RoomOperationSerializer(serializers.Serializer):
+    """批量操作房间的单个操作: create 需要 name, rename 需要 id + name, check 需要 id + checked, delete 需要 id 或 ids"""
+    OPS = ('create', 'rename', 'check', 'delete')
+
+    op = serializers.ChoiceField(choices=OPS)
+    id = serializers.IntegerField(required=False)
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False)
+    name = serializers.CharField(max_length=100, required=False)
+    checked = serializers.BooleanField(required=False)
+
+    def validate(self, attrs):
+        op = attrs['op']
+        required = {'create': ['name'], 'rename': ['id', 'name'], 'check': ['id', 'checked'], 'delete': []}[op]
+        missing = [name for name in required if name not in attrs]
+        if missing:
+            raise serializers.ValidationError(f'{op} 操作缺少字段: {", ".join(missing)}')
+        if op == 'delete':
+            if 'id' not in attrs and 'ids' not in attrs:
+                raise serializers.ValidationError('delete 操作需要 id 或 ids')
+            attrs['ids'] = [*attrs.get('ids', []), *([attrs['id']] if 'id' in attrs else [])]
+        return attrs
+
+
+class FastReadSerializer:
+    """
+    只读列表的快速序列化: 直接用 values() 取出字典再整理, 跳过 ModelSerializer 的逐字段处理
+    fields 为 {输出字段: values() 查询的字段}, 输出与对应 ModelSerializer 一致; 可用 ?fields=a,b 只取部分字段
+    """
+    fields = {}
+    datetime_fields = ()
+
+    def __init__(self, fields=None):
+        if fields:
+            requested = [name.strip() for name in fields.split(',') if name.strip()]
+            unknown = [name for name in requested if name not in self.fields]
+            if unknown:
+                raise serializers.ValidationError({'fields': f'不支持的字段: {", ".join(unknown)}'})
+            self.output = requested
+        else:
+            self.output = list(self.fields)
+
+    def values(self, queryset, extra=()):
+        # extra: 分页排序需要的字段, 即使没有请求也要查出来
+        lookups = dict.fromkeys([self.fields[name] for name in self.output] + list(extra))
+        return queryset.values(*lookups)
+
+    def datetime_formatter(self):
+        # 与 DateTimeField 的默认输出一致(转本地时区的 ISO 8601), 但时区只取一次
+        if not settings.USE_TZ or api_settings.DATETIME_FORMAT != ISO_8601:
+            return serializers.DateTimeField().to_representation
+        tz = timezone.get_current_timezone()
+
+        def to_representation(value):
+            value = value.astimezone(tz).isoformat()
+            return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+        return to_representation
+
+    def to_representation(self, rows):
+        columns = [(name, self.fields[name], name in self.datetime_fields) for name in self.output]
+        to_datetime = self.datetime_formatter()
+        with section('serialize'):
+            return [
+                {
+                    name: (to_datetime(row[lookup]) if is_datetime and row[lookup] is not None else row[lookup])
+                    for name, lookup, is_datetime in columns
+                }
+                for row in rows
+            ]
+
+
+class RoomReadSerializer(FastReadSerializer):
+    fields = {
+        'id': 'id',
+        'name': 'name',
+        'checked': 'checked',
+        'create_time': 'create_time',
+        'summary_until': 'summary_until',
+        'summary_tokens': 'summary_tokens',
+        'archived_at': 'archived_at',
+        'archived_messages': 'archived_messages',
+        'restored_at': 'restored_at',
+        'user': 'user_id',
+    }
+    datetime_fields = ('create_time', 'archived_at', 'restored_at')
+
+
+class MessageReadSerializer(FastReadSerializer):
+    fields = {
+        'id': 'id',
+        'content': 'content',
+        'role': 'role',
+        'model': 'model',
+        'date_time': 'date_time',
+        'create_time': 'create_time',
+        'tokens': 'tokens',
+        'room': 'room_id',
+        'user': 'user_id',
+    }
+    datetime_fields = ('create_time',)
@@ -0,0 +1,26 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from chat.archive import delete_archive
+from chat.caches import invalidate_rooms
+from chat.models import Room
+from user.authentication import user_cache
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def room_changed(sender, instance, **kwargs):
+    # 新建、改名、删除房间后, 侧边栏缓存失效
+    invalidate_rooms(instance.user_id)
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    # Profile.default_room 是 SET_NULL, 由 UPDATE 完成不会触发 Profile 的信号, 这里让认证缓存里的 profile 失效
+    user_cache.invalidate(instance.user_id)
+
+
+@receiver(post_delete, sender=Room)
+def room_archive_deleted(sender, instance, **kwargs):
+    # 已归档的房间被删除(包括随用户级联删除)时, 删掉冷存储里的文件
+    delete_archive(instance)
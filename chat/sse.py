@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+from django.conf import settings
+
+DEFAULT_SSE = {
+    'MAX_BYTES': 1024,  # 缓冲超过这么多字节立即发送
+    'MAX_DELAY': 0.05,  # 缓冲最多攒这么久(秒)就发送
+    'HEARTBEAT': 15,  # 上游长时间没有输出时, 每隔这么久发一个注释行保活
+}
+
+
+def get_config():
+    return {**DEFAULT_SSE, **getattr(settings, 'CHAT_SSE', {})}
+
+
+def format_event(data, event=None, id=None):
+    lines = []
+    if id is not None:
+        lines.append(f'id: {id}')
+    if event:
+        lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, ensure_ascii=False)}')
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+HEARTBEAT_FRAME = b': ping\n\n'
+
+
+class SSEEncoder:
+    """
+    把上游的文本片段编码成 SSE 帧:
+    - 第一个片段立即发送, 保证首字延迟; 之后的片段按 MAX_BYTES / MAX_DELAY 合并成一帧
+    - 上游停顿超过 HEARTBEAT 秒时发送注释行, 防止代理断开连接
+    - 每帧的 id 是截止到该帧的字符偏移量, 客户端可用 Last-Event-ID 从断点继续
+      start_offset 为 source 第一个字符的偏移量
+    - 结束时发送 done 事件(携带 usage), 出错时发送 error 事件
+    """
+
+    def __init__(self, start_offset=0, max_bytes=None, max_delay=None, heartbeat=None):
+        config = get_config()
+        self.max_bytes = max_bytes or config['MAX_BYTES']
+        self.max_delay = max_delay if max_delay is not None else config['MAX_DELAY']
+        self.heartbeat = heartbeat or config['HEARTBEAT']
+        self.offset = start_offset
+        self.frames = 0
+
+    def data_frame(self, buffer):
+        text = ''.join(buffer)
+        self.offset += len(text)
+        self.frames += 1
+        return format_event({'content': text}, id=self.offset)
+
+    async def encode(self, source, usage=None):
+        loop = asyncio.get_running_loop()
+        iterator = source.__aiter__()
+        # 不能用 wait_for 取下一个片段: 超时会把取消传进上游生成器, 所以单独建 task 反复等待
+        pending = None
+        buffer = []
+        size = 0
+        buffered_at = None
+        last_sent = loop.time()
+        first = True
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                now = loop.time()
+                if buffer:
+                    timeout = max(buffered_at + self.max_delay - now, 0)
+                else:
+                    timeout = max(last_sent + self.heartbeat - now, 0)
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    yield self.data_frame(buffer) if buffer else HEARTBEAT_FRAME
+                    buffer, size, buffered_at = [], 0, None
+                    last_sent = loop.time()
+                    continue
+
+                task, pending = pending, None
+                try:
+                    text = task.result()
+                except StopAsyncIteration:
+                    break
+
+                buffer.append(text)
+                size += len(text.encode())
+                if first or size >= self.max_bytes:
+                    first = False
+                    yield self.data_frame(buffer)
+                    buffer, size, buffered_at = [], 0, None
+                    last_sent = loop.time()
+                elif buffered_at is None:
+                    buffered_at = loop.time()
+
+            if buffer:
+                yield self.data_frame(buffer)
+            yield format_event({'length': self.offset, 'usage': usage() if usage else None}, event='done',
+                               id=self.offset)
+        except Exception as e:
+            if buffer:
+                yield self.data_frame(buffer)
+            yield format_event({'message': str(e)}, event='error', id=self.offset)
+        finally:
+            if pending is not None and not pending.done():
+                pending.cancel()
+            elif hasattr(iterator, 'aclose'):
+                await iterator.aclose()
@@ -0,0 +1,119 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+from chat.models import Room, Message
+from chat.providers import get_provider_for_model
+from chat.tokens import count_tokens
+
+DEFAULT_SUMMARY = {
+    'BACKEND': 'chat.summary.ProviderSummaryBackend',
+    'MODEL': 'gpt-4o-mini',
+    # 未被摘要的旧消息超过这么多 token 时触发一次摘要
+    'TRIGGER_TOKENS': 2000,
+    # 最近的几条消息始终原样发送, 不参与摘要
+    'KEEP_RECENT': 6,
+}
+
+SUMMARY_PROMPT = (
+    '你负责维护一段对话的摘要。根据已有摘要和新增的对话内容, 输出更新后的摘要。'
+    '保留事实、结论、用户的偏好和未完成的问题, 去掉寒暄, 不超过 300 字。'
+)
+
+
+def get_config():
+    return {**DEFAULT_SUMMARY, **getattr(settings, 'CHAT_SUMMARY', {})}
+
+
+class ProviderSummaryBackend:
+    """通过模型对应的 provider 生成摘要"""
+
+    def summarize(self, summary, messages, model):
+        lines = '\n'.join(f"{m['role']}: {m['content']}" for m in messages)
+        return get_provider_for_model(model).complete(model, [
+            {'role': 'system', 'content': SUMMARY_PROMPT},
+            {'role': 'user', 'content': f'已有摘要:\n{summary or "(无)"}\n\n新增对话:\n{lines}'},
+        ]).strip()
+
+
+class LocalSummaryBackend:
+    """不访问网络的确定性摘要, 用于测试和本地开发"""
+    max_chars = 2000
+
+    def summarize(self, summary, messages, model):
+        lines = [summary] if summary else []
+        lines += [f"{m['role']}: {m['content'][:80]}" for m in messages]
+        return '\n'.join(lines)[-self.max_chars:]
+
+
+_backend = None
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='room-summary')
+_pending = set()
+_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = import_string(get_config()['BACKEND'])()
+    return _backend
+
+
+def summarize_room(room_id):
+    """
+    把最近窗口之外、还没摘要过的消息折叠进房间摘要, 新摘要 = f(旧摘要, 新增消息), 不会从头重算
+    返回是否更新了摘要
+    """
+    config = get_config()
+    room = Room.objects.only('summary', 'summary_until').filter(id=room_id).first()
+    if room is None:
+        return False
+
+    # 最近 KEEP_RECENT 条之前的消息才可以被摘要
+    recent_ids = list(Message.objects.filter(room_id=room_id, id__gt=room.summary_until)
+                      .order_by('-id').values_list('id', flat=True)[:config['KEEP_RECENT'] + 1])
+    if len(recent_ids) <= config['KEEP_RECENT']:
+        return False
+    boundary = recent_ids[-1]
+
+    pending = list(Message.objects.filter(room_id=room_id, id__gt=room.summary_until, id__lte=boundary)
+                   .order_by('id').values('id', 'role', 'content', 'tokens'))
+    if sum(m['tokens'] or count_tokens(m['content']) for m in pending) < config['TRIGGER_TOKENS']:
+        return False
+
+    summary = get_backend().summarize(room.summary, pending, config['MODEL'])
+    # 以旧的 summary_until 为条件更新, 并发的两次摘要只会有一次生效
+    updated = Room.objects.filter(id=room_id, summary_until=room.summary_until).update(
+        summary=summary,
+        summary_until=pending[-1]['id'],
+        summary_tokens=count_tokens(summary),
+    )
+    return bool(updated)
+
+
+def _run(room_id):
+    try:
+        summarize_room(room_id)
+    except Exception as e:
+        print(f'summarize room {room_id} failed: {e}')
+    finally:
+        with _lock:
+            _pending.discard(room_id)
+        close_old_connections()
+
+
+def schedule_summary(room_id):
+    # 后台线程里做摘要, 同一个房间同时只排队一次
+    with _lock:
+        if room_id in _pending:
+            return
+        _pending.add(room_id)
+    try:
+        _executor.submit(_run, room_id)
+    except RuntimeError:
+        # 进程退出时线程池已关闭, 摘要等下一轮对话再做
+        with _lock:
+            _pending.discard(room_id)
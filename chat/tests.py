@@ -1,3 +1,1304 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework import serializers
+from rest_framework.response import Response
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat import archive, persistence, retrieval, summary, throttling, views
+from chat.archive import ArchiveError, archive_room, inactive_rooms, restore_room
+from chat.completion_cache import CompletionCache
+from chat.context import build_context
+from chat.generations import Generation, GenerationExpired, GenerationRegistry, generations, get_background_loop
+from chat.metrics import CompletionTrace, MetricsRecorder, metrics
+from chat.models import CompletionStat, Message, MessageEmbedding, Room
+from chat.persistence import TurnWriter
+from chat.providers import FakeProvider, OpenAIProvider
+from chat.retrieval import HashingEmbedder, VectorIndex
+from chat.sse import HEARTBEAT_FRAME, SSEEncoder
+from chat.tokens import MESSAGE_OVERHEAD, count_tokens
+from chat.transfer import Importer, export_ndjson
+from chat_ai_service import profiling
+from chat_ai_service.db import ConnectionPool, PooledDatabaseWrapperMixin, PoolTimeout, get_pool
+from chat_ai_service.renderer import FastPublicRenderer, PublicRenderer
+from chat_ai_service.routers import ReplicaRouter, choose_replica, pin_primary, read_from_replica
+
+
+def parse_events(body):
+    """把 SSE 响应体拆成事件列表, 心跳帧记为 {'event': 'heartbeat'}"""
+    events = []
+    for block in body.decode().split('\n\n'):
+        if not block:
+            continue
+        if block.startswith(':'):
+            events.append({'event': 'heartbeat'})
+            continue
+        event = {'event': 'message'}
+        for line in block.split('\n'):
+            key, _, value = line.partition(': ')
+            event[key] = json.loads(value) if key == 'data' else value
+        events.append(event)
+    return events
+
+
+def content_of(events):
+    return ''.join(event['data']['content'] for event in events if event['event'] == 'message')
+
+
+async def source(*parts, pause=0, error=None):
+    for part in parts:
+        if pause:
+            await asyncio.sleep(pause)
+        yield part
+    if error:
+        raise RuntimeError(error)
+
+
+async def collect(frames):
+    return b''.join([frame async for frame in frames])
+
+
+class SSEEncoderTests(SimpleTestCase):
+    async def test_first_chunk_alone_then_coalesced(self):
+        body = await collect(SSEEncoder(max_delay=10).encode(source('a', 'b', 'c', 'd')))
+        events = parse_events(body)
+        self.assertEqual([e['data']['content'] for e in events if e['event'] == 'message'], ['a', 'bcd'])
+        self.assertEqual([e['id'] for e in events], ['1', '4', '4'])
+        self.assertEqual(events[-1]['event'], 'done')
+        self.assertEqual(events[-1]['data']['length'], 4)
+
+    async def test_max_bytes_flushes_buffer(self):
+        body = await collect(SSEEncoder(max_bytes=2, max_delay=10).encode(source('a', 'b', 'c', 'd', 'e')))
+        contents = [e['data']['content'] for e in parse_events(body) if e['event'] == 'message']
+        self.assertEqual(contents, ['a', 'bc', 'de'])
+
+    async def test_heartbeat_while_upstream_is_silent(self):
+        body = await collect(SSEEncoder(heartbeat=0.01).encode(source('a', 'b', pause=0.05)))
+        self.assertIn(HEARTBEAT_FRAME, body)
+        self.assertEqual(content_of(parse_events(body)), 'ab')
+
+    async def test_ids_continue_from_start_offset(self):
+        body = await collect(SSEEncoder(start_offset=10, max_delay=10).encode(source('ab', 'cd')))
+        self.assertEqual([e['id'] for e in parse_events(body)], ['12', '14', '14'])
+
+    async def test_error_event_after_buffered_text(self):
+        body = await collect(SSEEncoder(max_delay=10).encode(source('a', 'b', error='boom')))
+        events = parse_events(body)
+        self.assertEqual(content_of(events), 'ab')
+        self.assertEqual(events[-1]['event'], 'error')
+        self.assertEqual(events[-1]['data']['message'], 'boom')
+
+
+class GenerationTests(SimpleTestCase):
+    async def read(self, generation, offset=0):
+        return ''.join([text async for text in generation.subscribe(offset)])
+
+    async def test_subscribers_resume_from_offset(self):
+        finished = []
+        generation = Generation(source('hello ', 'world'), owner=1, on_finish=finished.append)
+        self.assertEqual(await self.read(generation), 'hello world')
+        self.assertEqual(await self.read(generation, 6), 'world')
+        self.assertEqual(finished, [generation])
+
+    async def test_trimmed_offset_expires(self):
+        generation = Generation(source('a' * 10, 'b' * 10, pause=0.01), owner=1, ring_chars=15)
+        self.assertEqual(await self.read(generation), 'a' * 10 + 'b' * 10)
+        self.assertEqual(await self.read(generation, 15), 'b' * 5)
+        with self.assertRaises(GenerationExpired):
+            await self.read(generation, 0)
+
+    async def test_start_on_given_loop(self):
+        generation = Generation(source('a'), owner=1)
+        loop = asyncio.get_running_loop()
+        await asyncio.to_thread(generation.start, loop)
+        self.assertIsNotNone(generation.task)
+        await generation.task
+        self.assertTrue(generation.done)
+
+    def test_registry_abandons_unstarted_generation(self):
+        finished = []
+        registry = GenerationRegistry(ttl=600, start_timeout=30)
+        generation = registry.add(Generation(source('a'), owner=1, key=(1, 'q'), on_finish=finished.append))
+        self.assertIs(registry.find(1, (1, 'q')), generation)
+        self.assertIsNone(registry.find(2, (1, 'q')))
+
+        registry.cleanup()
+        self.assertEqual(finished, [])
+        registry.start_timeout = -1
+        registry.cleanup()
+        self.assertEqual(finished, [generation])
+        self.assertEqual(generation.error, 'abandoned')
+        # 已结束的生成在 ttl 内仍可重连
+        self.assertIsNone(registry.find(1, (1, 'q')))
+        self.assertIs(registry.find(1, (1, 'q'), include_done=True), generation)
+        registry.ttl = -1
+        registry.cleanup()
+        self.assertIsNone(registry.get(generation.id, 1))
+
+
+class ProviderTests(SimpleTestCase):
+    def test_new_loop_closes_previous_client(self):
+        transport = httpx.MockTransport(lambda request: httpx.Response(500))
+        provider = OpenAIProvider('test', api_key='sk-test', transport=transport)
+
+        async def acquire():
+            async with provider.slot():
+                await asyncio.sleep(0)
+            return provider._async_client
+
+        first = asyncio.run(acquire())
+        second = asyncio.run(acquire())
+        self.assertIsNot(first, second)
+        self.assertTrue(first.is_closed())
+        self.assertFalse(second.is_closed())
+
+
+class VectorIndexTests(SimpleTestCase):
+    def test_search_finds_nearest_and_skips_duplicates(self):
+        embedder = HashingEmbedder()
+        texts = ['red apples and pears', 'database connection pool', 'streaming server sent events']
+        index = VectorIndex(embedder.dim)
+        index.add([1, 2, 3], embedder.embed(texts))
+        index.add([2], embedder.embed(['duplicate']))
+        self.assertEqual(index.size, 3)
+        query = embedder.embed(['connection pool for the database'])[0]
+        for mode in ('exact', 'lsh'):
+            self.assertEqual(index.search(query, 1, mode=mode)[0][0], 2)
+        self.assertNotIn(2, [message_id for message_id, _ in index.search(query, 3, exclude=[2])])
+
+
+class GatedProvider(FakeProvider):
+    """收到 gate 之前不输出, 让生成保持进行中"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.gate = asyncio.Event()
+
+    async def _stream(self, model, messages, usage=None):
+        await self.gate.wait()
+        async for text in super()._stream(model, messages, usage):
+            yield text
+
+
+@override_settings(CHAT_THROTTLE={'USER_RATE': None, 'MAX_STREAMS': 2})
+class ChatViewTestCase(TestCase):
+    """ChatView 的测试: FakeProvider 代替上游, 消息不落库, 每个测试独立的生成表和限流计数"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('stream-user', password='password')
+        cls.room = Room.objects.create(user=cls.user, name='room')
+
+    def setUp(self):
+        self.token = str(AccessToken.for_user(self.user))
+        self.provider = FakeProvider('test')
+        self.saved = []
+        for patch in (
+            mock.patch.object(views, 'get_provider_for_model', lambda model: self.provider),
+            mock.patch.object(views.ChatView, 'save_message', lambda view, *args: self.saved.append(args)),
+            mock.patch.object(metrics, 'start', lambda: None),
+            mock.patch.object(generations, 'items', {}),
+            mock.patch.object(throttling, '_store', None),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def post(self, client, content, **headers):
+        return client.post('/chat/index?model=fake-test', {'content': content, 'room': self.room.id},
+                           content_type='application/json',
+                           headers={'Authorization': f'Bearer {self.token}', **headers})
+
+    async def read(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+
+class ChatStreamTests(ChatViewTestCase):
+    async def test_asgi_stream(self):
+        response = await self.post(self.async_client, 'hello streaming world')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = parse_events(await self.read(response))
+        self.assertEqual(events[0]['event'], 'generation')
+        self.assertEqual(response['X-Generation-Id'], events[0]['data']['id'])
+        text = content_of(events)
+        self.assertEqual(text, 'echo: hello streaming world ')
+        self.assertEqual(events[-1]['event'], 'done')
+        self.assertEqual(events[-1]['data']['length'], len(text))
+        self.assertEqual(len(self.saved), 1)
+
+    def test_wsgi_streams_while_generating(self):
+        # WSGI 下响应是同步迭代器, 生成还没结束就能读到前面的帧
+        self.provider = GatedProvider('test')
+        response = self.post(self.client, 'hello wsgi')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.is_async)
+        frames = iter(response.streaming_content)
+        self.assertEqual(parse_events(next(frames))[0]['event'], 'generation')
+        self.assertFalse(generations.get(response['X-Generation-Id'], self.user.id).done)
+
+        get_background_loop().call_soon_threadsafe(self.provider.gate.set)
+        events = parse_events(b''.join(frames))
+        self.assertEqual(content_of(events), 'echo: hello wsgi ')
+        self.assertEqual(events[-1]['event'], 'done')
+        self.assertEqual(len(self.saved), 1)
+
+    def test_missing_room(self):
+        response = self.client.post('/chat/index?model=fake-test', {'content': 'hi', 'room': 0},
+                                    content_type='application/json',
+                                    headers={'Authorization': f'Bearer {self.token}'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_wsgi_export_is_a_sync_stream(self):
+        Message.objects.create(room=self.room, user=self.user, content='exported', role='user', model='m',
+                               date_time='')
+        response = self.client.get('/chat/export', headers={'Authorization': f'Bearer {self.token}'})
+        self.assertFalse(response.is_async)
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(json.loads(lines[-1])['content'], 'exported')
+
+    async def test_asgi_export_streams_ndjson(self):
+        await Message.objects.acreate(room=self.room, user=self.user, content='streamed', role='user', model='m',
+                                      date_time='')
+        response = await self.async_client.get('/chat/export', headers={'Authorization': f'Bearer {self.token}'})
+        self.assertTrue(response.is_async)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = (await self.read(response)).splitlines()
+        self.assertEqual(json.loads(lines[-1])['content'], 'streamed')
+
+
+class StreamLeaseTests(ChatViewTestCase):
+    def leases(self):
+        return len(throttling.get_store().streams.get(f'user:{self.user.pk}', {}))
+
+    async def test_lease_held_until_generation_finishes(self):
+        self.provider = GatedProvider('test')
+        first = await self.post(self.async_client, 'first')
+        second = await self.post(self.async_client, 'second')
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual(self.leases(), 2)
+        # 名额用完
+        self.assertEqual((await self.post(self.async_client, 'third')).status_code, 429)
+
+        self.provider.gate.set()
+        await self.read(first)
+        await self.read(second)
+        self.assertEqual(self.leases(), 0)
+        third = await self.post(self.async_client, 'third')
+        self.assertEqual(third.status_code, 200)
+        await self.read(third)
+        self.assertEqual(self.leases(), 0)
+
+    async def test_disconnected_client_releases_lease(self):
+        # 响应一个字节都没读, 生成照常完成并归还名额
+        response = await self.post(self.async_client, 'nobody reads this')
+        self.assertEqual(response.status_code, 200)
+        generation = generations.get(response['X-Generation-Id'], self.user.id)
+        await generation.task
+        self.assertEqual(self.leases(), 0)
+        self.assertEqual(len(self.saved), 1)
+
+    def test_denied_request_does_not_take_later_throttles(self):
+        config = {'USER_RATE': '1/min', 'MODEL_RATES': {'fake-*': '5/min'}, 'MAX_STREAMS': 2}
+        with override_settings(CHAT_THROTTLE=config), \
+                mock.patch.object(throttling.ConcurrentStreamThrottle, 'allow_request', return_value=True) as streams:
+            self.assertEqual(self.post(self.client, 'first').status_code, 200)
+            self.assertEqual(self.post(self.client, 'second').status_code, 429)
+        tokens, _ = throttling.get_store().buckets[f'model:{self.user.pk}:fake-test']
+        self.assertLess(tokens, 5)
+        self.assertGreater(tokens, 3.9)
+        self.assertEqual(streams.call_count, 1)
+
+
+class GenerationViewTests(ChatViewTestCase):
+    async def test_generation_starts_on_request_loop(self):
+        # 同步视图在线程里运行, 生成交给请求所在的事件循环, 不等客户端开始读
+        response = await self.post(self.async_client, 'start right away')
+        generation = generations.get(response['X-Generation-Id'], self.user.id)
+        await asyncio.sleep(0)
+        self.assertIsNotNone(generation.task)
+        await self.read(response)
+
+    async def test_resume_from_last_event_id(self):
+        response = await self.post(self.async_client, 'hello streaming world')
+        events = parse_events(await self.read(response))
+        generation_id = events[0]['data']['id']
+        text = content_of(events)
+        self.assertEqual(len(self.saved), 1)
+
+        # 断线重连: 从 Last-Event-ID 的偏移量继续
+        response = await self.async_client.get(f'/chat/generation/{generation_id}', headers={
+            'Authorization': f'Bearer {self.token}', 'Last-Event-ID': '6'})
+        events = parse_events(await self.read(response))
+        self.assertEqual(content_of(events), text[6:])
+        self.assertEqual(events[-1]['id'], str(len(text)))
+
+        # 重试同一个问题并带上偏移量时接入已完成的生成, 不再请求上游
+        response = await self.post(self.async_client, 'hello streaming world', **{'Last-Event-ID': '12'})
+        events = parse_events(await self.read(response))
+        self.assertEqual(events[0]['data']['id'], generation_id)
+        self.assertEqual(content_of(events), text[12:])
+        self.assertEqual(len(self.saved), 1)
+
+    async def test_unknown_generation(self):
+        response = await self.async_client.get('/chat/generation/missing',
+                                               headers={'Authorization': f'Bearer {self.token}'})
+        self.assertEqual(response.status_code, 404)
+
+
+class ApiTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('api-user', password='password')
+        cls.room = Room.objects.create(user=cls.user, name='room')
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.user)}'
+
+    def add_messages(self, room, contents, **fields):
+        return [Message.objects.create(room=room, user=room.user, content=content, role='user',
+                                       model='gpt-4o-mini', date_time='', **fields) for content in contents]
+
+
+class MessageTokensTests(ApiTestCase):
+    def test_tokens_follow_content(self):
+        message = self.add_messages(self.room, ['hi'])[0]
+        self.assertEqual(message.tokens, count_tokens('hi', message.model))
+        message = Message.objects.get(id=message.id)
+        message.content = 'a much longer message than before'
+        message.save()
+        self.assertEqual(Message.objects.get(id=message.id).tokens, count_tokens(message.content, message.model))
+        message.content = 'x'
+        message.save(update_fields=['content'])
+        self.assertEqual(Message.objects.get(id=message.id).tokens, count_tokens('x', message.model))
+
+    def test_precomputed_tokens_are_kept(self):
+        message = self.add_messages(self.room, ['hi'], tokens=42)[0]
+        self.assertEqual(Message.objects.get(id=message.id).tokens, 42)
+
+
+@override_settings(CHAT_CONTEXT_BUDGETS={'default': 3 * (10 + MESSAGE_OVERHEAD) + 5})
+class ContextBudgetTests(ApiTestCase):
+    def test_newest_messages_within_budget(self):
+        self.add_messages(self.room, [f'message {i}' for i in range(5)], tokens=10)
+        context = build_context(self.room.id, 'gpt-4o-mini')
+        self.assertEqual([m['content'] for m in context], ['message 2', 'message 3', 'message 4'])
+
+    def test_reserved_tokens_shrink_window(self):
+        self.add_messages(self.room, [f'message {i}' for i in range(5)], tokens=10)
+        context = build_context(self.room.id, 'gpt-4o-mini', reserved=10 + MESSAGE_OVERHEAD)
+        self.assertEqual([m['content'] for m in context], ['message 3', 'message 4'])
+
+    def test_window_stops_at_first_message_that_does_not_fit(self):
+        # 放不下的那条之前的更早消息也不要, 上下文保持连续
+        self.add_messages(self.room, ['old'], tokens=1)
+        self.add_messages(self.room, ['huge'], tokens=1000)
+        self.add_messages(self.room, ['new'], tokens=10)
+        self.assertEqual([m['content'] for m in build_context(self.room.id, 'gpt-4o-mini')], ['new'])
+
+    def test_legacy_rows_without_tokens_are_counted(self):
+        message = self.add_messages(self.room, ['legacy row'])[0]
+        Message.objects.filter(id=message.id).update(tokens=0)
+        self.assertEqual(build_context(self.room.id, 'gpt-4o-mini'), [{'role': 'user', 'content': 'legacy row'}])
+
+
+@override_settings(CHAT_CONTEXT_BUDGETS={'default': 400}, CHAT_RETRIEVAL={'ENABLED': True, 'BUDGET_RATIO': 0.25})
+class RecallTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        for patch in (
+            mock.patch.object(retrieval, '_embedder', None),
+            mock.patch.object(retrieval, '_registry', None),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.add_messages(self.room, ['the database connection pool is exhausted'], tokens=10)
+        self.add_messages(self.room, [f'filler {i}' for i in range(40)], tokens=10)
+
+    def load(self):
+        retrieval.embed_room(self.room.id)
+        config = retrieval.get_config()
+        retrieval.get_registry().get('room', self.room.id, retrieval.get_embedder(), config['LSH_BITS'])
+
+    def test_unloaded_index_is_loaded_in_background(self):
+        with mock.patch.object(retrieval, 'schedule_load') as schedule_load:
+            context = build_context(self.room.id, 'gpt-4o-mini', query='database connection pool')
+        schedule_load.assert_called_once_with('room', self.room.id)
+        self.assertEqual(context[0]['role'], 'user')
+
+    def test_recall_is_capped_by_budget_ratio(self):
+        self.load()
+        context = build_context(self.room.id, 'gpt-4o-mini', query='database connection pool')
+        self.assertEqual(context[0]['role'], 'system')
+        self.assertIn('the database connection pool is exhausted', context[0]['content'])
+        recalled = count_tokens(context[0]['content']) + MESSAGE_OVERHEAD
+        self.assertLessEqual(recalled, 100)
+        window = len(context) - 1
+        self.assertEqual(window, (400 - recalled) // (10 + MESSAGE_OVERHEAD))
+
+        with self.settings(CHAT_RETRIEVAL={'ENABLED': True, 'BUDGET_RATIO': 0.01}):
+            context = build_context(self.room.id, 'gpt-4o-mini', query='database connection pool')
+        self.assertEqual(context[0]['role'], 'user')
+        self.assertEqual(len(context), 400 // (10 + MESSAGE_OVERHEAD))
+
+    def test_window_messages_are_not_recalled(self):
+        self.add_messages(self.room, ['database connection pool again'], tokens=10)
+        self.load()
+        context = build_context(self.room.id, 'gpt-4o-mini', query='database connection pool')
+        self.assertEqual(context[-1]['content'], 'database connection pool again')
+        self.assertNotIn('database connection pool again', context[0]['content'])
+        self.assertIn('the database connection pool is exhausted', context[0]['content'])
+
+    def test_messages_written_during_a_run_are_scheduled_again(self):
+        submitted = []
+
+        def embed_room(room_id):
+            # 计算过程中又写入了新消息
+            retrieval.schedule_embedding(room_id)
+
+        with mock.patch.object(retrieval._executor, 'submit', lambda *args: submitted.append(args)), \
+                mock.patch.object(retrieval, 'embed_room', embed_room), mock.patch.object(retrieval, '_pending', set()):
+            retrieval.schedule_embedding(self.room.id)
+            retrieval.schedule_embedding(self.room.id)
+            self.assertEqual(len(submitted), 1)
+            retrieval._embed(self.room.id)
+            self.assertEqual(len(submitted), 2)
+
+
+class RoomViewTests(ApiTestCase):
+    def test_room_shapes_are_consistent(self):
+        listed = self.client.get('/chat/room/').json()['data']['results'][0]
+        retrieved = self.client.get(f'/chat/room/{self.room.id}/').json()['data']
+        self.assertEqual(listed, retrieved)
+        self.assertNotIn('summary', listed)
+        changes = {'archived_at': timezone.now().isoformat(), 'summary_until': 5}
+        response = self.client.patch(f'/chat/room/{self.room.id}/', changes, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.room.refresh_from_db()
+        self.assertIsNone(self.room.archived_at)
+        self.assertEqual(self.room.summary_until, 0)
+
+
+class FailingSummaryBackend:
+    def summarize(self, summary, messages, model):
+        raise RuntimeError('upstream unavailable')
+
+
+@override_settings(CHAT_CONTEXT_BUDGETS={'default': 1000},
+                   CHAT_SUMMARY={'BACKEND': 'chat.summary.LocalSummaryBackend', 'TRIGGER_TOKENS': 30, 'KEEP_RECENT': 2})
+class SummaryTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        for patch in (
+            mock.patch.object(summary, '_backend', None),
+            mock.patch.object(summary, 'close_old_connections', lambda: None),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_short_history_is_not_summarized(self):
+        self.add_messages(self.room, [f'message {i}' for i in range(4)], tokens=10)
+        self.assertFalse(summary.summarize_room(self.room.id))
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.summary, self.room.summary_until), ('', 0))
+
+    def test_summary_replaces_older_turns(self):
+        messages = self.add_messages(self.room, [f'message {i}' for i in range(10)], tokens=10)
+        self.assertTrue(summary.summarize_room(self.room.id))
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.summary_until, messages[-3].id)
+        self.assertIn('user: message 0', self.room.summary)
+        self.assertIn('user: message 7', self.room.summary)
+        self.assertNotIn('message 8', self.room.summary)
+
+        context = build_context(self.room.id, 'gpt-4o-mini')
+        self.assertEqual(context[0], {'role': 'system', 'content': f'以下是之前对话的摘要:\n{self.room.summary}'})
+        self.assertEqual([m['content'] for m in context[1:]], ['message 8', 'message 9'])
+
+        # 新摘要在旧摘要基础上追加, 不会从头重算
+        self.add_messages(self.room, [f'later {i}' for i in range(4)], tokens=10)
+        self.assertTrue(summary.summarize_room(self.room.id))
+        self.room.refresh_from_db()
+        self.assertTrue(self.room.summary.startswith('user: message 0'))
+        self.assertIn('user: later 1', self.room.summary)
+
+    def test_failing_backend_keeps_full_history(self):
+        self.add_messages(self.room, [f'message {i}' for i in range(10)], tokens=10)
+        with mock.patch.object(summary, '_backend', FailingSummaryBackend()), mock.patch('builtins.print') as log:
+            summary._run(self.room.id)
+        self.assertIn('upstream unavailable', log.call_args[0][0])
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.summary, self.room.summary_until), ('', 0))
+        context = build_context(self.room.id, 'gpt-4o-mini')
+        self.assertEqual([m['content'] for m in context], [f'message {i}' for i in range(10)])
+
+
+class TurnWriterTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        self.spill_path = f'{path}/spill.jsonl'
+        self.writer = TurnWriter({**persistence.get_config(), 'MAX_QUEUE': 1, 'SPILL_PATH': self.spill_path})
+        # 测试里不起写入线程和后台任务, 直接在当前连接上重放
+        for patch in (mock.patch.object(self.writer, 'start', lambda: None),
+                      mock.patch.object(persistence, 'close_old_connections', lambda: None),
+                      mock.patch.object(persistence, 'schedule_summary', lambda room_id: None),
+                      mock.patch.object(persistence, 'schedule_embedding', lambda room_id: None)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def contents(self):
+        return list(Message.objects.filter(room=self.room).order_by('id').values_list('content', flat=True))
+
+    def test_full_queue_spills_and_replays(self):
+        with self.assertNumQueries(0):
+            for i in range(3):
+                self.writer.put(f'question {i}', f'answer {i}', self.room.id, self.user.id, 'gpt-4o-mini', '')
+        self.assertEqual(self.writer.queue.qsize(), 1)
+        self.writer._replay_spill()
+        self.assertEqual(self.contents(), ['question 1', 'answer 1', 'question 2', 'answer 2'])
+        self.assertFalse(os.path.exists(self.spill_path))
+
+    def test_leftover_replay_file_is_replayed(self):
+        # 上次重放到一半进程退出, 只剩下 .replay 文件
+        row = {'room_id': self.room.id, 'user_id': self.user.id, 'model': 'gpt-4o-mini', 'date_time': ''}
+        with open(f'{self.spill_path}.replay', 'w', encoding='utf-8') as f:
+            f.write(json.dumps({**row, 'role': 'user', 'content': 'left over'}) + '\n')
+        self.writer._spill([{**row, 'role': 'user', 'content': 'spilled'}])
+        self.writer._replay_spill()
+        self.assertEqual(self.contents(), ['left over', 'spilled'])
+        self.assertFalse(os.path.exists(f'{self.spill_path}.replay'))
+
+    def test_failed_spill_is_logged(self):
+        # SPILL_PATH 的目录是个文件, 落盘必然失败
+        self.writer.config = {**self.writer.config, 'SPILL_PATH': f'{self.spill_path}/nested/spill.jsonl'}
+        open(self.spill_path, 'w').close()
+        with mock.patch('builtins.print') as log:
+            self.writer._spill([{'content': 'lost'}])
+        self.assertIn('lost 1 messages', log.call_args[0][0])
+
+    def test_writer_survives_write_errors(self):
+        writer = TurnWriter({**persistence.get_config(), 'BATCH_SIZE': 1})
+        self.addCleanup(writer.overflow.shutdown)
+        writer.queue.put([{'content': 'broken'}])
+        writer.queue.put([{'content': 'next'}])
+        writer.queue.put(persistence._STOP)
+        with mock.patch.object(writer, '_write', side_effect=OSError('disk full')) as write, \
+                mock.patch.object(writer, '_replay_spill'), mock.patch('builtins.print') as log:
+            writer._run()
+        self.assertEqual(write.call_count, 2)
+        self.assertIn('disk full', log.call_args[0][0])
+        self.assertEqual(writer.queue.unfinished_tasks, 0)
+
+    def test_overflow_without_spill_path_uses_bounded_pool(self):
+        writer = TurnWriter({**persistence.get_config(), 'MAX_QUEUE': 1, 'SPILL_PATH': None, 'OVERFLOW_WORKERS': 1})
+        self.addCleanup(writer.overflow.shutdown)
+        with mock.patch.object(writer, 'start', lambda: None), mock.patch.object(writer, '_write') as write:
+            for i in range(3):
+                writer.put(f'question {i}', f'answer {i}', self.room.id, self.user.id, 'gpt-4o-mini', '')
+            writer.overflow.shutdown()
+        self.assertEqual(write.call_count, 2)
+        self.assertEqual(len(writer.overflow._threads), 1)
+
+
+class CursorPaginationTests(ApiTestCase):
+    def test_messages_page_backwards_by_id(self):
+        messages = self.add_messages(self.room, [f'message {i}' for i in range(5)])
+        url = f'/chat/message/?room={self.room.id}&page_size=2'
+        pages = []
+        while url:
+            data = self.client.get(url).json()['data']
+            self.assertNotIn('count', data)
+            pages.append([item['id'] for item in data['results']])
+            url = data['next']
+        ids = [message.id for message in reversed(messages)]
+        self.assertEqual(pages, [ids[:2], ids[2:4], ids[4:]])
+
+    def test_message_previous_page(self):
+        self.add_messages(self.room, [f'message {i}' for i in range(4)])
+        first = self.client.get(f'/chat/message/?room={self.room.id}&page_size=2').json()['data']
+        second = self.client.get(first['next']).json()['data']
+        previous = self.client.get(second['previous']).json()['data']
+        self.assertEqual(previous['results'], first['results'])
+
+    def test_rooms_switch_to_cursor_on_request(self):
+        for i in range(4):
+            Room.objects.create(user=self.user, name=f'room {i}')
+        data = self.client.get('/chat/room/?page_size=2').json()['data']
+        self.assertEqual(data['count'], 5)
+
+        url, seen = '/chat/room/?pagination=cursor&page_size=2', []
+        while url:
+            data = self.client.get(url).json()['data']
+            self.assertNotIn('count', data)
+            seen += [item['id'] for item in data['results']]
+            url = data['next']
+        self.assertEqual(sorted(seen), sorted(Room.objects.values_list('id', flat=True)))
+
+
+class CategorizedOlderTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        old = timezone.now() - timedelta(days=60)
+        for i in range(3):
+            room = Room.objects.create(user=self.user, name=f'old {i}')
+            # create_time 是 auto_now_add, 只能建好后再改
+            Room.objects.filter(id=room.id).update(create_time=old - timedelta(hours=i))
+
+    def names(self, limit):
+        data = self.client.get(f'/chat/room/categorized/older/?limit={limit}').json()['data']
+        return [room['name'] for group in data['groups'] for room in group['data']]
+
+    def test_limit_is_clamped(self):
+        self.assertEqual(self.names(0), ['old 0'])
+        self.assertEqual(self.names(-5), ['old 0'])
+        self.assertEqual(self.names(2), ['old 0', 'old 1'])
+        self.assertEqual(self.names(1000), ['old 0', 'old 1', 'old 2'])
+
+    def test_non_integer_limit_is_rejected(self):
+        response = self.client.get('/chat/room/categorized/older/?limit=abc')
+        self.assertEqual(response.status_code, 400)
+
+
+class CompletionCacheTests(SimpleTestCase):
+    messages = [{'role': 'system', 'content': 'be brief'}, {'role': 'user', 'content': 'Translate this!'}]
+
+    def test_exact_and_normalized_hits(self):
+        cache = CompletionCache()
+        self.assertIsNone(cache.get('m', self.messages))
+        cache.set('m', self.messages, 'answer')
+        self.assertEqual(cache.get('m', self.messages), 'answer')
+        similar = [self.messages[0], {'role': 'user', 'content': '  translate   THIS '}]
+        self.assertEqual(cache.get('m', similar), 'answer')
+        self.assertIsNone(cache.get('other-model', self.messages))
+        self.assertIsNone(cache.get('m', [self.messages[0], {'role': 'user', 'content': 'translate that'}]))
+        stats = cache.stats()
+        self.assertEqual((stats['hits_exact'], stats['hits_normalized'], stats['misses']), (1, 1, 3))
+        self.assertEqual(stats['hit_rate'], 0.4)
+
+    def test_entries_expire_and_are_evicted(self):
+        cache = CompletionCache(max_entries=1, ttl=10)
+        with mock.patch('chat.completion_cache.time.monotonic', return_value=100):
+            cache.set('m', self.messages, 'answer')
+        with mock.patch('chat.completion_cache.time.monotonic', return_value=111):
+            self.assertIsNone(cache.get('m', self.messages))
+        cache.set('m', self.messages, 'first')
+        cache.set('m', [{'role': 'user', 'content': 'second'}], 'second')
+        self.assertIsNone(cache.get('m', self.messages))
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+
+class CompletionCacheViewTests(ChatViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = CompletionCache()
+        patch = mock.patch.object(views, 'completion_cache', self.cache)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def ask(self, content, cache='1'):
+        response = await self.async_client.post(
+            f'/chat/index?model=fake-test&cache={cache}', {'content': content, 'room': self.room.id},
+            content_type='application/json', headers={'Authorization': f'Bearer {self.token}'})
+        return content_of(parse_events(await self.read(response)))
+
+    async def test_second_request_is_served_from_cache(self):
+        self.assertEqual(await self.ask('hello cache'), 'echo: hello cache ')
+        self.provider.prefix = 'changed: '
+        self.assertEqual(await self.ask('Hello   cache!'), 'echo: hello cache ')
+        self.assertEqual(self.cache.stats()['hits_normalized'], 1)
+        # 没开缓存的请求照常请求上游
+        self.assertEqual(await self.ask('hello cache', cache='0'), 'changed: hello cache ')
+        self.assertEqual(self.cache.stats()['stores'], 1)
+
+
+class ScoreSerializer(serializers.Serializer):
+    name = serializers.CharField()
+    score = serializers.FloatField()
+
+
+class RendererTests(SimpleTestCase):
+    def render(self, renderer_class, data, status=200, media_type='application/json'):
+        return renderer_class().render(data, media_type, {'response': Response(status=status)})
+
+    def assertSameOutput(self, data, **kwargs):
+        expected = self.render(PublicRenderer, data, **kwargs)
+        self.assertEqual(self.render(FastPublicRenderer, data, **kwargs), expected)
+        return expected
+
+    def test_output_matches_json_renderer(self):
+        self.assertSameOutput({
+            'text': '中文 "quoted" \\ \n tab\t',
+            'separators': 'line\u2028paragraph\u2029end',
+            'time': timezone.now(),
+            'date': timezone.now().date(),
+            'decimal': Decimal('1.10'),
+            'uuid': uuid.uuid4(),
+            'lazy': gettext_lazy('hello'),
+            'numbers': [0, -1, 2 ** 63, 0.1, 1.0, -0.0, 123456789.123],
+            'nested': {1: [None, True, False], 'set': {3}, 'tuple': (1, 2)},
+        })
+        self.assertSameOutput({'message': 'error'}, status=400)
+        self.assertSameOutput([])
+
+    def test_line_separators_are_escaped(self):
+        body = self.assertSameOutput({'text': '\u2028\u2029'})
+        self.assertIn(b'\\u2028\\u2029', body)
+
+    def test_floats_orjson_formats_differently(self):
+        self.assertSameOutput({'values': [1e16, 1.5e-7, 1e300, None]})
+        self.assertSameOutput({'text': '1e5 in a string', 'value': None})
+        self.assertSameOutput({'big': 2 ** 70})
+        # 序列化器输出里的浮点数字段照样检查
+        scores = ScoreSerializer([{'name': 'a', 'score': 1e20}, {'name': 'b', 'score': 0.5}], many=True).data
+        self.assertSameOutput({'results': scores})
+
+    def test_non_finite_floats_are_rejected_like_json_renderer(self):
+        for value in (float('nan'), float('inf')):
+            with self.assertRaises(ValueError):
+                self.render(PublicRenderer, {'value': [value]})
+            with self.assertRaises(ValueError):
+                self.render(FastPublicRenderer, {'value': [value]})
+
+    def test_indent_uses_standard_renderer(self):
+        self.assertSameOutput({'a': [1, 2]}, media_type='application/json; indent=2')
+
+
+class BulkRoomTests(ApiTestCase):
+    def bulk(self, operations):
+        return self.client.post('/chat/room/bulk/', operations, content_type='application/json')
+
+    def test_mixed_operations(self):
+        first, second = (Room.objects.create(user=self.user, name=f'room {i}') for i in range(2))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.bulk({'operations': [
+                {'op': 'create', 'name': 'new room'},
+                {'op': 'rename', 'id': first.id, 'name': 'renamed'},
+                {'op': 'check', 'id': first.id, 'checked': True},
+                {'op': 'rename', 'id': second.id, 'name': 'ignored'},
+                {'op': 'delete', 'ids': [second.id]},
+            ]})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()['data']
+        self.assertEqual([room['name'] for room in data['created']], ['new room'])
+        self.assertEqual((data['updated'], data['deleted']), ([first.id], [second.id]))
+        first.refresh_from_db()
+        self.assertEqual((first.name, first.checked), ('renamed', True))
+        self.assertFalse(Room.objects.filter(id=second.id).exists())
+        self.assertTrue(Room.objects.filter(id=data['created'][0]['id'], user=self.user, name='new room').exists())
+
+    def test_other_users_rooms_are_rejected(self):
+        other = User.objects.create_user('other-user', password='password')
+        room = Room.objects.create(user=other, name='theirs')
+        response = self.bulk([{'op': 'create', 'name': 'new room'}, {'op': 'delete', 'ids': [room.id]}])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['data']['ids'], [room.id])
+        self.assertTrue(Room.objects.filter(id=room.id).exists())
+        self.assertFalse(Room.objects.filter(name='new room').exists())
+
+    def test_invalid_operations(self):
+        self.assertEqual(self.bulk({'op': 'create'}).status_code, 400)
+        self.assertEqual(self.bulk([{'op': 'rename', 'name': 'no id'}]).status_code, 400)
+        self.assertEqual(self.bulk([{'op': 'create', 'name': 'x'}] * 501).status_code, 400)
+
+    def test_query_count_does_not_grow_with_batch(self):
+        def operations(count):
+            rooms = [Room.objects.create(user=self.user, name=f'room {i}') for i in range(count)]
+            return ([{'op': 'create', 'name': f'new {i}'} for i in range(count)]
+                    + [{'op': 'rename', 'id': room.id, 'name': 'renamed'} for room in rooms[:count // 2]]
+                    + [{'op': 'delete', 'ids': [room.id for room in rooms[count // 2:]]}])
+
+        queries = []
+        for count in (2, 10):
+            body = operations(count)
+            with CaptureQueriesContext(connection) as captured:
+                self.assertEqual(self.bulk(body).status_code, 200)
+            # 认证用户可能来自缓存, 只数房间相关的语句
+            queries.append(len([query for query in captured.captured_queries if '"chat_' in query['sql']]))
+        self.assertEqual(queries[0], queries[1])
+
+
+class ThrottleStoreTests(SimpleTestCase):
+    def test_local_bucket_refills(self):
+        store = throttling.LocalStore({})
+        with mock.patch('chat.throttling.time.monotonic', return_value=100):
+            self.assertEqual([store.take('k', 2, 1) for _ in range(3)], [0, 0, 1])
+        with mock.patch('chat.throttling.time.monotonic', return_value=100.5):
+            self.assertEqual(store.take('k', 2, 1), 0.5)
+        with mock.patch('chat.throttling.time.monotonic', return_value=102):
+            self.assertEqual(store.take('k', 2, 1), 0)
+
+    def test_local_leases(self):
+        store = throttling.LocalStore({})
+        first = store.acquire('k', 1, 60)
+        self.assertIsNone(store.acquire('k', 1, 60))
+        store.release('k', first)
+        self.assertIsNotNone(store.acquire('k', 1, 60))
+        with mock.patch('chat.throttling.time.monotonic', return_value=time.monotonic() + 61):
+            # 过期的名额不再占用
+            self.assertIsNotNone(store.acquire('k', 1, 60))
+
+    def test_cache_store_window(self):
+        store = throttling.CacheStore({'CACHE': 'default'})
+        store.cache.clear()
+        with mock.patch('chat.throttling.time.time', return_value=600.0):
+            self.assertEqual([store.take('k', 2, 2 / 60) for _ in range(3)], [0, 0, 60])
+        with mock.patch('chat.throttling.time.time', return_value=660.0):
+            self.assertEqual(store.take('k', 2, 2 / 60), 0)
+
+    def test_cache_store_leases_refresh_ttl(self):
+        store = throttling.CacheStore({'CACHE': 'default'})
+        store.cache.clear()
+        with mock.patch.object(store.cache, 'touch', wraps=store.cache.touch) as touch:
+            first = store.acquire('k', 2, 60)
+            second = store.acquire('k', 2, 60)
+            self.assertIsNone(store.acquire('k', 2, 60))
+        self.assertEqual(touch.call_count, 2)
+        self.assertEqual(store.cache.get(first), 2)
+        store.release(first, first)
+        self.assertIsNotNone(store.acquire('k', 2, 60))
+        store.release(second, second)
+
+    def test_model_throttle_does_not_query_default_model(self):
+        request = mock.Mock(query_params={}, user=mock.Mock(pk=1))
+        throttle = throttling.ModelRateThrottle()
+        with override_settings(CHAT_THROTTLE={'MODEL_RATES': {'gpt-4*': '1/min'}}, CHAT_DEFAULT_MODEL='gpt-4o'), \
+                mock.patch('chat.providers.cache.get', return_value=None), mock.patch.object(throttling, '_store', None):
+            self.assertTrue(throttle.allow_request(request, None))
+            self.assertFalse(throttle.allow_request(request, None))
+        self.assertEqual(throttle.model, 'gpt-4o')
+
+
+class MetricsTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.recorder = MetricsRecorder({'FLUSH_INTERVAL': 30, 'TOKEN': 'scrape', 'BUCKETS': (0.5, 1, 5)})
+        for patch in (mock.patch.object(self.recorder, 'start', lambda: None),
+                      mock.patch('chat.metrics.close_old_connections', lambda: None)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def trace(self, model, ttft=None, duration=2.0, chunks=3, cached=False):
+        trace = CompletionTrace(model, self.user.id, cached)
+        trace.started = 100.0
+        trace.first = None if ttft is None else 100.0 + ttft
+        trace.finished = 100.0 + duration
+        trace.chunks = chunks
+        return trace
+
+    def test_records_are_aggregated_per_hour(self):
+        self.recorder.record(self.trace('m', ttft=0.3), {'prompt_tokens': 10, 'completion_tokens': 5})
+        self.recorder.record(self.trace('m', ttft=0.8, cached=True), {'prompt_tokens': 7}, error='boom')
+        self.recorder.flush()
+        self.recorder.record(self.trace('m', ttft=0.1), {'completion_tokens': 1})
+        self.recorder.flush()
+        stat = CompletionStat.objects.get(user=self.user, model='m')
+        self.assertEqual((stat.requests, stat.errors, stat.cached, stat.chunks), (3, 1, 1, 9))
+        self.assertEqual((stat.prompt_tokens, stat.completion_tokens), (17, 6))
+        self.assertEqual((stat.ttft_ms, stat.ttft_ms_max, stat.duration_ms), (1200, 800, 6000))
+        self.assertEqual(self.recorder.pending, {})
+
+    def test_prometheus_text(self):
+        self.recorder.record(self.trace('m', ttft=0.3), {'prompt_tokens': 10, 'completion_tokens': 5})
+        self.recorder.record(self.trace('m', ttft=2), {}, error='boom')
+        self.recorder.record(self.trace('m'), {})
+        lines = self.recorder.render().splitlines()
+        for line in (
+            'chat_completions_total{model="m",status="ok"} 2',
+            'chat_completions_total{model="m",status="error"} 1',
+            'chat_completion_tokens_total{model="m",type="prompt"} 10',
+            'chat_completion_ttft_seconds_bucket{model="m",le="0.5"} 1',
+            'chat_completion_ttft_seconds_bucket{model="m",le="1"} 1',
+            'chat_completion_ttft_seconds_bucket{model="m",le="+Inf"} 2',
+            'chat_completion_ttft_seconds_count{model="m"} 2',
+            'chat_completion_duration_seconds_bucket{model="m",le="5"} 3',
+            'chat_completion_duration_seconds_sum{model="m"} 6.0',
+            '# TYPE chat_completion_duration_seconds histogram',
+        ):
+            self.assertIn(line, lines)
+
+    def test_endpoint_requires_token_or_staff(self):
+        with mock.patch.object(views, 'metrics', self.recorder), \
+                override_settings(CHAT_METRICS={'TOKEN': 'scrape'}):
+            self.assertEqual(self.client.get('/chat/metrics').status_code, 403)
+            response = self.client.get('/chat/metrics', headers={'X-Metrics-Token': 'scrape'})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+            self.assertIn(b'# TYPE chat_completions_total counter', response.content)
+            self.user.is_staff = True
+            self.user.save()
+            self.assertEqual(self.client.get('/chat/metrics').status_code, 200)
+
+
+class ProfilingTests(ApiTestCase):
+    def test_limit_is_validated(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(self.client.get('/profiling/?limit=5').status_code, 200)
+        for limit in ('abc', '0', '-1', '1.5'):
+            self.assertEqual(self.client.get(f'/profiling/?limit={limit}').status_code, 400)
+
+    def test_serializer_timing_only_while_enabled(self):
+        original = serializers.BaseSerializer.data
+        with self.settings(PROFILING={'ENABLED': True, 'PATH': tempfile.gettempdir()}):
+            profiling.ProfilingMiddleware(lambda request: None)
+            self.assertIsNot(serializers.BaseSerializer.data, original)
+            # 重复加载中间件不会把已替换的再包一层
+            profiling.ProfilingMiddleware(lambda request: None)
+            self.assertEqual(ScoreSerializer({'name': 'a', 'score': 1}).data, {'name': 'a', 'score': 1.0})
+        self.assertIs(serializers.BaseSerializer.data, original)
+
+
+class SearchTests(ApiTestCase):
+    def search(self, query):
+        return self.client.get(f'/chat/message/search/?{query}').json()['data']['results']
+
+    def test_search_hits_use_local_time(self):
+        message, _ = self.add_messages(self.room, ['hello search world', 'unrelated'])
+        data = self.client.get('/chat/message/search/?q=search').json()['data']
+        self.assertEqual([hit['id'] for hit in data['results']], [message.id])
+        listed = self.client.get(f'/chat/message/{message.id}/').json()['data']
+        self.assertEqual(data['results'][0]['create_time'], listed['create_time'])
+
+    def test_all_terms_must_match_in_own_rooms(self):
+        other_room = Room.objects.create(user=self.user, name='other')
+        stranger = User.objects.create_user('stranger', password='password')
+        both, _ = self.add_messages(self.room, ['database pool exhausted', 'database is fine'])
+        elsewhere, = self.add_messages(other_room, ['the pool of the database'])
+        self.add_messages(Room.objects.create(user=stranger, name='theirs'), ['database pool'])
+        self.assertEqual(sorted(hit['id'] for hit in self.search('q=database pool')), [both.id, elsewhere.id])
+        self.assertEqual([hit['id'] for hit in self.search(f'q=database pool&room={other_room.id}')],
+                         [elsewhere.id])
+        self.assertEqual(len(self.search('q=database&limit=1')), 1)
+
+    def test_snippet_around_first_hit(self):
+        self.add_messages(self.room, ['x' * 100 + ' needle ' + 'y' * 100])
+        snippet = self.search('q=needle')[0]['snippet']
+        self.assertIn('needle', snippet)
+        self.assertTrue(snippet.startswith('…') and snippet.endswith('…'))
+        self.assertLess(len(snippet), 100)
+
+    def test_search_requires_query(self):
+        self.assertEqual(self.client.get('/chat/message/search/').status_code, 400)
+        self.assertEqual(self.client.get('/chat/message/search/?q=x&limit=abc').status_code, 400)
+
+
+class TransferTests(ApiTestCase):
+    def test_bulk_create_rooms_without_returning_ids(self):
+        # MySQL 的 bulk_create 拿不到自增 id
+        other = Room.objects.create(user=self.user, name='other')
+        features = type(connection.features)
+        with mock.patch.object(features, 'can_return_rows_from_bulk_insert', False), transaction.atomic():
+            rooms = Room.bulk_create_for_user(self.user, [Room(user=self.user, name=f'new {i}') for i in range(3)])
+        self.assertEqual([Room.objects.get(id=room.id).name for room in rooms], ['new 0', 'new 1', 'new 2'])
+        self.assertNotIn(other.id, [room.id for room in rooms])
+
+    def test_export_import_round_trip(self):
+        self.add_messages(self.room, ['one', 'two'])
+        lines = b''.join(export_ndjson(self.user, chunk_size=1)).decode().splitlines()
+        self.assertEqual([json.loads(line)['type'] for line in lines], ['meta', 'room', 'message', 'message'])
+
+        other = User.objects.create_user('importer')
+        counts = Importer(other, batch_size=1).run(lines)
+        self.assertEqual(counts, {'rooms': 1, 'messages': 2, 'skipped': 0})
+        room = Room.objects.get(user=other)
+        # 导出的时间精确到毫秒
+        self.assertLess(abs(room.create_time - self.room.create_time), timedelta(milliseconds=1))
+        self.assertEqual(list(Message.objects.filter(room=room).order_by('id').values_list('content', 'tokens')),
+                         list(Message.objects.filter(room=self.room).order_by('id').values_list('content', 'tokens')))
+
+    def upload(self, *records):
+        lines = [record if isinstance(record, str) else json.dumps(record) for record in records]
+        upload = SimpleUploadedFile('history.ndjson', '\n'.join(lines).encode(), 'application/x-ndjson')
+        return self.client.post('/chat/import', {'file': upload})
+
+    def test_import_reports_bad_line(self):
+        response = self.upload(
+            {'type': 'meta', 'version': 1},
+            {'type': 'room', 'id': 7, 'name': 'imported'},
+            {'type': 'message', 'room': 7, 'role': 'user', 'content': 'kept'},
+            '{not json',
+        )
+        self.assertEqual(response.status_code, 400)
+        data = response.json()['data']
+        self.assertEqual(data['line'], 4)
+        self.assertEqual(data['imported']['rooms'], 1)
+        self.assertTrue(Room.objects.filter(user=self.user, name='imported').exists())
+
+    def test_import_rejects_unknown_record_and_skips_orphans(self):
+        response = self.upload({'type': 'message', 'room': 1, 'role': 'user', 'content': 'orphan'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['data']['skipped'], 1)
+
+        response = self.upload({'type': 'meta'}, {'type': 'bogus'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['data']['line'], 2)
+
+        response = self.upload({'type': 'meta', 'version': 99})
+        self.assertEqual(response.status_code, 400)
+
+    def test_import_requires_file(self):
+        self.assertEqual(self.client.post('/chat/import').status_code, 400)
+
+
+class ArchiveTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        config = override_settings(CHAT_ARCHIVE={'PATH': path, 'BATCH_SIZE': 2})
+        config.enable()
+        self.addCleanup(config.disable)
+        storage = mock.patch.object(archive, '_storage', None)
+        storage.start()
+        self.addCleanup(storage.stop)
+
+    def test_archive_and_restore_on_access(self):
+        messages = self.add_messages(self.room, ['one', 'two', 'three'])
+        original = list(Message.objects.filter(room=self.room).order_by('id').values())
+        self.assertEqual(archive_room(self.room), 3)
+        self.assertFalse(Message.objects.filter(room=self.room).exists())
+        self.room.refresh_from_db()
+        self.assertIsNotNone(self.room.archived_at)
+        self.assertEqual((self.room.archived_first_id, self.room.archived_last_id), (messages[0].id, messages[-1].id))
+        self.assertTrue(archive.get_storage().exists(archive.blob_name(self.room)))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get(f'/chat/message/?room={self.room.id}')
+        self.assertEqual([item['id'] for item in response.json()['data']['results']],
+                         [message.id for message in reversed(messages)])
+        self.assertEqual(list(Message.objects.filter(room=self.room).order_by('id').values()), original)
+        self.room.refresh_from_db()
+        self.assertIsNone(self.room.archived_at)
+        self.assertIsNotNone(self.room.restored_at)
+        self.assertFalse(archive.get_storage().exists(archive.blob_name(self.room)))
+
+    def test_embeddings_deleted_before_messages_in_batches(self):
+        messages = self.add_messages(self.room, ['one', 'two', 'three', 'four', 'five'])
+        for message in messages:
+            MessageEmbedding.objects.create(message=message, room=self.room, user=self.user, vector=b'')
+        other = self.add_messages(Room.objects.create(user=self.user, name='other'), ['kept'])[0]
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(archive_room(self.room), 5)
+        deletes = [query['sql'] for query in queries if query['sql'].startswith('DELETE')]
+        self.assertIn('chat_messageembedding', deletes[0])
+        # BATCH_SIZE=2: 5 条消息分 3 批删, 不把消息读出来级联
+        self.assertEqual(len([sql for sql in deletes if 'chat_message"' in sql]), 3)
+        self.assertFalse(MessageEmbedding.objects.filter(room=self.room).exists())
+        self.assertTrue(Message.objects.filter(id=other.id).exists())
+
+    def test_empty_room_is_not_archived(self):
+        self.assertEqual(archive_room(self.room), 0)
+        self.room.refresh_from_db()
+        self.assertIsNone(self.room.archived_at)
+
+    def test_missing_archive_returns_503(self):
+        message, = self.add_messages(self.room, ['one'])
+        archive_room(self.room)
+        archive.get_storage().delete(archive.blob_name(self.room))
+        self.assertEqual(self.client.get(f'/chat/message/?room={self.room.id}').status_code, 503)
+        self.assertEqual(self.client.get(f'/chat/message/{message.id}/').status_code, 503)
+        self.assertEqual(self.client.get(f'/chat/message/search/?q=one&room={self.room.id}').status_code, 503)
+        with self.assertRaises(ArchiveError):
+            restore_room(self.room.id)
+
+    def test_retrieve_and_search_restore(self):
+        message, _ = self.add_messages(self.room, ['archived needle', 'other'])
+        archive_room(self.room)
+        self.assertEqual(self.client.get(f'/chat/message/{message.id}/').json()['data']['content'],
+                         'archived needle')
+        self.room.refresh_from_db()
+        self.assertIsNone(self.room.archived_at)
+
+        archive_room(self.room)
+        hits = self.client.get(f'/chat/message/search/?q=needle&room={self.room.id}').json()['data']['results']
+        self.assertEqual([hit['id'] for hit in hits], [message.id])
+        self.assertEqual(self.client.get('/chat/message/999999/').status_code, 404)
+
+    def test_export_archived_room_from_blob(self):
+        self.add_messages(self.room, ['one', 'two', 'three'])
+        before = b''.join(export_ndjson(self.user, chunk_size=2))
+        archive_room(self.room)
+        self.assertEqual(b''.join(export_ndjson(self.user, chunk_size=2)), before)
+        # 导出不恢复房间
+        self.room.refresh_from_db()
+        self.assertIsNotNone(self.room.archived_at)
+
+    def test_inactive_rooms(self):
+        long_ago = timezone.now() - timedelta(days=100)
+        old = []
+        for i in range(3):
+            room = Room.objects.create(user=self.user, name=f'old {i}')
+            self.add_messages(room, ['old message'])
+            Message.objects.filter(room=room).update(create_time=long_ago)
+            old.append(room.id)
+        empty = Room.objects.create(user=self.user, name='empty')
+        self.add_messages(self.room, ['recent'])
+        Room.objects.filter(id__in=[*old, empty.id, self.room.id]).update(create_time=long_ago)
+        # 5 个候选房间分 3 页, 每页两次查询: 候选房间, 其中最近有消息的房间
+        with self.assertNumQueries(6):
+            rooms = [room.id for room in inactive_rooms(days=90, chunk=2)]
+        self.assertEqual(rooms, [*old, empty.id])
+        self.assertEqual([room.id for room in inactive_rooms(days=90, after=old[1])], [old[2], empty.id])
+
+
+class FakeConnection:
+    def __init__(self, params=None):
+        self.params = params
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBackend:
+    class Database:
+        class OperationalError(Exception):
+            pass
+
+    def __init__(self, alias, params, pool=None):
+        self.alias = alias
+        self.params = params
+        self.settings_dict = {'POOL': pool or {}}
+
+    def get_new_connection(self, conn_params):
+        return FakeConnection(conn_params)
+
+
+class PooledFakeWrapper(PooledDatabaseWrapperMixin, FakeBackend):
+    def check_pooled(self, conn):
+        return not conn.closed
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def pool(self, **config):
+        return ConnectionPool(lambda conn: conn.close(), config)
+
+    def acquire(self, pool):
+        return pool.acquire(FakeConnection, lambda conn: not conn.closed)
+
+    def test_checkout_and_return(self):
+        pool = self.pool()
+        conn = self.acquire(pool)
+        self.assertEqual(pool.stats(), {'in_use': 1, 'idle': 0, 'peak': 1, 'created': 1})
+        pool.release(conn)
+        self.assertIs(self.acquire(pool), conn)
+        self.assertEqual(pool.stats(), {'in_use': 1, 'idle': 0, 'peak': 1, 'created': 1})
+        # 不可复用(事务中、出过错)的连接关掉, 不放回池里
+        pool.release(conn, reusable=False)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+    def test_size_limit(self):
+        pool = self.pool(MAX_SIZE=1, TIMEOUT=0.05)
+        conn = self.acquire(pool)
+        with self.assertRaises(PoolTimeout):
+            self.acquire(pool)
+        self.assertEqual(pool.stats()['in_use'], 1)
+
+        # 等待中的请求拿到别人还回来的连接
+        pool.config['TIMEOUT'] = 5
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(self.acquire(pool)))
+        waiter.start()
+        time.sleep(0.05)
+        pool.release(conn)
+        waiter.join(5)
+        self.assertEqual(got, [conn])
+        self.assertEqual(pool.stats()['created'], 1)
+
+    def test_max_idle(self):
+        pool = self.pool(MAX_IDLE=1)
+        first, second = self.acquire(pool), self.acquire(pool)
+        pool.release(first)
+        pool.release(second)
+        self.assertEqual(pool.stats()['idle'], 1)
+        self.assertTrue(second.closed)
+
+    def test_broken_idle_connection_replaced(self):
+        pool = self.pool(CHECK_AFTER=0)
+        conn = self.acquire(pool)
+        pool.release(conn)
+        conn.closed = True
+        replacement = self.acquire(pool)
+        self.assertIsNot(replacement, conn)
+        self.assertEqual(pool.stats()['created'], 2)
+
+    def test_wrappers_share_pool_by_alias_with_own_params(self):
+        with mock.patch.dict('chat_ai_service.db._pools', clear=True):
+            first = PooledFakeWrapper('default', {'db': 'first'}, {'MAX_SIZE': 2, 'TIMEOUT': 0})
+            second = PooledFakeWrapper('default', {'db': 'second'}, {'MAX_SIZE': 2, 'TIMEOUT': 0})
+            held = first.get_new_connection(first.params)
+            conn = second.get_new_connection(second.params)
+            self.assertIs(first.pool, second.pool)
+            self.assertIs(get_pool('default'), first.pool)
+            # 新连接用的是借连接的 wrapper 的参数, 不是创建池的那个
+            self.assertEqual((held.params, conn.params), ({'db': 'first'}, {'db': 'second'}))
+            self.assertIsNot(PooledFakeWrapper('replica1', {}).pool, first.pool)
+            with self.assertRaises(FakeBackend.Database.OperationalError):
+                PooledFakeWrapper('default', {}).get_new_connection({})
+            first.pool.release(held)
+            self.assertIs(second.get_new_connection(second.params), held)
+
+
+@override_settings(DATABASE_REPLICAS={'ALIASES': ['replica1'], 'STICKY_SECONDS': 60})
+class ReplicaRoutingTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = ReplicaRouter()
+
+    def test_reads_go_to_replica_only_inside_block(self):
+        self.assertIsNone(self.router.db_for_read(Message))
+        with read_from_replica(1):
+            self.assertEqual(self.router.db_for_read(Message), 'replica1')
+            self.assertEqual(self.router.db_for_write(Message), 'default')
+        self.assertIsNone(self.router.db_for_read(Message))
+
+    def test_writes_pin_user_to_primary(self):
+        pin_primary(1)
+        self.assertIsNone(choose_replica(1))
+        self.assertEqual(choose_replica(2), 'replica1')
+        with read_from_replica(1):
+            self.assertIsNone(self.router.db_for_read(Message))
+
+    def test_pin_switches_current_request_to_primary(self):
+        with read_from_replica(1):
+            self.assertEqual(self.router.db_for_read(Message), 'replica1')
+            pin_primary(1)
+            self.assertIsNone(self.router.db_for_read(Message))
+
+    def test_reads_inside_transaction_use_primary(self):
+        with read_from_replica(1), transaction.atomic():
+            self.assertIsNone(self.router.db_for_read(Message))
+
+    def test_successful_write_request_pins_user(self):
+        user = User.objects.create_user('replica-user')
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(user)}'
+        response = self.client.post('/chat/room/', {'name': 'new', 'user': user.id}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(choose_replica(user.id))
+        # 钉在主库期间列表不读从库, 能立即看到刚建的房间
+        data = self.client.get('/chat/room/').json()['data']
+        self.assertEqual([item['name'] for item in data['results']], ['new'])
+
+    def test_migrations_stay_on_primary(self):
+        self.assertTrue(self.router.allow_migrate('default', 'chat'))
+        self.assertFalse(self.router.allow_migrate('replica1', 'chat'))
@@ -0,0 +1,258 @@
+import fnmatch
+import math
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+from chat.generations import generations
+
+DEFAULT_THROTTLE = {
+    'STORE': 'chat.throttling.LocalStore',  # 多进程部署时换成 chat.throttling.CacheStore(需要共享的 CACHES)
+    'CACHE': 'default',  # CacheStore 使用的缓存别名
+    'USER_RATE': '20/min',  # 每个用户的对话请求速率, None 为不限制
+    'USER_BURST': None,  # 令牌桶容量, 默认等于速率的请求数
+    'MODEL_RATES': {},  # 每个用户每个模型的速率, 按模型名通配匹配, 如 {'gpt-4*': '5/min'}
+    'MAX_STREAMS': 3,  # 每个用户同时进行的生成数, None 为不限制
+    'STREAM_TTL': 900,  # 生成名额的最长占用时间, 防止进程崩溃后名额一直不释放
+}
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def get_config():
+    return {**DEFAULT_THROTTLE, **getattr(settings, 'CHAT_THROTTLE', {})}
+
+
+def parse_rate(rate):
+    # '20/min' -> (20, 60), 与 DRF 的写法一致
+    if not rate:
+        return None, None
+    num, period = rate.split('/')
+    return int(num), PERIODS[period[0]]
+
+
+class LocalStore:
+    """进程内的令牌桶和并发计数, 只限制当前进程"""
+
+    def __init__(self, config):
+        self.buckets = {}
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        # 取一个令牌, 返回需要等待的秒数, 0 表示放行
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+    def acquire(self, key, limit, ttl):
+        now = time.monotonic()
+        with self.lock:
+            leases = {token: expires for token, expires in self.streams.get(key, {}).items() if expires > now}
+            if len(leases) >= limit:
+                self.streams[key] = leases
+                return None
+            token = uuid.uuid4().hex
+            leases[token] = now + ttl
+            self.streams[key] = leases
+            return token
+
+    def release(self, key, token):
+        with self.lock:
+            leases = self.streams.get(key)
+            if leases is not None:
+                leases.pop(token, None)
+                if not leases:
+                    del self.streams[key]
+
+
+class CacheStore:
+    """
+    基于 Django 缓存的共享实现, 依赖 add/incr 的原子性(Redis、Memcached)
+    令牌桶近似为固定窗口计数, 并发数为带过期时间的计数器
+    """
+
+    def __init__(self, config):
+        self.cache = caches[config['CACHE']]
+
+    def _incr(self, key, timeout):
+        if self.cache.add(key, 1, timeout):
+            return 1
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # 刚好过期, 重新计数
+            self.cache.set(key, 1, timeout)
+            return 1
+
+    def take(self, key, capacity, rate):
+        period = capacity / rate
+        now = time.time()
+        window = int(now // period)
+        count = self._incr(f'throttle:{key}:{window}', math.ceil(period))
+        if count <= capacity:
+            return 0
+        return (window + 1) * period - now
+
+    def acquire(self, key, limit, ttl):
+        key = f'throttle:streams:{key}'
+        count = self._incr(key, ttl)
+        if count > 1:
+            # incr 不会顺延过期时间, 每次占名额都顺延, 否则计数器可能在生成进行中过期, 名额被多占
+            self.cache.touch(key, ttl)
+        if count <= limit:
+            return key
+        self.release(key, key)
+        return None
+
+    def release(self, key, token):
+        try:
+            self.cache.decr(token)
+        except ValueError:
+            pass
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            config = get_config()
+            _store = import_string(config['STORE'])(config)
+        return _store
+
+
+class StreamLease:
+    """一个生成名额, 生成结束时释放; 释放是幂等的"""
+
+    def __init__(self, store, key, token):
+        self.store = store
+        self.key = key
+        self.token = token
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.store.release(self.key, self.token)
+
+
+class TokenBucketThrottle(BaseThrottle):
+    def get_rate(self, request, view):
+        raise NotImplementedError
+
+    def get_key(self, request, view):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        num, period = parse_rate(self.get_rate(request, view))
+        if num is None:
+            return True
+        capacity = self.get_burst() or num
+        self.delay = get_store().take(self.get_key(request, view), capacity, num / period)
+        return self.delay == 0
+
+    def get_burst(self):
+        return None
+
+    def wait(self):
+        return self.delay
+
+
+class ChatRateThrottle(TokenBucketThrottle):
+    """每个用户的对话请求速率"""
+
+    def get_rate(self, request, view):
+        return get_config()['USER_RATE']
+
+    def get_burst(self):
+        return get_config()['USER_BURST']
+
+    def get_key(self, request, view):
+        return f'user:{request.user.pk}'
+
+
+class ModelRateThrottle(TokenBucketThrottle):
+    """每个用户每个模型的请求速率, 贵的模型可以单独限得更严"""
+
+    def get_model(self, request, view):
+        # 限流在视图之前执行, 不查库: 默认模型取缓存里的, 缓存过期时用配置里的
+        from chat.providers import get_default_model
+        return request.query_params.get('model') or get_default_model(cached_only=True)
+
+    def get_rate(self, request, view):
+        rates = get_config()['MODEL_RATES']
+        if not rates:
+            return None
+        self.model = self.get_model(request, view)
+        return next((rate for pattern, rate in rates.items() if fnmatch.fnmatch(self.model, pattern)), None)
+
+    def get_key(self, request, view):
+        return f'model:{request.user.pk}:{self.model}'
+
+
+class ConcurrentStreamThrottle(BaseThrottle):
+    """
+    每个用户同时进行的生成数: 放行时占一个名额放到 request.stream_lease 上
+    视图把名额交给生成(结束时释放), 没交出去的在 finalize_response 里释放, 见 StreamLeaseMixin
+    """
+
+    def allow_request(self, request, view):
+        config = get_config()
+        if not config['MAX_STREAMS']:
+            return True
+        store = get_store()
+        key = f'user:{request.user.pk}'
+        token = store.acquire(key, config['MAX_STREAMS'], config['STREAM_TTL'])
+        if token is None:
+            # 名额可能被一直没人接收的生成占着, 清理掉(归还名额)再试一次
+            generations.cleanup()
+            token = store.acquire(key, config['MAX_STREAMS'], config['STREAM_TTL'])
+        if token is None:
+            return False
+        request.stream_lease = StreamLease(store, key, token)
+        return True
+
+    def wait(self):
+        return 1
+
+
+class ShortCircuitThrottleMixin:
+    """
+    DRF 会把每个限流都执行一遍再取最长的等待时间; 这里第一个拒绝就停,
+    后面的令牌桶和并发名额不会被已经拒绝的请求白白占用, 所以限流的顺序要从便宜到贵
+    """
+
+    def check_throttles(self, request):
+        for throttle in self.get_throttles():
+            if not throttle.allow_request(request, self):
+                self.throttled(request, throttle.wait())
+
+
+class StreamLeaseMixin:
+    """配合 ConcurrentStreamThrottle: 请求结束时名额还在 request 上(被拒绝、复用已有生成、出错)就释放"""
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        lease = getattr(request, 'stream_lease', None)
+        if lease is not None:
+            lease.release()
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    def take_stream_lease(self, request):
+        lease = getattr(request, 'stream_lease', None)
+        request.stream_lease = None
+        return lease
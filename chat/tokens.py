@@ -0,0 +1,33 @@
+import math
+import re
+
+try:
+    import tiktoken
+except ImportError:  # 可选依赖, 没装就用估算
+    tiktoken = None
+
+# 中日韩字符基本是一字一 token, 其它文本按 4 个字符 1 个 token 估算
+CJK_RE = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+# 每条消息在 chat 格式里额外占用的 token (role、分隔符等)
+MESSAGE_OVERHEAD = 4
+
+_encodings = {}
+
+
+def _get_encoding(model):
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding('cl100k_base')
+    return _encodings[model]
+
+
+def count_tokens(text, model=None):
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_get_encoding(model or 'gpt-4o').encode(text))
+    cjk = len(CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
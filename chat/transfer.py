@@ -0,0 +1,255 @@
+import io
+import json
+import zipfile
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+from django.utils.dateparse import parse_datetime
+
+from chat.caches import invalidate_rooms
+from chat.models import Room, Message
+from chat.tokens import count_tokens
+from chat_ai_service.routers import pin_primary
+
+FORMAT_VERSION = 1
+CHUNK_SIZE = 1000  # 导出时每次查询的行数, 导入时每次 bulk_create 的行数
+ZIP_MEMBER = 'history.ndjson'
+
+ROOM_FIELDS = ('id', 'name', 'checked', 'create_time')
+MESSAGE_FIELDS = ('id', 'room_id', 'role', 'content', 'model', 'date_time', 'create_time', 'tokens')
+
+encoder = DjangoJSONEncoder(ensure_ascii=False)
+
+
+class TransferError(Exception):
+    def __init__(self, message, line=None):
+        super().__init__(message)
+        self.line = line
+
+
+def export_records(user, chunk_size=CHUNK_SIZE):
+    """
+    按 [元信息, 房间, 房间的消息..., 房间, ...] 的顺序逐行产出导出记录
+    房间和消息都按主键做键集翻页, 每次只取 chunk_size 行: MySQL 的驱动不支持服务端游标,
+    iterator() 在 MySQL 上仍会把整个结果集读进内存, 键集翻页在所有数据库上内存都是恒定的
+    已归档的房间直接从归档文件里逐条读消息, 不为导出把房间恢复回消息表
+    """
+    from chat.archive import ArchiveError, iter_archived  # archive 依赖本模块
+
+    yield {'type': 'meta', 'version': FORMAT_VERSION, 'user': user.username}
+    last_room = 0
+    while True:
+        rooms = list(Room.objects.filter(user=user, id__gt=last_room).order_by('id')
+                     .values(*ROOM_FIELDS, 'user_id', 'archived_at')[:chunk_size])
+        for room in rooms:
+            user_id, archived_at = room.pop('user_id'), room.pop('archived_at')
+            yield {'type': 'room', **room}
+            if archived_at is not None:
+                try:
+                    for message in iter_archived(Room(id=room['id'], user_id=user_id)):
+                        message.pop('user_id')
+                        message['room'] = message.pop('room_id')
+                        yield {'type': 'message', **message}
+                    continue
+                except ArchiveError:
+                    # 期间被恢复了(恢复成功后才删文件), 消息已经回到消息表
+                    pass
+            # 走 (room, id) 索引
+            last_message = 0
+            while True:
+                messages = list(Message.objects.filter(room_id=room['id'], id__gt=last_message).order_by('id')
+                                .values(*MESSAGE_FIELDS)[:chunk_size])
+                for message in messages:
+                    message['room'] = message.pop('room_id')
+                    yield {'type': 'message', **message}
+                if len(messages) < chunk_size:
+                    break
+                last_message = messages[-1]['id']
+        if len(rooms) < chunk_size:
+            return
+        last_room = rooms[-1]['id']
+
+
+def export_ndjson(user, chunk_size=CHUNK_SIZE):
+    # 每攒 chunk_size 行输出一块, 减少响应的分块数
+    lines = []
+    for record in export_records(user, chunk_size):
+        lines.append(encoder.encode(record))
+        if len(lines) >= chunk_size:
+            yield ('\n'.join(lines) + '\n').encode()
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode()
+
+
+class _Pipe(io.RawIOBase):
+    """zipfile 写入的不可 seek 的缓冲区, 写进来的字节每次被取走后清空"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def export_zip(user, chunk_size=CHUNK_SIZE):
+    # 压缩后的 NDJSON, 边压缩边输出(zipfile 对不可 seek 的输出使用数据描述符, 不需要回写文件头)
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(ZIP_MEMBER, 'w', force_zip64=True) as member:
+            for chunk in export_ndjson(user, chunk_size):
+                member.write(chunk)
+                data = pipe.take()
+                if data:
+                    yield data
+    yield pipe.take()
+
+
+async def iterate_in_thread(iterator):
+    """
+    ASGI 下 StreamingHttpResponse 会把同步迭代器整个读进内存再发送,
+    这里在线程里一块一块地取, 每取一块就发出去; 导出期间数据库连接在同一个线程里复用
+    """
+    step = sync_to_async(lambda: next(iterator, None), thread_sensitive=True)
+    try:
+        while True:
+            chunk = await step()
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await sync_to_async(close_old_connections, thread_sensitive=True)()
+
+
+def read_lines(upload):
+    """上传的文件可以是 NDJSON 或导出的 zip, 逐行读取, 不整个读进内存"""
+    head = upload.read(4)
+    upload.seek(0)
+    if head.startswith(b'PK'):
+        archive = zipfile.ZipFile(upload)
+        name = ZIP_MEMBER if ZIP_MEMBER in archive.namelist() else archive.namelist()[0]
+        stream = archive.open(name)
+    else:
+        stream = upload
+    for line in io.TextIOWrapper(stream, encoding='utf-8'):
+        yield line
+
+
+def parse_time(value):
+    if not value:
+        return None
+    value = parse_datetime(value)
+    if value is None:
+        raise ValueError('create_time 格式错误')
+    return value
+
+
+class Importer:
+    """
+    把导出的记录导入到 user 名下: 房间分批 bulk_create(记下旧 id 到新 id 的映射), 消息分批 bulk_create
+    每批一个短事务, 中途出错时已导入的部分保留, 返回的统计里有出错的行号
+    """
+
+    def __init__(self, user, batch_size=CHUNK_SIZE):
+        self.user = user
+        self.batch_size = batch_size
+        self.room_ids = {}
+        self.rooms = []
+        self.messages = []
+        self.counts = {'rooms': 0, 'messages': 0, 'skipped': 0}
+
+    def run(self, lines):
+        try:
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    self.add(record)
+                except (ValueError, KeyError, TypeError) as e:
+                    raise TransferError(f'第 {number} 行无法解析: {e}', number)
+            self.flush_rooms()
+            self.flush_messages()
+        finally:
+            if self.counts['rooms'] or self.counts['messages']:
+                invalidate_rooms(self.user.id)
+                pin_primary(self.user.id)
+        return self.counts
+
+    def add(self, record):
+        kind = record['type']
+        if kind == 'meta':
+            if record.get('version', FORMAT_VERSION) > FORMAT_VERSION:
+                raise TransferError(f'不支持的导出版本: {record["version"]}')
+        elif kind == 'room':
+            self.flush_messages()
+            room = Room(user=self.user, name=str(record['name'])[:100], checked=bool(record.get('checked', False)))
+            self.rooms.append((record['id'], room, parse_time(record.get('create_time'))))
+            if len(self.rooms) >= self.batch_size:
+                self.flush_rooms()
+        elif kind == 'message':
+            # 消息的房间必须先出现
+            self.flush_rooms()
+            room_id = self.room_ids.get(record['room'])
+            if room_id is None:
+                self.counts['skipped'] += 1
+                return
+            content = str(record['content'])
+            model = str(record.get('model', ''))[:100]
+            message = Message(
+                room_id=room_id,
+                user=self.user,
+                role=str(record['role'])[:100],
+                content=content,
+                model=model,
+                date_time=str(record.get('date_time', ''))[:100],
+                tokens=int(record.get('tokens') or 0) or count_tokens(content, model),
+            )
+            create_time = parse_time(record.get('create_time'))
+            if create_time is not None:
+                message.create_time = create_time
+            self.messages.append(message)
+            if len(self.messages) >= self.batch_size:
+                self.flush_messages()
+        else:
+            raise ValueError(f'unknown record type {kind!r}')
+
+    def flush_rooms(self):
+        if not self.rooms:
+            return
+        with transaction.atomic():
+            rooms = Room.bulk_create_for_user(self.user, [room for _, room, _ in self.rooms])
+            # create_time 是 auto_now_add, bulk_create 时被改成了当前时间, 写回原来的时间
+            restored = []
+            for (_, _, create_time), room in zip(self.rooms, rooms):
+                if create_time is not None:
+                    room.create_time = create_time
+                    restored.append(room)
+            if restored:
+                Room.objects.bulk_update(restored, ['create_time'])
+        for (old_id, _, _), room in zip(self.rooms, rooms):
+            self.room_ids[old_id] = room.id
+        self.counts['rooms'] += len(rooms)
+        self.rooms = []
+
+    def flush_messages(self):
+        if not self.messages:
+            return
+        Message.objects.bulk_create(self.messages, batch_size=self.batch_size)
+        self.counts['messages'] += len(self.messages)
+        self.messages = []
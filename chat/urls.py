@@ -8,4 +8,9 @@ router.register('message', views.MessageView, basename='message')
 
 urlpatterns = [
     path("index", views.ChatView.as_view(), name="chat"),
+    path("generation/<str:generation_id>", views.GenerationView.as_view(), name="generation"),
+    path("cache/stats", views.CompletionCacheStatsView.as_view(), name="completion_cache_stats"),
+    path("metrics", views.MetricsView.as_view(), name="metrics"),
+    path("export", views.ExportView.as_view(), name="export"),
+    path("import", views.ImportView.as_view(), name="import"),
 ] + router.urls
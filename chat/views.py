@@ -1,182 +1,461 @@
 import json
+import zipfile
 from datetime import datetime, timedelta
 
+from django.core.cache import cache
 from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
 from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.filters import OrderingFilter
+from rest_framework.permissions import IsAdminUser
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
-from django.http import StreamingHttpResponse
-from openai import OpenAI
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from chat.archive import ArchiveError, ensure_hot, ensure_message_hot, restore_room
+from chat.caches import CATEGORIZED_TTL, invalidate_rooms, rooms_cache_key
+from chat.completion_cache import completion_cache, is_enabled as cache_enabled, replay
+from chat.context import build_context
+from chat.generations import (Generation, generations, get_background_loop, get_event_loop, iterate_sync,
+                              stream_generation)
+from chat.metrics import CompletionTrace, MetricsPermission, metrics
 from chat.models import Room, Message
-from chat.serializers import RoomSerializer, MessageSerializer
+from chat.persistence import turn_writer
+from chat.providers import get_default_model, get_provider_for_model
+from chat.search import search_messages
+from chat.serializers import (RoomSerializer, MessageSerializer, RoomReadSerializer, MessageReadSerializer,
+                              RoomOperationSerializer)
+from chat.throttling import (ChatRateThrottle, ConcurrentStreamThrottle, ModelRateThrottle,
+                             ShortCircuitThrottleMixin, StreamLeaseMixin)
+from chat.tokens import MESSAGE_OVERHEAD, count_tokens
+from chat.transfer import Importer, TransferError, export_ndjson, export_zip, iterate_in_thread, read_lines
+from chat_ai_service.db import release_connections
+from chat_ai_service.pagination import PaginationModeMixin, PublicCursorPagination
+from chat_ai_service.routers import ReplicaReadMixin, read_from_replica
 from dotenv import load_dotenv
-import os
 
 load_dotenv()
-openai = OpenAI(
-    api_key=os.getenv("API_KEY"),
-    organization=os.getenv("ORGANIZATION"),
-    project=os.getenv("PROJECT"),
-)
+
+
+def stream_response(request, generation, offset=0):
+    # 视图的查询到这里都做完了, 生成期间不占着数据库连接, 消息由后台线程落库
+    release_connections()
+    frames = stream_generation(generation, offset)
+    if getattr(request, 'event_loop', None) is None:
+        # WSGI: 生成在后台事件循环上, 同步地逐帧取出, 照样边生成边发送
+        frames = iterate_sync(frames, get_background_loop())
+    response = StreamingHttpResponse(frames, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    response['X-Generation-Id'] = generation.id
+    return response
 
 
 # Create your views here.
-class ChatView(APIView):
-    @transaction.atomic
+class ChatView(ShortCircuitThrottleMixin, StreamLeaseMixin, APIView):
+    # 限流在鉴权之后、查询数据库和请求上游之前执行, 超限直接 429
+    throttle_classes = [ChatRateThrottle, ModelRateThrottle, ConcurrentStreamThrottle]
+
     def post(self, request):
         # 获取相关参数
         data = json.loads(request.body)
-        model = request.query_params.get('model')
+        model = request.query_params.get('model') or get_default_model()
         content = data['content']
         room = data['room']
         user = request.user
         fetch_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-        # 获取消息上下文
-        serializer_message_list = self.get_messages(room)
-        message_params = serializer_message_list.data + [{'role': 'user', 'content': content}]
+        # 消息是流结束后异步批量写入的, 房间归属要在这里先校验; 已归档的房间先恢复再组装上下文
+        archived = Room.objects.filter(id=room, user=user).values_list('id', 'archived_at').first()
+        if archived is None:
+            return Response({'message': '会话不存在'}, status=status.HTTP_404_NOT_FOUND)
+        if archived[1] is not None:
+            try:
+                restore_room(room)
+            except ArchiveError as e:
+                print(f'restore room {room} failed: {e}')
+                return Response({'message': '会话归档恢复失败'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        # 客户端重试同一个问题时接入进行中的生成, 不重复请求上游
+        resume_offset = self.get_resume_offset(request)
+        generation = generations.find(user.id, (room, content), include_done=bool(resume_offset))
+        if generation is not None:
+            return stream_response(request, generation, min(resume_offset, generation.length))
 
         # 准备 OpenAI API 请求数据
-        messages = [{"role": "system", "content": "You are a helpful assistant."}] + message_params
-        # 发送请求
-        completion = openai.chat.completions.create(
-            model=model,
-            messages=messages,
-            stream=True,
-        )
-
-        response = StreamingHttpResponse(self.event_stream(completion, content, room, user, fetch_time, model),
-                                         content_type='text/event-stream')
-        response['Cache-Control'] = 'no-cache'
+        system_message = {"role": "system", "content": "You are a helpful assistant."}
+        user_message = {'role': 'user', 'content': content}
 
-        return response
+        # 获取消息上下文: 在预算内尽量带上最近的消息
+        reserved = count_tokens(system_message['content'], model) + count_tokens(content, model) + 2 * MESSAGE_OVERHEAD
+        # 组装上下文只读, 走从库; 上一轮的消息刚落库时 pin_primary 会让它读主库
+        with read_from_replica(user.id):
+            messages = [system_message] + self.get_messages(room, model, reserved, content) + [user_message]
 
-    def event_stream(self, completion, content, room, user, fetch_time, model):
-        ai_content = ''
-        try:
-            for chunk in completion:
-                delta = chunk.choices[0].delta
-                if delta.content:
-                    ai_content += delta.content
-                yield delta.content
-        except Exception as e:
-            yield f"data: Error: {str(e)}"
-        finally:
-            if ai_content:
-                self.save_message(content, ai_content, room, user, model, fetch_time)
+        # 视图本身只做鉴权和查询, 生成作为后台 task 在 ASGI 事件循环上运行, 响应只是它的一个订阅者
+        provider = get_provider_for_model(model)
+        generation = self.start_generation(provider, messages, content, room, user, fetch_time, model,
+                                           cache_enabled(request), self.take_stream_lease(request),
+                                           get_event_loop(request))
+        return stream_response(request, generation)
 
-    def save_message(self, content, ai_content, room, user, model, fetch_time):
-        # 存当前的上下文
-        res_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        # 使用字典推导式创建消息字典
-        common_fields = {
-            "room": room,
-            "user": user.id,
-            "model": model,
+    def get_resume_offset(self, request):
+        # 断线重连时 EventSource 会带上 Last-Event-ID, 值为已收到的字符数
+        value = request.headers.get('Last-Event-ID') or request.query_params.get('last_event_id')
+        return int(value) if value and value.isdigit() else 0
+
+    def start_generation(self, provider, messages, content, room, user, fetch_time, model, use_cache=False,
+                         lease=None, loop=None):
+        cached = completion_cache.get(model, messages) if use_cache else None
+        trace = CompletionTrace(model, user.id if user else None, cached is not None)
+
+        def on_finish(generation):
+            # 并发名额在生成结束时归还, 与客户端是否断开无关
+            if lease is not None:
+                lease.release()
+            ai_content = generation.text
+            # 优先用上游报告的用量, 拿不到(缓存回放、兼容接口不支持)时本地估算
+            generation.usage = trace.usage or self.get_usage(messages, ai_content, model)
+            metrics.record(trace, generation.usage, generation.error)
+            if not ai_content:
+                return
+            if use_cache and cached is None and not generation.error:
+                completion_cache.set(model, messages, ai_content)
+            # 不管客户端是否还在, 生成完成后都保存
+            self.save_message(content, ai_content, room, user, model, fetch_time)
+
+        source = trace.wrap(self.generate(provider, messages, model, cached, trace.usage))
+        generation = generations.add(Generation(source, user.id if user else None, (room, content), on_finish))
+        generation.start(loop)
+        return generation
+
+    async def generate(self, provider, messages, model, cached=None, usage=None):
+        if cached is not None:
+            # 命中缓存, 按同样的格式回放, 不请求上游
+            for text in replay(cached):
+                yield text
+            return
+
+        # 发送请求, provider 负责连接池和并发排队
+        async for text in provider.stream(model, messages, usage):
+            yield text
+
+    def get_usage(self, messages, ai_content, model):
+        prompt_tokens = sum(count_tokens(m['content'], model) + MESSAGE_OVERHEAD for m in messages)
+        completion_tokens = count_tokens(ai_content, model)
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
         }
-        message_dict = {**common_fields, "role": 'user', "content": content, "date_time": fetch_time}
-        ai_message_dict = {**common_fields, "role": 'assistant', "content": ai_content, "date_time": res_time}
-        cxt_list = [message_dict, ai_message_dict]
 
-        message_serializer = MessageSerializer(data=cxt_list, many=True)
-        if message_serializer.is_valid():
-            message_serializer.save()
+    def save_message(self, content, ai_content, room, user, model, fetch_time):
+        # 只入队, 由后台线程批量写库, 流的结束不用等数据库
+        turn_writer.put(content, ai_content, room, user.id, model, fetch_time)
+
+    def get_messages(self, room, model, reserved=0, query=None):
+        return build_context(room, model, reserved, query)
+
+
+class GenerationView(APIView):
+    # 断线重连或其它标签页接入进行中的生成: GET generation/<id>, 偏移量取自 Last-Event-ID 或 ?offset=
+    def get(self, request, generation_id):
+        generation = generations.get(generation_id, request.user.id)
+        if generation is None:
+            return Response({'message': '生成不存在或已过期'}, status=status.HTTP_404_NOT_FOUND)
+        value = request.headers.get('Last-Event-ID') or request.query_params.get('offset', '0')
+        offset = min(int(value) if value.isdigit() else 0, generation.length)
+        return stream_response(request, generation, offset)
+
+
+class CompletionCacheStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(completion_cache.stats())
+
+
+class MetricsView(APIView):
+    # Prometheus 抓取: 管理员或带 X-Metrics-Token, 输出纯文本
+    permission_classes = [MetricsPermission]
+
+    def get(self, request):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class ExportView(APIView):
+    """导出当前用户的全部房间和消息: ?type=ndjson(默认) 或 zip, 流式输出, 内存占用与历史大小无关"""
+
+    def get(self, request):
+        # 不用 format 参数, 它被 DRF 用来选择渲染器
+        export_type = request.query_params.get('type', 'ndjson')
+        if export_type not in ('ndjson', 'zip'):
+            return Response({'message': 'type 只支持 ndjson 或 zip'}, status=status.HTTP_400_BAD_REQUEST)
+        date = timezone.localdate().strftime('%Y%m%d')
+        if export_type == 'zip':
+            chunks, content_type, filename = export_zip(request.user), 'application/zip', f'chat-{date}.zip'
         else:
-            print(message_serializer.errors)
-            return Response(message_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            chunks, content_type, filename = export_ndjson(request.user), 'application/x-ndjson', f'chat-{date}.ndjson'
+        if getattr(request, 'event_loop', None) is not None:
+            # ASGI 下同步迭代器会被整个读进内存, 改为在线程里逐块取; WSGI 下本来就是逐块发送
+            chunks = iterate_in_thread(chunks)
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class ImportView(APIView):
+    """导入 ExportView 导出的文件(multipart 的 file 字段, NDJSON 或 zip), 房间和消息都新建在当前用户名下"""
+
+    def post(self, request):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'message': '请上传 file'}, status=status.HTTP_400_BAD_REQUEST)
+        importer = Importer(request.user)
+        try:
+            counts = importer.run(read_lines(upload))
+        except (TransferError, zipfile.BadZipFile, UnicodeDecodeError) as e:
+            return Response({'message': str(e), 'line': getattr(e, 'line', None), 'imported': importer.counts},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(counts, status=status.HTTP_201_CREATED)
+
+
+class FastListMixin:
+    # list 接口用 values() 投影的只读序列化器, 写操作仍然使用 serializer_class
+    read_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer = self.read_serializer_class(request.query_params.get('fields'))
+        ordering = OrderingFilter().get_ordering(request, queryset, self) or []
+        rows = serializer.values(queryset, [field.lstrip('-') for field in ordering])
 
-    def get_messages(self, room):
-        messages_list = Message.objects.filter(room=room).order_by('id')[:10].only('role', 'content')
-        serializer_message_list = MessageSerializer(messages_list, many=True)
-        return serializer_message_list
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(serializer.to_representation(page))
+        return Response(serializer.to_representation(rows))
 
 
-class RoomView(ModelViewSet):
+class RoomView(ReplicaReadMixin, FastListMixin, PaginationModeMixin, ModelViewSet):
+    replica_actions = ('list', 'retrieve', 'categorized', 'categorized_older')
     queryset = Room.objects.all().order_by('-create_time')
     serializer_class = RoomSerializer
+    read_serializer_class = RoomReadSerializer
     filterset_fields = ['user']
     search_fields = ['name']
     ordering_fields = ['user__username', 'id']  # 允许排序的字段
     ordering = ['-create_time']
 
+    # 侧边栏分组: (key, 显示名, 距今天零点的天数)
+    room_buckets = [
+        ('today', '今天', 0),
+        ('yesterday', '昨天', 1),
+        ('three_days_ago', '三天前', 3),
+        ('seven_days_ago', '七天前', 7),
+        ('one_month_ago', '一个月前', 30),
+    ]
+    categorized_limit = 50
+
+    @action(detail=False, methods=['get'], url_path='categorized/older')
+    def categorized_older(self, request):
+        # 超出 categorized 范围(30天/50条)的更早房间, 按月分组, before 为已展示的最后一个房间的 id
+        user = request.user
+        before = request.query_params.get('before')
+        if before and not before.isdigit():
+            return Response({'message': 'before 参数必须是房间 id'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.query_params.get('limit', self.categorized_limit))
+        except ValueError:
+            return Response({'message': 'limit 参数必须是整数'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = min(max(limit, 1), 200)
+
+        cache_key = rooms_cache_key(user.id, 'older', before, limit)
+        data = cache.get(cache_key)
+        if data is not None:
+            return Response(data)
+
+        # 按 (create_time, id) 做键集翻页; 不带 before 时从 categorized 的 30 天窗口之外开始
+        rooms = Room.objects.filter(user=user).defer('summary').order_by('-create_time', '-id')
+        if before:
+            anchor = Room.objects.filter(user=user, id=before).values_list('create_time', flat=True).first()
+            if anchor is None:
+                return Response({'message': '会话不存在'}, status=status.HTTP_404_NOT_FOUND)
+            rooms = rooms.filter(Q(create_time__lt=anchor) | Q(create_time=anchor, id__lt=before))
+        else:
+            today_start = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+            rooms = rooms.filter(create_time__lt=today_start - timedelta(days=self.room_buckets[-1][2]))
+        rooms = list(rooms[:limit])
+
+        groups = {}
+        for room, item in zip(rooms, RoomSerializer(rooms, many=True).data):
+            month = timezone.localtime(room.create_time)
+            key = month.strftime('%Y-%m')
+            if key not in groups:
+                groups[key] = {'key': key, 'date': f'{month.year}年{month.month:02d}月', 'data': []}
+            groups[key]['data'].append(item)
+
+        data = {
+            'groups': list(groups.values()),
+            'next': rooms[-1].id if len(rooms) == limit else None,
+        }
+        cache.set(cache_key, data, CATEGORIZED_TTL)
+        return Response(data)
+
     @action(detail=False, methods=['get'])
     def categorized(self, request):
-
         user = request.user
-        now = timezone.now()
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        yesterday_start = today_start - timedelta(days=1)
-        three_days_ago_start = today_start - timedelta(days=3)
-        seven_days_ago_start = today_start - timedelta(days=7)
-        one_month_ago_start = today_start - timedelta(days=30)
+        today_start = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+
+        # 缓存按用户 + 房间版本号 + 日期, 房间增删改后版本号变化, 跨天后分组边界变化
+        cache_key = rooms_cache_key(user.id, 'categorized', today_start.date())
+        data = cache.get(cache_key)
+        if data is not None:
+            return Response(data)
+
+        # 分组边界只算一次, 从新到旧排列
+        starts = [today_start - timedelta(days=days) for _, _, days in self.room_buckets]
         today_end = today_start + timedelta(days=1)
+        rooms = list(Room.objects.filter(create_time__gte=starts[-1], create_time__lt=today_end, user=user)
+                     .defer('summary').order_by('-create_time')[:self.categorized_limit])
 
-        # 获取过滤条件范围内的所有数据
-        start_time = one_month_ago_start
-        end_time = today_end
-        rooms = Room.objects.filter(create_time__gte=start_time, create_time__lt=end_time, user=user).order_by('-create_time')[:50]
-
-        # 在内存中对查询结果进行分类
-        today_rooms = []
-        yesterday_rooms = []
-        three_days_ago_rooms = []
-        seven_days_ago_rooms = []
-        one_month_ago_rooms = []
-
-        for room in rooms:
-            if today_start <= room.create_time < today_end:
-                today_rooms.append(room)
-            elif yesterday_start <= room.create_time < today_start:
-                yesterday_rooms.append(room)
-            elif three_days_ago_start <= room.create_time < yesterday_start:
-                three_days_ago_rooms.append(room)
-            elif seven_days_ago_start <= room.create_time < three_days_ago_start:
-                seven_days_ago_rooms.append(room)
-            elif one_month_ago_start <= room.create_time < seven_days_ago_start:
-                one_month_ago_rooms.append(room)
-
-        # 序列化数据
-        today_serializer = RoomSerializer(today_rooms, many=True)
-        yesterday_serializer = RoomSerializer(yesterday_rooms, many=True)
-        three_days_ago_serializer = RoomSerializer(three_days_ago_rooms, many=True)
-        seven_days_ago_serializer = RoomSerializer(seven_days_ago_rooms, many=True)
-        one_month_ago_serializer = RoomSerializer(one_month_ago_rooms, many=True)
+        # 一次序列化, 房间已按时间倒序, 顺序扫描即可分组
+        serialized = RoomSerializer(rooms, many=True).data
+        groups = [[] for _ in self.room_buckets]
+        index = 0
+        for room, item in zip(rooms, serialized):
+            while room.create_time < starts[index]:
+                index += 1
+            groups[index].append(item)
 
-        return Response({
-            'today': {'date':'今天','data':today_serializer.data},
-            'yesterday': {'date':'昨天','data':yesterday_serializer.data},
-            'three_days_ago': {'date':'三天前','data':three_days_ago_serializer.data},
-            'seven_days_ago': {'date':'七天前','data':seven_days_ago_serializer.data},
-            'one_month_ago': {'date':'一个月前','data':one_month_ago_serializer.data},
-        })
-        
+        data = {key: {'date': label, 'data': group} for (key, label, _), group in zip(self.room_buckets, groups)}
+        cache.set(cache_key, data, CATEGORIZED_TTL)
+        return Response(data)
 
-   
-        if not isinstance(request.data, list):
-            return Response({'error': 'Expected a list of items.'}, status=status.HTTP_400_BAD_REQUEST)
+    bulk_limit = 500
 
-        serializer = self.get_serializer(data=request.data, many=True)
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        批量操作当前用户的房间, 请求体为操作列表(或 {"operations": [...]}), 例如:
+        [{"op": "create", "name": "新会话"}, {"op": "rename", "id": 1, "name": "改名"},
+         {"op": "check", "id": 2, "checked": true}, {"op": "delete", "ids": [3, 4]}]
+        整批在一个事务里执行: 一次查询校验归属, 然后各一条 DELETE ... IN / bulk_update / bulk_create
+        同一批里被删除的房间, 针对它的改名和选中会被忽略
+        """
+        operations = request.data.get('operations') if isinstance(request.data, dict) else request.data
+        if not isinstance(operations, list):
+            return Response({'message': '请求体必须是操作列表'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(operations) > self.bulk_limit:
+            return Response({'message': f'单次最多 {self.bulk_limit} 个操作'}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = RoomOperationSerializer(data=operations, many=True)
         serializer.is_valid(raise_exception=True)
+        operations = serializer.validated_data
+
+        user = request.user
+        delete_ids = {room_id for op in operations if op['op'] == 'delete' for room_id in op['ids']}
+        update_ids = {op['id'] for op in operations if op['op'] in ('rename', 'check')} - delete_ids
+        referenced = delete_ids | update_ids
+
+        with transaction.atomic():
+            # 一次查询: 校验归属, 同时取出要修改的房间
+            rooms = {}
+            if referenced:
+                rooms = (Room.objects.select_for_update().filter(user=user, id__in=referenced)
+                         .only('id', 'user_id', 'name', 'checked').in_bulk())
+            missing = sorted(referenced - rooms.keys())
+            if missing:
+                return Response({'message': '会话不存在', 'ids': missing}, status=status.HTTP_404_NOT_FOUND)
 
-        # 从序列化器中提取已验证的数据
-        instances = []
-        for item in request.data:
-            instance = Room.objects.get(id=item['id'])
-            instance.active = item['active']
-            instances.append(instance)
+            if delete_ids:
+                Room.objects.filter(user=user, id__in=delete_ids).delete()
 
-        # 使用 bulk_update 方法批量更新
-        Room.objects.bulk_update(instances, ['active'])
+            changed = set()
+            update_fields = set()
+            for op in operations:
+                if op['op'] == 'rename' and op['id'] in update_ids:
+                    rooms[op['id']].name = op['name']
+                    update_fields.add('name')
+                elif op['op'] == 'check' and op['id'] in update_ids:
+                    rooms[op['id']].checked = op['checked']
+                    update_fields.add('checked')
+                else:
+                    continue
+                changed.add(op['id'])
+            if changed:
+                Room.objects.bulk_update([rooms[room_id] for room_id in changed], sorted(update_fields))
 
-        return Response(serializer.data, status=status.HTTP_200_OK)
+            created = [Room(user=user, name=op['name']) for op in operations if op['op'] == 'create']
+            if created:
+                created = Room.bulk_create_for_user(user, created)
 
-    
+            # bulk_create / bulk_update 不触发 post_save, 侧边栏缓存在这里统一失效
+            transaction.on_commit(lambda: invalidate_rooms(user.id))
 
-class MessageView(ModelViewSet):
+        return Response({
+            'created': RoomSerializer(created, many=True).data,
+            'updated': sorted(changed),
+            'deleted': sorted(delete_ids),
+        })
+
+
+class MessageView(ReplicaReadMixin, FastListMixin, ModelViewSet):
+    replica_actions = ('list', 'retrieve', 'search')
     queryset = Message.objects.all()
-    pagination_class = None
+    # 长会话不再一次性返回全部历史, 按 id 倒序分页, next 游标加载更早的消息
+    pagination_class = PublicCursorPagination
     serializer_class = MessageSerializer
+    read_serializer_class = MessageReadSerializer
     filterset_fields = ['user', 'room']  # 过滤字段
+    ordering_fields = ['id']
+    ordering = ['-id']
+
+    def list(self, request, *args, **kwargs):
+        # 按房间取消息时, 房间已归档就先从冷存储恢复
+        room = request.query_params.get('room')
+        if room and room.isdigit():
+            try:
+                ensure_hot(int(room), request.user)
+            except ArchiveError as e:
+                print(f'restore room {room} failed: {e}')
+                return Response({'message': '会话归档恢复失败'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return super().list(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        # 没找到时消息可能在已归档的房间里, 恢复房间后再取一次; 找到时没有额外查询
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            pk = str(kwargs.get(self.lookup_url_kwarg or self.lookup_field, ''))
+            if not pk.isdigit():
+                raise
+            try:
+                restored = ensure_message_hot(int(pk), request.user)
+            except ArchiveError as e:
+                print(f'restore message {pk} failed: {e}')
+                return Response({'message': '会话归档恢复失败'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            if not restored:
+                raise
+        return super().retrieve(request, *args, **kwargs)
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        # 搜索当前用户的消息内容: ?q=关键词(空格分隔, 都要出现)&room=房间id&limit=20, 按相关度排序
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'message': '缺少搜索关键词 q'}, status=status.HTTP_400_BAD_REQUEST)
+        room = request.query_params.get('room')
+        limit = request.query_params.get('limit', '20')
+        if (room and not room.isdigit()) or not limit.isdigit():
+            return Response({'message': 'room 和 limit 必须是数字'}, status=status.HTTP_400_BAD_REQUEST)
+        if room:
+            # 只在一个房间里搜时先恢复归档; 不限房间的搜索不恢复, 否则一次搜索会把所有冷数据搬回来
+            try:
+                ensure_hot(int(room), request.user)
+            except ArchiveError as e:
+                print(f'restore room {room} failed: {e}')
+                return Response({'message': '会话归档恢复失败'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        hits = search_messages(request.user.id, query, int(room) if room else None, int(limit))
+        return Response({'query': query, 'results': hits})
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_ai_service.settings")
 
 application = get_asgi_application()
+
+# 消息写入线程随服务启动, 先重放上次没写进数据库的消息
+from chat.persistence import turn_writer  # noqa: E402
+
+turn_writer.start()
@@ -0,0 +1,160 @@
+"""
+数据库连接管理
+
+- ConnectionPool / PooledDatabaseWrapperMixin: 进程内连接池. ASGI 下每个请求在自己的线程里执行,
+  CONN_MAX_AGE 的持久连接跟着线程走, 不会被下一个请求复用; 连接池让请求结束时把连接还回池里,
+  下个请求直接取用, 取出前对空闲较久的连接做健康检查
+- release_connections: 流式响应在返回前释放连接, 生成期间不占用数据库连接
+"""
+import threading
+import time
+from collections import deque
+
+from django.db import connections
+
+DEFAULT_POOL = {
+    'MAX_SIZE': 20,  # 同时借出的连接上限, 超过时等待
+    'MAX_IDLE': 10,  # 池里最多保留的空闲连接
+    'TIMEOUT': 10,  # 等待空闲连接的最长时间(秒)
+    'MAX_AGE': 600,  # 连接创建后超过这个时间不再放回池里(秒), 避开服务端的 wait_timeout
+    'CHECK_AFTER': 30,  # 空闲超过这个时间的连接, 取出前先 ping 一下(秒)
+}
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    一个数据库别名一个池; 空闲连接后进先出, 最近用过的连接最可能还活着
+    acquire 拿不到连接时在条件变量上等待, 连接的创建和关闭在锁外进行
+    池被这个别名在各线程里的 DatabaseWrapper 共用, 新建和检查连接由借连接的 wrapper 传入的 connect/check 完成
+    """
+
+    def __init__(self, close, config=None):
+        self.close = close
+        self.config = {**DEFAULT_POOL, **(config or {})}
+        self.idle = deque()  # (连接, 创建时间, 放回时间)
+        self.born = {}  # id(连接) -> 创建时间
+        self.in_use = 0
+        self.peak = 0
+        self.created = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, connect, check):
+        deadline = time.monotonic() + self.config['TIMEOUT']
+        with self.condition:
+            while not self.idle and self.in_use >= self.config['MAX_SIZE']:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f'等待数据库连接超时, 已借出 {self.in_use} 个')
+                self.condition.wait(remaining)
+            self.in_use += 1
+            self.peak = max(self.peak, self.in_use)
+            item = self.idle.pop() if self.idle else None
+        try:
+            while item is not None:
+                conn, born, released = item
+                now = time.monotonic()
+                if now - born < self.config['MAX_AGE'] and (
+                        now - released < self.config['CHECK_AFTER'] or check(conn)):
+                    return conn
+                self.discard(conn)
+                with self.condition:
+                    item = self.idle.pop() if self.idle else None
+            conn = connect()
+            self.born[id(conn)] = time.monotonic()
+            self.created += 1
+            return conn
+        except BaseException:
+            with self.condition:
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, conn, reusable=True):
+        born = self.born.get(id(conn), 0)
+        now = time.monotonic()
+        with self.condition:
+            self.in_use -= 1
+            keep = reusable and len(self.idle) < self.config['MAX_IDLE'] and now - born < self.config['MAX_AGE']
+            if keep:
+                self.idle.append((conn, born, now))
+            self.condition.notify()
+        if not keep:
+            self.discard(conn)
+
+    def discard(self, conn):
+        self.born.pop(id(conn), None)
+        try:
+            self.close(conn)
+        except Exception:
+            pass
+
+    def clear(self):
+        with self.condition:
+            items, self.idle = list(self.idle), deque()
+        for conn, _, _ in items:
+            self.discard(conn)
+
+    def stats(self):
+        with self.condition:
+            return {'in_use': self.in_use, 'idle': len(self.idle), 'peak': self.peak, 'created': self.created}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias):
+    return _pools.get(alias)
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    放在数据库后端的 DatabaseWrapper 前面: 新建连接改为从池里借, 关闭改为还回池里
+    在事务中、出过错或关闭了自动提交的连接直接关掉, 不放回池里; 配置在 DATABASES 的 POOL 里
+    """
+
+    @property
+    def pool(self):
+        pool = _pools.get(self.alias)
+        if pool is None:
+            with _pools_lock:
+                pool = _pools.get(self.alias)
+                if pool is None:
+                    # 池按别名在各线程的 wrapper 间共用, 不持有创建它的 wrapper
+                    pool = _pools[self.alias] = ConnectionPool(lambda conn: conn.close(),
+                                                               self.settings_dict.get('POOL'))
+        return pool
+
+    def get_new_connection(self, conn_params):
+        # 需要新建连接时用当前 wrapper 和它这次的连接参数
+        connect = lambda: super(PooledDatabaseWrapperMixin, self).get_new_connection(conn_params)
+        try:
+            return self.pool.acquire(connect, self.check_pooled)
+        except PoolTimeout as e:
+            # 按数据库错误抛出, 由 Django 转成 django.db.OperationalError
+            raise self.Database.OperationalError(str(e)) from e
+
+    def check_pooled(self, conn):
+        raise NotImplementedError
+
+    def _close(self):
+        if self.connection is None:
+            return
+        with self.wrap_database_errors:
+            reusable = not self.in_atomic_block and not self.errors_occurred and self.get_autocommit()
+            self.pool.release(self.connection, reusable)
+
+
+def release_connections():
+    """
+    流式响应返回前调用: 视图的查询已经做完, 之后的生成可能持续几十秒,
+    而 ASGI 下连接要等响应结束(request_finished)才会关闭; 这里提前关闭(或还回池里)
+    之后如果还要查询会自动重新获取, 落库由后台写入线程用它自己的连接完成
+    """
+    for conn in connections.all(initialized_only=True):
+        if not conn.in_atomic_block:
+            conn.close()
@@ -0,0 +1,14 @@
+from django.db.backends.mysql.base import DatabaseWrapper as MySQLDatabaseWrapper
+
+from chat_ai_service.db import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, MySQLDatabaseWrapper):
+    """带进程内连接池的 MySQL 后端, ENGINE 写 chat_ai_service.db"""
+
+    def check_pooled(self, conn):
+        try:
+            conn.ping()
+        except self.Database.Error:
+            return False
+        return True
@@ -0,0 +1,29 @@
+import asyncio
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+
+class EventLoopMiddleware:
+    """
+    ASGI 下把请求所在的事件循环放到 request.event_loop 上, WSGI 下为 None
+    同步视图在线程里运行, 拿不到这个循环; 后台生成要在它上面启动(见 chat.generations)
+    要放在 ProfilingMiddleware 之后: 外层有只支持同步的中间件时, 这里会被当成同步中间件在线程里调用
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        request.event_loop = None
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        request.event_loop = asyncio.get_running_loop()
+        return await self.get_response(request)
@@ -1,4 +1,4 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 
 
 # 继承分页类
@@ -10,3 +10,29 @@ class PublicPagination(PageNumberPagination):
     page_query_param = 'page'  # 页号,第几页的参数 ,比如定义为pages，那么请求分页的参数就应该是pages
     page_size_query_param = 'page_size'  # 自己指定每页显示多少个数
     max_page_size = 200  # 最大允许设置的每页显示的数量
+
+
+# 游标分页: WHERE id < 上一页最后一条 LIMIT n, 翻多深都是常数代价, 适合"加载更早的消息"
+class PublicCursorPagination(CursorPagination):
+    page_size_query_description = "每页的显示的条数，默认为50条数据，最大为200条"
+
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    ordering = '-id'  # 默认从新到旧, next 指向更早的数据
+
+
+# 视图默认用 pagination_class, 请求带 ?pagination=cursor(或 cursor 参数)时切换为游标分页
+class PaginationModeMixin:
+    cursor_pagination_class = PublicCursorPagination
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if params.get('pagination') == 'cursor' or 'cursor' in params:
+                pagination_class = self.cursor_pagination_class
+            else:
+                pagination_class = self.pagination_class
+            self._paginator = pagination_class() if pagination_class else None
+        return self._paginator
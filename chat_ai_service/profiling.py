@@ -0,0 +1,322 @@
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+from django.http import Http404
+from rest_framework import serializers, status
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+DEFAULT_PROFILING = {
+    'ENABLED': False,  # 关闭时中间件不加载, 没有任何开销
+    'SLOW_MS': 500,  # 超过这个耗时的请求记为慢请求, 被采样到的保存 cProfile 结果
+    'SAMPLE_RATE': 0.1,  # 开启 cProfile 的请求比例(cProfile 本身会让请求变慢一倍左右)
+    'PATH': None,  # cProfile 结果的目录
+    'MAX_PROFILES': 50,  # 目录里最多保留的结果数, 超出删除最早的
+    'MAX_RECORDS': 1000,  # 内存里保留的最近请求数
+    'SERVER_TIMING': True,  # 响应里加 Server-Timing 头, 浏览器开发者工具里可以直接看
+}
+
+NUMBER_RE = re.compile(r'\b\d+\b')
+IN_LIST_RE = re.compile(r'IN \([^)]*\)')
+
+
+def get_config():
+    return {**DEFAULT_PROFILING, **getattr(settings, 'PROFILING', {})}
+
+
+_current = contextvars.ContextVar('profiling_record', default=None)
+# Python 的 profiler 同一时间只能有一个在运行, 其它请求这时不采样
+_profiler_lock = threading.Lock()
+
+
+@contextmanager
+def section(name):
+    """把一段代码的耗时记到当前请求的 name 上, 没有开启分析时几乎没有开销"""
+    record = _current.get()
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.add(name, time.perf_counter() - start)
+
+
+class RequestRecord:
+    def __init__(self, request):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = request.method
+        self.path = request.path
+        self.started = time.time()
+        self.timings = Counter()
+        self.queries = 0
+        self.statements = Counter()
+
+    def add(self, name, seconds):
+        self.timings[name] += seconds
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper: 记录每条 SQL 的耗时, 按去掉参数后的语句计数, 找 N+1
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add('db', time.perf_counter() - start)
+            self.queries += 1
+            self.statements[IN_LIST_RE.sub('IN (...)', NUMBER_RE.sub('?', sql))] += 1
+
+    def summary(self, request, response, total):
+        match = getattr(request, 'resolver_match', None)
+        user = getattr(request, 'user', None)
+        return {
+            'id': self.id,
+            'time': self.started,
+            'method': self.method,
+            'path': self.path,
+            'route': match.route if match else None,
+            'view': match.view_name if match else None,
+            'user': user.pk if user is not None and user.is_authenticated else None,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 1),
+            'queries': self.queries,
+            **{f'{name}_ms': round(seconds * 1000, 1) for name, seconds in self.timings.items()},
+            'duplicates': [{'sql': sql, 'count': count} for sql, count in self.statements.most_common(5) if count > 1],
+            'profile': None,
+        }
+
+
+class ProfileStore:
+    """最近请求的统计放内存, 慢请求的 cProfile 结果按时间轮转存到本地目录"""
+
+    def __init__(self, config):
+        self.path = config['PATH'] or os.path.join(settings.BASE_DIR, 'var', 'profiles')
+        self.max_profiles = config['MAX_PROFILES']
+        self.records = deque(maxlen=config['MAX_RECORDS'])
+        self.lock = threading.Lock()
+
+    def add(self, record, profiler=None):
+        if profiler is not None:
+            record['profile'] = record['id']
+            self.save_profile(record, profiler)
+        with self.lock:
+            self.records.append(record)
+
+    def save_profile(self, record, profiler):
+        os.makedirs(self.path, exist_ok=True)
+        profiler.dump_stats(os.path.join(self.path, f'{record["id"]}.prof'))
+        with open(os.path.join(self.path, f'{record["id"]}.json'), 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False)
+        profiles = sorted(
+            (entry for entry in os.scandir(self.path) if entry.name.endswith('.prof')),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in profiles[:-self.max_profiles]:
+            for suffix in ('.prof', '.json'):
+                try:
+                    os.remove(entry.path[:-len('.prof')] + suffix)
+                except FileNotFoundError:
+                    pass
+
+    def endpoints(self):
+        # 按路由汇总, 最慢的排前面
+        with self.lock:
+            records = list(self.records)
+        groups = {}
+        for record in records:
+            key = (record['method'], record['route'] or record['path'])
+            group = groups.setdefault(key, {'method': key[0], 'route': key[1], 'count': 0, 'total_ms': 0,
+                                            'max_ms': 0, 'queries': 0, 'max_queries': 0})
+            group['count'] += 1
+            group['total_ms'] += record['total_ms']
+            group['max_ms'] = max(group['max_ms'], record['total_ms'])
+            group['queries'] += record['queries']
+            group['max_queries'] = max(group['max_queries'], record['queries'])
+        result = []
+        for group in groups.values():
+            count = group.pop('count')
+            result.append({
+                **group,
+                'count': count,
+                'total_ms': round(group['total_ms'], 1),
+                'avg_ms': round(group['total_ms'] / count, 1),
+                'avg_queries': round(group.pop('queries') / count, 1),
+            })
+        return sorted(result, key=lambda group: group['total_ms'], reverse=True)
+
+    def slowest(self, limit=20):
+        with self.lock:
+            records = list(self.records)
+        return sorted(records, key=lambda record: record['total_ms'], reverse=True)[:limit]
+
+    def profile(self, profile_id, sort='cumulative', limit=40):
+        path = os.path.join(self.path, f'{profile_id}.prof')
+        if not re.fullmatch(r'[0-9a-f]+', profile_id) or not os.path.exists(path):
+            return None
+        with open(os.path.join(self.path, f'{profile_id}.json'), encoding='utf-8') as f:
+            record = json.load(f)
+        out = io.StringIO()
+        pstats.Stats(path, stream=out).strip_dirs().sort_stats(sort).print_stats(limit)
+        return {**record, 'stats': out.getvalue()}
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = ProfileStore(get_config())
+    return _store
+
+
+# 开启分析时才替换 DRF 序列化器的 .data, 关闭后还原
+_serializer_data = None
+
+
+def _timed_serializer_data(self):
+    with section('serialize'):
+        return _serializer_data.fget(self)
+
+
+def install_serializer_timing():
+    global _serializer_data
+    if _serializer_data is None:
+        _serializer_data = serializers.BaseSerializer.data
+        serializers.BaseSerializer.data = property(_timed_serializer_data)
+
+
+def uninstall_serializer_timing():
+    global _serializer_data
+    if _serializer_data is not None:
+        serializers.BaseSerializer.data = _serializer_data
+        _serializer_data = None
+
+
+@receiver(setting_changed)
+def profiling_changed(setting, **kwargs):
+    if setting == 'PROFILING' and not get_config()['ENABLED']:
+        uninstall_serializer_timing()
+
+
+class ProfilingMiddleware:
+    """
+    按请求记录 SQL 条数/耗时、重复的 SQL(N+1)、序列化和渲染耗时, 按 SAMPLE_RATE 开启 cProfile,
+    超过 SLOW_MS 的保存结果; 在 /profiling/ 查看(仅管理员)
+    流式响应只统计到返回响应头为止
+    """
+
+    def __init__(self, get_response):
+        self.config = get_config()
+        if not self.config['ENABLED']:
+            uninstall_serializer_timing()
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.store = get_store()
+        # DRF 序列化器的 .data 计入 serialize
+        install_serializer_timing()
+
+    def __call__(self, request):
+        record = RequestRecord(request)
+        token = _current.set(record)
+        profiler = None
+        if random.random() < self.config['SAMPLE_RATE'] and _profiler_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            with self.wrap_connections(record):
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+                        _profiler_lock.release()
+        finally:
+            _current.reset(token)
+        total = time.perf_counter() - start
+
+        summary = record.summary(request, response, total)
+        slow = summary['total_ms'] >= self.config['SLOW_MS']
+        self.store.add(summary, profiler if slow else None)
+        if self.config['SERVER_TIMING']:
+            response['Server-Timing'] = ', '.join(
+                [f'db;dur={summary.get("db_ms", 0)};desc="{record.queries} queries"']
+                + [f'{name};dur={summary[f"{name}_ms"]}' for name in ('serialize', 'render') if f'{name}_ms' in summary]
+                + [f'total;dur={summary["total_ms"]}']
+            )
+        return response
+
+    @contextmanager
+    def wrap_connections(self, record):
+        wrappers = [connections[alias].execute_wrapper(record) for alias in connections]
+        for wrapper in wrappers:
+            wrapper.__enter__()
+        try:
+            yield
+        finally:
+            for wrapper in reversed(wrappers):
+                wrapper.__exit__(None, None, None)
+
+    def process_template_response(self, request, response):
+        # DRF 的 Response 在这之后渲染, 包一层计时
+        render = response.render
+
+        def timed_render():
+            record = _current.get()
+            start = time.perf_counter()
+            try:
+                return render()
+            finally:
+                if record is not None:
+                    record.add('render', time.perf_counter() - start)
+
+        response.render = timed_render
+        return response
+
+
+class ProfilingView(APIView):
+    """按路由汇总的耗时和 SQL 条数, 以及最近最慢的请求"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        limit = request.query_params.get('limit', '20')
+        if not limit.isdigit() or int(limit) < 1:
+            return Response({'message': 'limit 参数必须是正整数'}, status=status.HTTP_400_BAD_REQUEST)
+        store = get_store()
+        return Response({
+            'endpoints': store.endpoints(),
+            'slowest': store.slowest(int(limit)),
+        })
+
+
+class ProfileDetailView(APIView):
+    """一次慢请求的 cProfile 结果, ?sort=cumulative|tottime|calls"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, profile_id):
+        sort = request.query_params.get('sort', 'cumulative')
+        if sort not in ('cumulative', 'tottime', 'calls'):
+            sort = 'cumulative'
+        profile = get_store().profile(profile_id, sort)
+        if profile is None:
+            raise Http404
+        return Response(profile)
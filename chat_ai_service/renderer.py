@@ -1,15 +1,93 @@
+import math
+
+from rest_framework import serializers
 from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # 可选依赖, 没装时 FastPublicRenderer 退回标准库 json
+    orjson = None
 
 
 class PublicRenderer(JSONRenderer):
-    def render(self, data, accepted_media_type=None, renderer_context=None):
+    def envelope(self, data, renderer_context):
         response = renderer_context['response']
-        request = renderer_context['request']
         success = response.status_code < 400
 
-        response_data = {
+        return {
             'code': response.status_code,
             'msg': 'ok' if success else 'error',
             'data': data,
         }
-        return super().render(response_data, accepted_media_type, renderer_context)
\ No newline at end of file
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response_data = self.envelope(data, renderer_context)
+        return super().render(response_data, accepted_media_type, renderer_context)
+
+
+# 可能输出浮点数的字段; 序列化器里没有这些字段时, 它的输出不用逐个检查
+FLOAT_FIELDS = (serializers.FloatField, serializers.DecimalField, serializers.SerializerMethodField,
+                serializers.JSONField, serializers.DictField, serializers.ReadOnlyField)
+
+
+def may_have_floats(serializer):
+    if isinstance(serializer, serializers.ListSerializer):
+        serializer = serializer.child
+    if not isinstance(serializer, serializers.Serializer):
+        return True
+    for field in serializer.fields.values():
+        if isinstance(field, serializers.ListField):
+            field = field.child
+        if isinstance(field, (serializers.BaseSerializer, serializers.ListSerializer)):
+            if may_have_floats(field):
+                return True
+        elif isinstance(field, FLOAT_FIELDS):
+            return True
+    return False
+
+
+def has_odd_float(data):
+    # orjson 与标准库输出不同的浮点数: NaN/Infinity(orjson 输出 null, 标准库报错或输出 NaN)和指数形式
+    # 数据可能很大, 用栈代替递归; 序列化器的输出(ReturnDict/ReturnList)按字段类型判断, 不逐个展开
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, str):
+            continue
+        if isinstance(value, float):
+            if not math.isfinite(value) or 'e' in repr(value):
+                return True
+        elif isinstance(value, (dict, list, tuple)):
+            serializer = getattr(value, 'serializer', None)
+            if serializer is not None and not may_have_floats(serializer):
+                continue
+            stack.extend(value.values() if isinstance(value, dict) else value)
+    return False
+
+
+class FastPublicRenderer(PublicRenderer):
+    """
+    与 PublicRenderer 输出相同的 {code,msg,data} 结构, 用 orjson 序列化
+    datetime、Decimal、惰性翻译字符串等交给 DRF 的 JSONEncoder.default 处理, 保证输出格式一致
+    orjson 与标准库输出不同的情况(非有限或指数形式的浮点数、超出 64 位的整数)退回标准实现
+    """
+    encoder = JSONEncoder()
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson else 0
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # 需要缩进(调试时 Accept 带 indent)或改了 UNICODE_JSON / COMPACT_JSON 时走标准实现
+        if (orjson is None or self.ensure_ascii or not self.compact
+                or self.get_indent(accepted_media_type, renderer_context or {})):
+            return super().render(data, accepted_media_type, renderer_context)
+        response_data = self.envelope(data, renderer_context)
+        if has_odd_float(response_data):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(response_data, default=self.encoder.default, option=self.options)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # 与 JSONRenderer 一样转义 U+2028/U+2029, 输出可以直接嵌进 <script>; 先找首字节, 没有时不用扫两遍
+        if b'\xe2' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
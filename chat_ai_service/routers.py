@@ -0,0 +1,108 @@
+"""
+读写分离: 只读的接口(房间列表、历史消息、搜索、组装上下文)读从库, 其余都走主库
+
+- 读哪个库由 contextvar 决定, 只在 ReplicaReadMixin 标记的只读 action 或 read_from_replica() 里生效,
+  后台线程、管理命令、事务里的查询一律走主库
+- 读自己写过的: 用户写入后 STICKY_SECONDS 秒内(从库可能还没同步到)该用户的读都走主库
+"""
+import contextvars
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+DEFAULT_DATABASE_REPLICAS = {
+    'ALIASES': [],  # DATABASES 里从库的别名, 为空时全部走主库
+    'STICKY_SECONDS': 10,  # 写入后这段时间内读主库, 应大于从库的复制延迟
+}
+
+_state = contextvars.ContextVar('replica_read', default=None)  # (从库别名, 用户id)
+
+
+def get_config():
+    return {**DEFAULT_DATABASE_REPLICAS, **getattr(settings, 'DATABASE_REPLICAS', {})}
+
+
+def _sticky_key(user_id):
+    return f'db:sticky:{user_id}'
+
+
+def pin_primary(*user_ids):
+    """这些用户刚写过数据, 接下来一段时间读主库; 当前请求正在为其中的用户读从库时立即切回主库"""
+    user_ids = [user_id for user_id in user_ids if user_id is not None]
+    config = get_config()
+    if not user_ids or not config['ALIASES']:
+        return
+    cache.set_many({_sticky_key(user_id): 1 for user_id in user_ids}, timeout=config['STICKY_SECONDS'])
+    state = _state.get()
+    if state is not None and state[1] in user_ids:
+        _state.set(None)
+
+
+def choose_replica(user_id):
+    aliases = get_config()['ALIASES']
+    if not aliases or user_id is None or cache.get(_sticky_key(user_id)):
+        return None
+    return random.choice(aliases)
+
+
+@contextmanager
+def read_from_replica(user_id):
+    """块内的读查询走从库(用户刚写过时仍走主库), 一个请求固定用同一个从库"""
+    token = _state.set((choose_replica(user_id), user_id))
+    try:
+        yield
+    finally:
+        _state.reset(token)
+
+
+class ReplicaRouter:
+    """DATABASE_ROUTERS 里配置; 写和迁移只在主库, 从库是主库的镜像"""
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or state[0] is None:
+            return None
+        # 主库上有进行中的事务(比如读时恢复归档), 事务里的读要看到自己的写
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return state[0]
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 主从是同一份数据
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in get_config()['ALIASES']
+
+
+class ReplicaReadMixin:
+    """
+    放在 APIView/ViewSet 前面: replica_actions 里的 action(普通 APIView 按小写的请求方法)读从库;
+    非只读请求成功后把用户钉在主库上一段时间
+    """
+    replica_actions = ('list', 'retrieve')
+
+    def initial(self, request, *args, **kwargs):
+        # 鉴权之后才知道是谁
+        super().initial(request, *args, **kwargs)
+        action = getattr(self, 'action', None) or request.method.lower()
+        if action in self.replica_actions and request.method in SAFE_METHODS:
+            self._replica_token = _state.set((choose_replica(request.user.id), request.user.id))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, '_replica_token', None)
+        if token is not None:
+            _state.reset(token)
+            self._replica_token = None
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                pin_primary(user.id)
+        return super().finalize_response(request, response, *args, **kwargs)
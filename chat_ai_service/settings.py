@@ -29,6 +29,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # 请求分析, PROFILING['ENABLED'] 为 False 时不加载
+    'chat_ai_service.profiling.ProfilingMiddleware',
+    # ASGI 下记下请求所在的事件循环, 后台生成在它上面启动
+    'chat_ai_service.middleware.EventLoopMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -61,15 +65,41 @@ WSGI_APPLICATION = "chat_ai_service.wsgi.application"
 
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.mysql",
+        # MySQL + 进程内连接池(chat_ai_service.db), DB_POOL=0 时用 Django 自带的后端
+        "ENGINE": "chat_ai_service.db" if os.getenv("DB_POOL", "1") == "1" else "django.db.backends.mysql",
         "NAME": "Chat",
         "USER": "root",
         "PASSWORD": "12345678",
         "HOST": "127.0.0.1",
         "PORT": "3306",
+        # 用连接池时保持 0: 请求结束就把连接还回池里; 不用连接池的 WSGI 部署可以设成持久连接的秒数
+        "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", "0")),
+        "CONN_HEALTH_CHECKS": os.getenv("DB_CONN_HEALTH_CHECKS", "1") == "1",
+        "POOL": {
+            "MAX_SIZE": int(os.getenv("DB_POOL_SIZE", "20")),
+            "MAX_IDLE": int(os.getenv("DB_POOL_IDLE", "10")),
+            "TIMEOUT": 10,
+            "MAX_AGE": 600,
+            "CHECK_AFTER": 30,
+        },
     }
 }
 
+# 只读从库: DB_REPLICA_HOSTS=host1,host2, 其余配置与主库相同; 测试时从库镜像到主库的测试库
+for index, host in enumerate(filter(None, os.getenv("DB_REPLICA_HOSTS", "").split(",")), 1):
+    DATABASES[f"replica{index}"] = {
+        **DATABASES["default"],
+        "HOST": host.strip(),
+        "TEST": {"MIRROR": "default"},
+    }
+
+# 只读接口读从库, 用户写入后的一段时间读主库
+DATABASE_ROUTERS = ["chat_ai_service.routers.ReplicaRouter"]
+DATABASE_REPLICAS = {
+    "ALIASES": [alias for alias in DATABASES if alias.startswith("replica")],
+    "STICKY_SECONDS": int(os.getenv("DB_REPLICA_STICKY_SECONDS", "10")),
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         "NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator",
@@ -102,11 +132,11 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 REST_FRAMEWORK = {
     # 认证
-    "DEFAULT_AUTHENTICATION_CLASSES": ["rest_framework_simplejwt.authentication.JWTAuthentication"],
+    "DEFAULT_AUTHENTICATION_CLASSES": ["user.authentication.CachedJWTAuthentication"],
     # 权限
     "DEFAULT_PERMISSION_CLASSES": ["rest_framework.permissions.IsAuthenticated"],
     # 渲染器
-    'DEFAULT_RENDERER_CLASSES': ['chat_ai_service.renderer.PublicRenderer'],
+    'DEFAULT_RENDERER_CLASSES': ['chat_ai_service.renderer.FastPublicRenderer'],
     # 分页
     'DEFAULT_PAGINATION_CLASS': 'chat_ai_service.pagination.PublicPagination',
     # 过滤 OR 搜索 OR 排序
@@ -122,3 +152,141 @@ SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(days=120),  # 配置过期时间
     "REFRESH_TOKEN_LIFETIME": timedelta(days=15),
 }
+
+# 每个模型组装上下文时可用的 token 预算(不含模型回复), 没配置的模型使用 default
+CHAT_CONTEXT_BUDGETS = {
+    'default': 3000,
+    'gpt-3.5-turbo': 3000,
+    'gpt-4o-mini': 8000,
+    'gpt-4o': 8000,
+}
+
+# 长会话滚动摘要
+CHAT_SUMMARY = {
+    'BACKEND': 'chat.summary.ProviderSummaryBackend',  # 测试可换成 chat.summary.LocalSummaryBackend
+    'MODEL': 'gpt-4o-mini',
+    'TRIGGER_TOKENS': 2000,
+    'KEEP_RECENT': 6,
+}
+
+# 语义检索: 消息写入后异步计算向量, 组装上下文时把窗口之外的相关旧消息带上
+CHAT_RETRIEVAL = {
+    'ENABLED': False,
+    'EMBEDDER': 'chat.retrieval.HashingEmbedder',  # 或 chat.retrieval.OpenAIEmbedder
+    'OPTIONS': {},
+    'SCOPE': 'room',
+    'MODE': 'exact',
+    'TOP_K': 4,
+    'MIN_SCORE': 0.25,
+    'BUDGET_RATIO': 0.25,
+}
+
+# 冷热分层: 不活跃的房间由 manage.py archive_rooms(--loop 定时)归档到压缩文件, 访问时自动恢复
+CHAT_ARCHIVE = {
+    'INACTIVE_DAYS': 90,
+    'PATH': os.path.join(BASE_DIR, 'var', 'archive'),
+}
+
+# 消息异步批量写入
+CHAT_WRITE_BEHIND = {
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.5,
+    'MAX_QUEUE': 10000,
+    'SPILL_PATH': os.path.join(BASE_DIR, 'var', 'pending_messages.jsonl'),
+}
+
+# 缓存, 多进程部署时换成 redis 等共享缓存
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chat-ai-service',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+
+# 上游模型服务, OPTIONS 对应 provider 的构造参数
+CHAT_PROVIDERS = {
+    'openai': {
+        'BACKEND': 'chat.providers.OpenAIProvider',
+        'OPTIONS': {
+            'MAX_CONCURRENCY': 64,  # 同时在途的上游请求数
+            'MAX_QUEUE': 256,  # 超过并发上限后最多排队的请求数
+            'QUEUE_TIMEOUT': 30,
+            'MAX_CONNECTIONS': 100,
+            'MAX_KEEPALIVE_CONNECTIONS': 32,
+            'KEEPALIVE_EXPIRY': 60,
+        },
+    },
+    'fake': {
+        'BACKEND': 'chat.providers.FakeProvider',
+        'OPTIONS': {'DELAY': 0.02},
+    },
+}
+# 模型名到 provider 的通配路由, AiModel.provider 非空时优先
+CHAT_MODEL_PROVIDERS = {
+    'fake-*': 'fake',
+    'gpt-*': 'openai',
+}
+CHAT_DEFAULT_PROVIDER = 'openai'
+CHAT_DEFAULT_MODEL = 'gpt-4o-mini'
+
+# 相同上下文的回复缓存(默认关闭, 请求可用 ?cache=1 单独开启)
+CHAT_RESPONSE_CACHE = {
+    'ENABLED': False,
+    'TTL': 3600,
+    'MAX_ENTRIES': 1000,
+    'REPLAY_CHUNK': 16,
+}
+
+# 流式输出的 SSE 编码: 合并小片段, 长时间无输出时发心跳
+CHAT_SSE = {
+    'MAX_BYTES': 1024,
+    'MAX_DELAY': 0.05,
+    'HEARTBEAT': 15,
+}
+
+# 后台生成: 客户端断开不影响上游生成, 可凭生成 id 重新接入
+CHAT_GENERATIONS = {
+    'RING_CHARS': 64 * 1024,
+    'TTL': 600,
+}
+
+# 对话限流: 每用户/每模型令牌桶 + 每用户并发生成数, 多进程部署时 STORE 换成 chat.throttling.CacheStore
+CHAT_THROTTLE = {
+    'STORE': 'chat.throttling.LocalStore',
+    'USER_RATE': '20/min',
+    'MODEL_RATES': {},
+    'MAX_STREAMS': 3,
+    'STREAM_TTL': 900,
+}
+
+# 生成的用量和延迟统计, 按用户/模型/小时聚合写入 CompletionStat; /chat/metrics 输出 Prometheus 格式
+CHAT_METRICS = {
+    'FLUSH_INTERVAL': 30,
+    'TOKEN': os.getenv('METRICS_TOKEN'),
+}
+
+# 请求分析: SQL 条数/耗时、序列化和渲染耗时, 慢请求采样 cProfile, 管理员在 /profiling/ 查看
+PROFILING = {
+    'ENABLED': os.getenv('PROFILING') == '1',
+    'SLOW_MS': 500,
+    'SAMPLE_RATE': 0.1,
+    'PATH': os.path.join(BASE_DIR, 'var', 'profiles'),
+    'MAX_PROFILES': 50,
+}
+
+# 头像: 按内容哈希存储, 缩略图在后台线程池生成, 经 /user/avatar/<hash>/<size> 以长缓存输出
+AVATARS = {
+    'ROOT': 'avatars',
+    'SIZES': (32, 64, 128, 256),
+    'FORMAT': 'WEBP',
+    'QUALITY': 80,
+    'WORKERS': 2,
+}
+
+# 认证用户缓存, 多进程部署时把 SHARED 打开(需要共享的 CACHES)
+USER_AUTH_CACHE = {
+    'SHARED': False,
+    'TTL': 300,
+    'MAX_ENTRIES': 10000,
+}
@@ -3,10 +3,14 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from chat_ai_service.profiling import ProfileDetailView, ProfilingView
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("chat/", include("chat.urls")),
     path("user/", include("user.urls")),
+    path("profiling/", ProfilingView.as_view(), name="profiling"),
+    path("profiling/<str:profile_id>", ProfileDetailView.as_view(), name="profile_detail"),
 ]
 
 if settings.DEBUG:
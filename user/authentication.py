@@ -0,0 +1,115 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+DEFAULT_USER_AUTH_CACHE = {
+    'SHARED': False,  # True 时用 Django 缓存保存版本号和用户, 多进程间失效同步
+    'TTL': 300,
+    'MAX_ENTRIES': 10000,
+}
+
+
+def get_config():
+    return {**DEFAULT_USER_AUTH_CACHE, **getattr(settings, 'USER_AUTH_CACHE', {})}
+
+
+class UserCache:
+    """
+    已认证用户(连同 profile)的缓存, 键为 用户id + 版本号
+    用户或 profile 变更时版本号加一, 旧条目不再命中
+    本地 LRU 存 pickle 后的字节, 每次取出都是新对象, 视图里修改 user 不会污染缓存
+    """
+
+    def __init__(self, max_entries=10000, ttl=300, shared=False):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self.local = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def version(self, user_id):
+        if self.shared:
+            return cache.get_or_set(f'auth:user_version:{user_id}', 1, timeout=None)
+        return self.versions.get(user_id, 1)
+
+    def get(self, user_id):
+        key = (user_id, self.version(user_id))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.local.get(key)
+            if entry is not None and entry[0] > now:
+                self.local.move_to_end(key)
+                return pickle.loads(entry[1])
+        if self.shared:
+            data = cache.get(f'auth:user:{key[0]}:{key[1]}')
+            if data is not None:
+                self._store(key, data)
+                return pickle.loads(data)
+        return None
+
+    def set(self, user):
+        key = (user.pk, self.version(user.pk))
+        data = pickle.dumps(user)
+        self._store(key, data)
+        if self.shared:
+            cache.set(f'auth:user:{key[0]}:{key[1]}', data, self.ttl)
+
+    def _store(self, key, data):
+        with self.lock:
+            self.local[key] = (time.monotonic() + self.ttl, data)
+            self.local.move_to_end(key)
+            while len(self.local) > self.max_entries:
+                self.local.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.versions[user_id] = self.versions.get(user_id, 1) + 1
+            for key in [key for key in self.local if key[0] == user_id]:
+                del self.local[key]
+        if self.shared:
+            try:
+                cache.incr(f'auth:user_version:{user_id}')
+            except ValueError:
+                cache.set(f'auth:user_version:{user_id}', 2, timeout=None)
+
+
+_config = get_config()
+user_cache = UserCache(max_entries=_config['MAX_ENTRIES'], ttl=_config['TTL'], shared=_config['SHARED'])
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """与 JWTAuthentication 相同的校验, 但 user + profile 走缓存, 命中时不查库"""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        user = user_cache.get(user_id)
+        if user is None:
+            try:
+                user = User.objects.select_related('profile').get(**{api_settings.USER_ID_FIELD: user_id})
+            except User.DoesNotExist:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found")
+            user_cache.set(user)
+
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
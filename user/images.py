@@ -0,0 +1,110 @@
+import hashlib
+import io
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image, ImageOps
+
+DEFAULT_AVATARS = {
+    'ROOT': 'avatars',  # MEDIA_ROOT 下的目录
+    'SIZES': (32, 64, 128, 256),  # 生成的正方形缩略图边长
+    'FORMAT': 'WEBP',
+    'QUALITY': 80,
+    'WORKERS': 2,  # Pillow 缩放和编码时释放 GIL, 线程池即可并行
+    'MAX_PIXELS': 40_000_000,  # 超过这个像素数的图片拒绝解码, 防止解压炸弹
+}
+
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp', 'BMP': 'bmp'}
+
+
+def get_config():
+    return {**DEFAULT_AVATARS, **getattr(settings, 'AVATARS', {})}
+
+
+def avatar_dir(digest):
+    # 按内容寻址: 相同的图片只存一份, 路径不变所以可以永久缓存
+    return f'{get_config()["ROOT"]}/{digest[:2]}/{digest}'
+
+
+def thumbnail_path(digest, size):
+    return f'{avatar_dir(digest)}/{size}.{get_config()["FORMAT"].lower()}'
+
+
+def store_avatar(profile, upload):
+    """
+    请求里只做哈希和保存原图(已存在则跳过), 把 profile 指向它;
+    解码、裁剪、缩放和编码在事务提交后交给后台线程池
+    """
+    data = upload.read()
+    digest = hashlib.sha256(data).hexdigest()
+    image = getattr(upload, 'image', None)  # ImageField 校验时 Pillow 已识别出格式
+    ext = EXTENSIONS.get(getattr(image, 'format', None), 'jpg')
+    path = f'{avatar_dir(digest)}/original.{ext}'
+    if not default_storage.exists(path):
+        default_storage.save(path, ContentFile(data))
+    profile.image.name = path
+    profile.avatar_hash = digest
+    transaction.on_commit(lambda: schedule_thumbnails(digest, path))
+    return digest
+
+
+def make_thumbnails(digest, path):
+    config = get_config()
+    missing = [size for size in sorted(config['SIZES'], reverse=True)
+               if not default_storage.exists(thumbnail_path(digest, size))]
+    if not missing:
+        return
+    with default_storage.open(path, 'rb') as f:
+        # open 只读文件头; 按本地的上限检查, 不改 Image.MAX_IMAGE_PIXELS, 以免影响进程里其它用到 Pillow 的地方
+        image = Image.open(f)
+        width, height = image.size
+        if width * height > config['MAX_PIXELS']:
+            raise Image.DecompressionBombError(f'image has {width * height} pixels, limit is {config["MAX_PIXELS"]}')
+        image.draft('RGB', (missing[0], missing[0]))  # JPEG 直接按缩小的尺寸解码
+        image = ImageOps.exif_transpose(image)
+    image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    # 居中裁成正方形, 从大到小依次缩放, 每一级都基于上一级, 减少计算量
+    image = ImageOps.fit(image, (missing[0], missing[0]), Image.LANCZOS)
+    for size in missing:
+        image = image.resize((size, size), Image.LANCZOS) if image.width != size else image
+        buffer = io.BytesIO()
+        image.save(buffer, config['FORMAT'], quality=config['QUALITY'])
+        target = thumbnail_path(digest, size)
+        if not default_storage.exists(target):
+            default_storage.save(target, ContentFile(buffer.getvalue()))
+
+
+_executor = None
+_pending = set()
+_lock = threading.Lock()
+
+
+def _run(digest, path):
+    try:
+        make_thumbnails(digest, path)
+    except Exception as e:
+        print(f'make thumbnails for {digest} failed: {e}')
+    finally:
+        with _lock:
+            _pending.discard(digest)
+
+
+def schedule_thumbnails(digest, path):
+    global _executor
+    with _lock:
+        if digest in _pending:
+            return
+        _pending.add(digest)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_config()['WORKERS'], thread_name_prefix='avatar')
+    try:
+        _executor.submit(_run, digest, path)
+    except RuntimeError:
+        with _lock:
+            _pending.discard(digest)
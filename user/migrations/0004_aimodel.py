@@ -0,0 +1,44 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user", "0003_alter_profile_default_room"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AiModel",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(help_text="模型名字", max_length=100)),
+                ("description", models.TextField(help_text="模型描述")),
+                ("create_time", models.DateTimeField(auto_now_add=True)),
+                ("update_time", models.DateTimeField(auto_now=True)),
+                (
+                    "is_default",
+                    models.BooleanField(default=False, help_text="是否默认模型"),
+                ),
+                (
+                    "provider",
+                    models.CharField(
+                        blank=True,
+                        default="",
+                        help_text="上游服务, 为空时按 CHAT_MODEL_PROVIDERS 路由",
+                        max_length=50,
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user", "0004_aimodel"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="profile",
+            name="avatar_hash",
+            field=models.CharField(
+                blank=True,
+                default="",
+                help_text="头像内容的 sha256, 缩略图按它存取",
+                max_length=64,
+            ),
+        ),
+    ]
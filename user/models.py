@@ -31,6 +31,7 @@ class AiModel(models.Model):
     create_time = models.DateTimeField(auto_now_add=True)
     update_time = models.DateTimeField(auto_now=True)
     is_default = models.BooleanField(default=False, help_text='是否默认模型')
+    provider = models.CharField(max_length=50, blank=True, default='', help_text='上游服务, 为空时按 CHAT_MODEL_PROVIDERS 路由')
 
     def __str__(self):
         return self.name
@@ -40,3 +41,4 @@ class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     default_room = models.OneToOneField(Room, on_delete=models.SET_NULL, null=True, blank=True)
     image = models.ImageField(default='default.jpg', upload_to=user_directory_path, blank=True, null=True)
+    avatar_hash = models.CharField(max_length=64, blank=True, default='', help_text='头像内容的 sha256, 缩略图按它存取')
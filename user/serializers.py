@@ -1,12 +1,24 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from django.urls import reverse
+
+from .images import get_config as get_avatar_config, store_avatar
 from .models import Profile
 
 
 class ProfileSerializer(serializers.ModelSerializer):
+    avatar = serializers.SerializerMethodField()
+
     class Meta:
         model = Profile
-        fields = ['image', 'default_room_id']
+        fields = ['image', 'default_room_id', 'avatar']
+
+    def get_avatar(self, profile):
+        # 各尺寸缩略图的地址, 内容寻址, 可以永久缓存
+        if not profile.avatar_hash:
+            return None
+        return {str(size): reverse('avatar', args=[profile.avatar_hash, size])
+                for size in get_avatar_config()['SIZES']}
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -33,8 +45,11 @@ class UserSerializer(serializers.ModelSerializer):
         # 创建用户
         user = User.objects.create_user(**validated_data)
 
-        # 创建或获取已存在的 Profile 并关联图片
-        Profile.objects.create(user=user, image=image)
+        # 创建 Profile 并关联图片, 缩略图在后台生成
+        profile = Profile(user=user)
+        if image:
+            store_avatar(profile, image)
+        profile.save()
 
         return user
 
@@ -54,7 +69,7 @@ class UserSerializer(serializers.ModelSerializer):
         # 更新或创建 Profile
         profile, created = Profile.objects.get_or_create(user=instance)
         if image:
-            profile.image = image
+            store_avatar(profile, image)
         profile.save()
 
         return instance
@@ -1,3 +1,133 @@
-from django.test import TestCase
+import hashlib
+import io
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from PIL import Image
+from rest_framework_simplejwt.tokens import AccessToken
+
+from user import images, views
+from user.authentication import UserCache
+from user.images import make_thumbnails, thumbnail_path
+from user.models import Profile
+
+
+def make_image(size=(300, 200), color='red', format='PNG'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format)
+    return buffer.getvalue()
+
+
+@override_settings(AVATARS={'SIZES': (32, 64), 'FORMAT': 'WEBP'})
+class AvatarTests(TestCase):
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=path)
+        media.enable()
+        self.addCleanup(media.disable)
+        # 缩略图不进后台线程池, 由测试直接生成
+        self.schedule = mock.Mock()
+        for patch in (mock.patch.object(images, 'schedule_thumbnails', self.schedule),
+                      mock.patch.object(views, 'schedule_thumbnails', self.schedule)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def register(self, username, data):
+        upload = SimpleUploadedFile('avatar.png', data, 'image/png')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/user/register', {'username': username, 'password': 'password',
+                                                            'image': upload})
+        self.assertEqual(response.status_code, 201)
+        return response.json()['data']
+
+    def test_register_stores_original_by_content(self):
+        data = make_image()
+        digest = hashlib.sha256(data).hexdigest()
+        user = self.register('avatar-user', data)
+        self.assertEqual(user['profile']['avatar'], {'32': f'/user/avatar/{digest}/32',
+                                                     '64': f'/user/avatar/{digest}/64'})
+        profile = Profile.objects.get(user_id=user['id'])
+        self.assertEqual(profile.avatar_hash, digest)
+        self.assertTrue(default_storage.exists(profile.image.name))
+        self.schedule.assert_called_once_with(digest, profile.image.name)
+
+        # 相同的图片只存一份
+        other = Profile.objects.get(user_id=self.register('avatar-user-2', data)['id'])
+        self.assertEqual(other.image.name, profile.image.name)
+
+    def test_thumbnails_are_square_and_cached_forever(self):
+        data = make_image()
+        user = self.register('avatar-user', data)
+        profile = Profile.objects.get(user_id=user['id'])
+        digest = profile.avatar_hash
+
+        # 缩略图还没生成: 返回原图, 只短暂缓存, 并确保已排队
+        self.schedule.reset_mock()
+        response = self.client.get(f'/user/avatar/{digest}/32')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(b''.join(response.streaming_content), data)
+        self.schedule.assert_called_once_with(digest, profile.image.name)
+
+        make_thumbnails(digest, profile.image.name)
+        for size in (32, 64):
+            with default_storage.open(thumbnail_path(digest, size), 'rb') as f:
+                self.assertEqual(Image.open(f).size, (size, size))
+
+        response = self.client.get(f'/user/avatar/{digest}/64')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        etag = response['ETag']
+        b''.join(response.streaming_content)
+        response = self.client.get(f'/user/avatar/{digest}/64', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_unknown_avatar(self):
+        digest = '0' * 64
+        self.assertEqual(self.client.get(f'/user/avatar/{digest}/32').status_code, 404)
+        self.assertEqual(self.client.get(f'/user/avatar/{digest}/33').status_code, 404)
+        self.assertEqual(self.client.get('/user/avatar/not-a-hash/32').status_code, 404)
+
+    def test_oversized_image_is_rejected_without_touching_pillow_limit(self):
+        data = make_image()
+        profile = Profile.objects.get(user_id=self.register('avatar-user', data)['id'])
+        limit = Image.MAX_IMAGE_PIXELS
+        with override_settings(AVATARS={'SIZES': (32, 64), 'FORMAT': 'WEBP', 'MAX_PIXELS': 300 * 200 - 1}):
+            with self.assertRaises(Image.DecompressionBombError):
+                make_thumbnails(profile.avatar_hash, profile.image.name)
+        self.assertEqual(Image.MAX_IMAGE_PIXELS, limit)
+        self.assertFalse(default_storage.exists(thumbnail_path(profile.avatar_hash, 32)))
+        make_thumbnails(profile.avatar_hash, profile.image.name)
+        self.assertEqual(Image.MAX_IMAGE_PIXELS, limit)
+        self.assertTrue(default_storage.exists(thumbnail_path(profile.avatar_hash, 32)))
+
+
+class AuthCacheTests(TestCase):
+    def test_user_changes_invalidate_cached_user(self):
+        user = User.objects.create_user('cached-user', email='old@example.com', password='password')
+        headers = {'Authorization': f'Bearer {AccessToken.for_user(user)}'}
+        self.assertEqual(self.client.get('/user/info', headers=headers).json()['data']['email'], 'old@example.com')
+
+        user.email = 'new@example.com'
+        user.save()
+        self.assertEqual(self.client.get('/user/info', headers=headers).json()['data']['email'], 'new@example.com')
+
+        user.is_active = False
+        user.save()
+        self.assertEqual(self.client.get('/user/info', headers=headers).status_code, 401)
+
+    def test_cached_user_is_a_copy(self):
+        user = User.objects.create_user('copied-user', password='password')
+        users = UserCache()
+        users.set(user)
+        cached = users.get(user.pk)
+        cached.username = 'changed'
+        self.assertEqual(users.get(user.pk).username, 'copied-user')
+        users.invalidate(user.pk)
+        self.assertIsNone(users.get(user.pk))
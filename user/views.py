@@ -1,8 +1,13 @@
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.views import View
 from rest_framework import status
 from rest_framework.generics import GenericAPIView, RetrieveAPIView
 from rest_framework.response import Response
 
 from chat.models import Room
+from user.images import HASH_RE, get_config as get_avatar_config, schedule_thumbnails, thumbnail_path
+from user.models import Profile
 from user.serializers import UserSerializer
 from django.contrib.auth.models import User
 
@@ -59,3 +64,32 @@ class ToggleRoomView(GenericAPIView):
         user_serializer = UserSerializer(user)
         
         return Response(user_serializer.data, status=status.HTTP_200_OK)
+
+
+class AvatarView(View):
+    """
+    头像缩略图, 路径按内容寻址, 永久缓存; 不需要登录(<img> 带不了 token)
+    缩略图还没生成好时返回原图并只短暂缓存, 同时确保已排队生成
+    """
+    IMMUTABLE = 'public, max-age=31536000, immutable'
+
+    def get(self, request, digest, size):
+        if not HASH_RE.match(digest) or size not in get_avatar_config()['SIZES']:
+            raise Http404
+        etag = f'"{digest}-{size}"'
+        path = thumbnail_path(digest, size)
+        if default_storage.exists(path):
+            if request.headers.get('If-None-Match') == etag:
+                response = HttpResponseNotModified()
+            else:
+                response = FileResponse(default_storage.open(path, 'rb'))
+            response['Cache-Control'] = self.IMMUTABLE
+            response['ETag'] = etag
+            return response
+        original = Profile.objects.filter(avatar_hash=digest).values_list('image', flat=True).first()
+        if not original or not default_storage.exists(original):
+            raise Http404
+        schedule_thumbnails(digest, original)
+        response = FileResponse(default_storage.open(original, 'rb'))
+        response['Cache-Control'] = 'public, max-age=60'
+        return response